@@ -3,6 +3,7 @@ import json
 import streamlit as st
 from src.common.home import Home
 from src.common.chatBot import ChatBot
+from src.common.retrieverRegistry import get_registry
 from src.common.courseMaterial import CourseMaterial
 from src.s3.getFiles import load_files_from_s3, get_updated_config_list
 from src.common.reference import Reference
@@ -20,6 +21,18 @@ logger = Logger.get_logger()
 config_list = get_updated_config_list()
 
 
+def release_chatbot():
+    """
+    Function to release the shared retrievers held by the chatbot of the previous course.
+    """
+    if "retriever" in st.session_state:
+        del st.session_state['retriever']
+    if "page_chatbot" in st.session_state:
+        get_registry().release(st.session_state.page_chatbot)
+        if st.session_state.page_chatbot.federated_retriever is not None:
+            st.session_state.page_chatbot.federated_retriever.close()
+
+
 def refresh_application():
     """
     Function to refresh the application based on the user's selection.
@@ -29,11 +42,11 @@ def refresh_application():
         logger.info(
             f"Logging into application: {st.session_state.active_application}")
         if st.session_state['active_application'] in {"COLCPL", "CALLAW", "EUAIA"}:
+            release_chatbot()
             st.session_state.page_home = Home()
             return
         if st.session_state['active_application'] not in {"CONSU"}:
-            if "retriever" in st.session_state:
-                del st.session_state['retriever']
+            release_chatbot()
             if "messages" in st.session_state:
                 del st.session_state['messages']
             st.session_state.page_chatbot = ChatBot()
@@ -0,0 +1,173 @@
+# Import the required libraries
+import re
+import time
+import random
+import threading
+import hashlib
+from functools import lru_cache
+from typing import Optional, Sequence, List
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
+from langchain_core.callbacks import Callbacks
+
+_WORDS = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=1 << 16)
+def _hash_token(token, dimension):
+    """
+    Function to get the bucket and the sign of a token.
+
+    Args:
+    token (str): The token.
+    dimension (int): The number of buckets.
+
+    Returns:
+    tuple: The bucket and the sign.
+    """
+    digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+    return digest % dimension, 1.0 if digest >> 63 else -1.0
+
+
+def tokenize(text):
+    """
+    Function to split a text into lower-cased words.
+
+    Args:
+    text (str): The text.
+
+    Returns:
+    list: The words.
+    """
+    return _WORDS.findall(text.lower())
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic offline stand-in for OpenAIEmbeddings.
+
+    Texts are embedded as signed hashed bags of words scaled to unit length, so texts sharing
+    words are close and dense retrieval gives meaningful recall without any network call.
+
+    Attributes:
+    model (str): The name of the model, part of the embedding cache key.
+    dimension (int): The size of the vectors.
+    latency (float): The seconds every call sleeps, to emulate the API.
+    """
+    def __init__(self, dimension=256, latency=0.0):
+        """
+        The constructor for the FakeEmbeddings class.
+
+        Args:
+        dimension (int): The size of the vectors.
+        latency (float): The seconds every call sleeps, to emulate the API.
+        """
+        self.dimension = dimension
+        self.latency = latency
+        self.model = f"fake-hashing-{dimension}"
+
+    def _embed(self, text):
+        """
+        Function to embed one text.
+
+        Args:
+        text (str): The text.
+
+        Returns:
+        list: The unit vector of the text.
+        """
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for token in tokenize(text):
+            bucket, sign = _hash_token(token, self.dimension)
+            vector[bucket] += sign
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._embed(text)
+
+
+class FakeReranker(BaseDocumentCompressor):
+    """
+    Deterministic offline stand-in for CohereRerank.
+
+    Documents are scored by the share of the query words they contain, ties keep the retrieval
+    order, and the top_n best are returned with their relevance_score like CohereRerank does.
+
+    Attributes:
+    top_n: The number of documents to return.
+    latency: The seconds every call sleeps, to emulate the API.
+    """
+    top_n: Optional[int] = 3
+    latency: float = 0.0
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        if self.latency:
+            time.sleep(self.latency)
+        query_words = set(tokenize(query))
+        scored = []
+        for doc in documents:
+            doc_words = set(tokenize(doc.page_content))
+            scored.append(len(query_words & doc_words) / len(query_words) if query_words else 0.0)
+        order = sorted(range(len(documents)), key=lambda i: scored[i], reverse=True)[:self.top_n]
+        return [documents[i].copy(update={"metadata": {**documents[i].metadata, "relevance_score": scored[i]}})
+                for i in order]
+
+
+class FakeProvider:
+    """
+    Offline stand-in for an LLM provider, called with a filled prompt like the providers of LLMRouter.
+
+    Every call sleeps for the latency with up to jitter more, and a share of the calls raise, so
+    routing, hedging and failover can be exercised without any network call. The attributes can
+    be changed between calls to emulate a provider slowing down or going down.
+
+    Attributes:
+    name (str): The name of the provider, prefixed to the responses.
+    latency (float): The seconds every call sleeps.
+    jitter (float): The share of the latency added at random.
+    error_rate (float): The share of the calls that raise.
+    calls (int): The number of calls made.
+    """
+    def __init__(self, name, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        """
+        The constructor for the FakeProvider class.
+
+        Args:
+        name (str): The name of the provider, prefixed to the responses.
+        latency (float): The seconds every call sleeps.
+        jitter (float): The share of the latency added at random.
+        error_rate (float): The share of the calls that raise.
+        seed (int): The random seed of the jitter and the errors.
+        """
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, text):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * (1 + self.jitter * self._random.random())
+            failed = self._random.random() < self.error_rate
+        time.sleep(delay)
+        if failed:
+            raise RuntimeError(f"Injected error of provider {self.name}")
+        return f"{self.name}: {text}"
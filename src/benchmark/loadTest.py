@@ -0,0 +1,320 @@
+# Import the required libraries
+import os
+import sys
+import json
+import time
+import types
+import random
+import argparse
+import resource
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import streamlit as st
+from src.benchmark.retrievalBenchmark import generate_corpus, make_queries, get_commit
+from src.common.customHybridRetriever import Retriever
+from src.common.retrieverRegistry import get_registry
+from src.common.metrics import get_metrics
+from src.common.rateLimiter import get_scheduler
+import src.common.chatBot as chatBot
+
+# Defaults of the load test
+DEFAULT_USERS = 20
+DEFAULT_COURSES = 2
+DEFAULT_QUESTIONS = 5
+DEFAULT_THINK_TIME = 1.0
+DEFAULT_PARAGRAPHS = 400
+DEFAULT_STARTER_SHARE = 0.3
+DEFAULT_SEED = 13
+
+# Number of starter questions of every generated course
+NUM_STARTER_QUESTIONS = 3
+
+
+class _SessionState(threading.local):
+    """
+    Session state of the simulated users, one per thread as Streamlit keeps one per browser session.
+    """
+    def __contains__(self, key):
+        return key in self.__dict__
+
+    def __getitem__(self, key):
+        return self.__dict__[key]
+
+    def __setitem__(self, key, value):
+        self.__dict__[key] = value
+
+
+class _CourseOwner:
+    """
+    Placeholder owning the registry reference of a course for the duration of the load test.
+    """
+
+
+def percentiles(values):
+    """
+    Function to summarize a list of latencies.
+
+    Args:
+    values (list): The latencies in seconds.
+
+    Returns:
+    dict: The count, mean, p50, p95 and p99 in milliseconds.
+    """
+    if not values:
+        return {"count": 0}
+    values = np.array(values) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": len(values), "mean_ms": round(float(values.mean()), 2), "p50_ms": round(float(p50), 2),
+            "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2)}
+
+
+def start_mock_server(latency, tokens_per_second, error_rate, answer_words, seed):
+    """
+    Function to start the mock OpenAI and Cohere server in its own process.
+
+    Running it in another process keeps its work off the interpreter lock of the app under test.
+
+    Returns:
+    tuple: The server process and its URL.
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "src.benchmark.mockServer", "--latency", str(latency),
+         "--tokens-per-second", str(tokens_per_second), "--error-rate", str(error_rate),
+         "--answer-words", str(answer_words), "--seed", str(seed)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def stop_mock_server(process):
+    """
+    Function to stop the mock server.
+
+    Args:
+    process (subprocess.Popen): The server process.
+
+    Returns:
+    dict: The statistics of the server, None if it did not report them.
+    """
+    process.send_signal(subprocess.signal.SIGINT)
+    try:
+        _, stderr = process.communicate(timeout=10)
+        return json.loads(stderr.strip().splitlines()[-1])
+    except (subprocess.TimeoutExpired, ValueError, IndexError):
+        process.kill()
+        return None
+
+
+def build_courses(work_dir, num_courses, num_paragraphs, seed):
+    """
+    Function to generate and index the synthetic courses through the mock APIs.
+
+    Args:
+    work_dir (str): The folder holding the courses.
+    num_courses (int): The number of courses.
+    num_paragraphs (int): The number of paragraphs of every course.
+    seed (int): The random seed of the first course.
+
+    Returns:
+    list: The configurations of the courses, with the questions to ask in QUESTIONS.
+    """
+    config_params = []
+    for i in range(num_courses):
+        course_dir = os.path.join(work_dir, f"course{i}")
+        os.makedirs(course_dir)
+        corpus_path = os.path.join(course_dir, "corpus.txt")
+        generate_corpus(corpus_path, num_paragraphs, seed + i)
+
+        retriever = Retriever(os.path.join(course_dir, "index"), os.path.join(course_dir, "hybrid_db"))
+        retriever.embedding_cache_path = os.path.join(course_dir, "embedding_cache.sqlite")
+        retriever.create_vector_store(corpus_path)
+
+        questions = [query for query, _ in make_queries(list(retriever.index_bundle.iter_documents()), 50, 8, seed + i)]
+        config_params.append({
+            "APP_CODE": f"LOAD{i}",
+            "APP_NAME": f"Load test course {i}",
+            "DOCUMENT_LINK": f"https://example.com/course{i}",
+            "RETRIEVER_DB_PATH": retriever.retriever_db_path,
+            "HYBRID_DB_PATH": retriever.hybrid_db_path,
+            "CHAT_BOT_STARTER_FOLLOW_UP_QUESTIONS": questions[:NUM_STARTER_QUESTIONS],
+            "QUESTIONS": questions[NUM_STARTER_QUESTIONS:],
+        })
+    return config_params
+
+
+def run_user(user, config_param, num_questions, think_time, starter_share, seed, results):
+    """
+    Function to simulate one user asking questions to the chatbot of a course.
+
+    Args:
+    user (int): The number of the user.
+    config_param (dict): The configuration of the course.
+    num_questions (int): The number of questions asked.
+    think_time (float): The mean seconds between two questions.
+    starter_share (float): The share of the questions picked from the starter questions.
+    seed (int): The random seed.
+    results (list): The list the measurements of every question are appended to.
+    """
+    rng = random.Random(seed + user)
+    chatBot.st.session_state.config_param = config_param
+    chatBot.st.session_state.openai_key = st.secrets["OPENAI_KEY"]
+    bot = chatBot.ChatBot()
+
+    # Start the users at different times, as real users would
+    time.sleep(rng.uniform(0, think_time))
+    for _ in range(num_questions):
+        pool = config_param["CHAT_BOT_STARTER_FOLLOW_UP_QUESTIONS"] if rng.random() < starter_share \
+            else config_param["QUESTIONS"]
+        question = rng.choice(pool)
+        started = time.perf_counter()
+        first_token = None
+        error = None
+        try:
+            for _ in bot.stream_response(question):
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+            if bot.last_response is None or not bot.last_response.get("follow_up_questions"):
+                error = "unparsed_response"
+        except Exception as e:
+            error = type(e).__name__
+        results.append({"user": user, "course": config_param["APP_CODE"], "latency": time.perf_counter() - started,
+                        "first_token": first_token, "error": error})
+        time.sleep(rng.expovariate(1 / think_time) if think_time else 0)
+
+
+def run_load_test(work_dir, server_url, num_users=DEFAULT_USERS, num_courses=DEFAULT_COURSES,
+                  num_questions=DEFAULT_QUESTIONS, think_time=DEFAULT_THINK_TIME, num_paragraphs=DEFAULT_PARAGRAPHS,
+                  starter_share=DEFAULT_STARTER_SHARE, seed=DEFAULT_SEED):
+    """
+    Function to run the load test against a mock server.
+
+    The chatbots of the simulated users run the real pipeline, registry, caches, retrieval,
+    rerank, resolution and streamed generation, with every API call going to the mock server.
+
+    Args:
+    work_dir (str): An empty folder for the courses.
+    server_url (str): The URL of the mock server.
+    num_users (int): The number of concurrent users.
+    num_courses (int): The number of courses the users are spread over.
+    num_questions (int): The number of questions of every user.
+    think_time (float): The mean seconds between two questions of a user.
+    num_paragraphs (int): The number of paragraphs of every course.
+    starter_share (float): The share of the questions picked from the starter questions.
+    seed (int): The random seed.
+
+    Returns:
+    dict: The results.
+    """
+    # Every client reads the URL of its API from the environment when it is created
+    os.environ["OPENAI_BASE_URL"] = f"{server_url}/v1"
+    os.environ["CO_API_URL"] = server_url
+    chatBot.st = types.SimpleNamespace(secrets=st.secrets, session_state=_SessionState())
+
+    started = time.perf_counter()
+    config_params = build_courses(work_dir, num_courses, num_paragraphs, seed)
+    build_seconds = time.perf_counter() - started
+
+    # Load the shared retrievers once, which also warms the answers of the starter questions
+    owners = [_CourseOwner() for _ in config_params]
+    for owner, config_param in zip(owners, config_params):
+        get_registry().acquire(config_param, owner=owner)
+
+    results = []
+    threads = [threading.Thread(target=run_user, name=f"user-{user}",
+                                args=(user, config_params[user % num_courses], num_questions, think_time,
+                                      starter_share, seed, results))
+               for user in range(num_users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    errors = {}
+    for result in results:
+        if result["error"]:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    succeeded = [result for result in results if not result["error"]]
+    return {
+        "commit": get_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "config": {"users": num_users, "courses": num_courses, "questions_per_user": num_questions,
+                   "think_time": think_time, "paragraphs": num_paragraphs, "starter_share": starter_share,
+                   "seed": seed},
+        "build_seconds": round(build_seconds, 3),
+        "seconds": round(seconds, 3),
+        "questions": len(results),
+        "errors": errors,
+        "throughput_qps": round(len(succeeded) / seconds, 3) if seconds else None,
+        "latency": percentiles([result["latency"] for result in succeeded]),
+        "first_token": percentiles([result["first_token"] for result in succeeded if result["first_token"] is not None]),
+        "courses": {config_param["APP_CODE"]: percentiles([result["latency"] for result in succeeded
+                                                           if result["course"] == config_param["APP_CODE"]])
+                    for config_param in config_params},
+        "stages": get_metrics().summary(),
+        "answer_cache": {config_param["APP_CODE"]: chatBot.get_answer_cache(config_param["APP_CODE"]).stats()
+                         for config_param in config_params},
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "registry": get_registry().stats(),
+        "scheduler": {name: get_scheduler(name).stats() for name in ("openai", "cohere")},
+    }
+
+
+def main(argv=None):
+    """
+    Function to run the load test from the command line.
+
+    Run it from the repository root with "python -m src.benchmark.loadTest --users 50 --output load.json".
+    Importing the app reads .streamlit/secrets.toml, placeholder keys are enough as every call
+    goes to the mock server, started in its own process unless --server-url is given.
+
+    Args:
+    argv (list): The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Load test the chatbot offline against mock OpenAI and Cohere APIs.")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS, help="Number of concurrent users.")
+    parser.add_argument("--courses", type=int, default=DEFAULT_COURSES, help="Number of courses.")
+    parser.add_argument("--questions", type=int, default=DEFAULT_QUESTIONS, help="Number of questions per user.")
+    parser.add_argument("--think-time", type=float, default=DEFAULT_THINK_TIME,
+                        help="Mean seconds between two questions of a user.")
+    parser.add_argument("--paragraphs", type=int, default=DEFAULT_PARAGRAPHS, help="Number of paragraphs per course.")
+    parser.add_argument("--starter-share", type=float, default=DEFAULT_STARTER_SHARE,
+                        help="Share of the questions picked from the starter questions.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds every mock API request waits.")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Rate of the streamed tokens.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the mock requests failing.")
+    parser.add_argument("--answer-words", type=int, default=120, help="Number of words per answer.")
+    parser.add_argument("--server-url", help="URL of an already running mock server.")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed.")
+    parser.add_argument("--output", help="JSON file to write the results to, defaults to stdout.")
+    args = parser.parse_args(argv)
+
+    process = None
+    server_url = args.server_url
+    if server_url is None:
+        process, server_url = start_mock_server(args.latency, args.tokens_per_second, args.error_rate,
+                                                args.answer_words, args.seed)
+    try:
+        with tempfile.TemporaryDirectory(prefix="load-test-") as work_dir:
+            results = run_load_test(work_dir, server_url, args.users, args.courses, args.questions,
+                                    args.think_time, args.paragraphs, args.starter_share, args.seed)
+    finally:
+        if process is not None:
+            server_stats = stop_mock_server(process)
+    if process is not None:
+        results["server"] = server_stats
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
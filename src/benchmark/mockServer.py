@@ -0,0 +1,280 @@
+# Import the required libraries
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from src.benchmark.fakes import FakeEmbeddings, tokenize
+
+# Defaults of the emulated APIs
+DEFAULT_LATENCY = 0.2
+DEFAULT_TOKENS_PER_SECOND = 50.0
+DEFAULT_ANSWER_WORDS = 120
+DEFAULT_DIMENSION = 256
+
+# Characters per token of the emulated streams
+CHARS_PER_TOKEN = 4
+
+# Question of the ambiguity resolution prompt, echoed back as the resolved question
+_QUESTION = re.compile(r"NOW QUESTION:\s*(.*)")
+
+_FILLER = ("the model uses these inputs to estimate the risk of each position and the expected return "
+           "of the portfolio over the next period given the current market conditions").split()
+
+
+class MockApiServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the OpenAI chat and embedding endpoints and the Cohere rerank endpoint.
+
+    Every request waits for the configured latency, with up to 50% jitter, and streamed chat
+    completions then emit their tokens at the configured rate. A share of the requests can be
+    answered with an error status to exercise the retries of the clients. Embeddings are the
+    deterministic hashed bags of words of FakeEmbeddings, and reranking scores documents by the
+    similarity of their embedding with the query's, so retrieval stays meaningful.
+
+    Attributes:
+    latency (float): The seconds every request waits before answering.
+    tokens_per_second (float): The rate of the streamed tokens.
+    error_rate (float): The share of the requests answered with error_status.
+    error_status (int): The status of the injected errors.
+    answer_words (int): The number of words of the answers.
+    requests (dict): The number of requests by endpoint.
+    errors (int): The number of injected errors.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=DEFAULT_LATENCY, tokens_per_second=DEFAULT_TOKENS_PER_SECOND, error_rate=0.0,
+                 error_status=503, answer_words=DEFAULT_ANSWER_WORDS, dimension=DEFAULT_DIMENSION, seed=0):
+        """
+        The constructor for the MockApiServer class.
+
+        Args:
+        port (int): The port to listen on, 0 for any free port.
+        latency (float): The seconds every request waits before answering.
+        tokens_per_second (float): The rate of the streamed tokens.
+        error_rate (float): The share of the requests answered with error_status.
+        error_status (int): The status of the injected errors.
+        answer_words (int): The number of words of the answers.
+        dimension (int): The size of the embeddings.
+        seed (int): The random seed of the jitter and the injected errors.
+        """
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.answer_words = answer_words
+        self.embeddings = FakeEmbeddings(dimension)
+        self.requests = {}
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def admit(self, endpoint):
+        """
+        Function to count a request, wait for its latency and decide whether it fails.
+
+        Args:
+        endpoint (str): The endpoint of the request.
+
+        Returns:
+        bool: Whether the request is answered with an error.
+        """
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            delay = self.latency * (1 + 0.5 * self._random.random())
+            failed = self._random.random() < self.error_rate
+            self.errors += failed
+        time.sleep(delay)
+        return failed
+
+    def get_answer(self, messages):
+        """
+        Function to make up the answer of a response prompt out of its context.
+
+        Args:
+        messages (list): The messages of the request.
+
+        Returns:
+        str: The answer.
+        """
+        words = tokenize(" ".join([str(message.get("content") or "") for message in messages])) or _FILLER
+        words = [word for word in words if len(word) > 3] or _FILLER
+        rng = random.Random(len(words))
+        return " ".join(rng.choice(words) for _ in range(self.answer_words)).capitalize() + "."
+
+    def stats(self):
+        """
+        Function to get the statistics of the server.
+
+        Returns:
+        dict: The requests by endpoint and the injected errors.
+        """
+        with self._lock:
+            return {"requests": dict(self.requests), "errors": self.errors}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Handler of the requests of MockApiServer.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        routes = {
+            "/v1/chat/completions": self._chat_completions,
+            "/v1/embeddings": self._embeddings,
+            "/v1/rerank": self._rerank,
+        }
+        route = routes.get(self.path.split("?")[0])
+        if route is None:
+            self._send_json(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+            return
+        if self.server.admit(self.path):
+            self._send_json(self.server.error_status, {"error": {"message": "Injected error", "type": "server_error"},
+                                                       "message": "Injected error"})
+            return
+        route(body)
+
+    def _chat_completions(self, body):
+        messages = body.get("messages", [])
+        prompt = str(messages[-1].get("content") or "") if messages else ""
+        question = _QUESTION.search(prompt)
+        tool = (body.get("tools") or [None])[0]
+        if question is not None and "OUTPUT QUESTION" in prompt:
+            # Ambiguity resolution, the question is already standalone
+            content = question.group(1).strip()
+        elif tool is not None or "follow_up_questions" in prompt:
+            content = json.dumps({"answer": self.server.get_answer(messages),
+                                  "follow_up_questions": ["Can you give an example?", "Why does it matter?",
+                                                          "How is it measured?"]})
+        else:
+            content = self.server.get_answer(messages)
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model", "gpt-3.5-turbo")
+        usage = {"prompt_tokens": len(json.dumps(messages)) // CHARS_PER_TOKEN,
+                 "completion_tokens": len(content) // CHARS_PER_TOKEN}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        tool_call = {"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                     "function": {"name": tool["function"]["name"] if tool else "", "arguments": content}}
+
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": None, "tool_calls": [tool_call]} if tool \
+                else {"role": "assistant", "content": content}
+            self._send_json(200, {"id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                                  "model": model, "usage": usage,
+                                  "choices": [{"index": 0, "message": message,
+                                               "finish_reason": "tool_calls" if tool else "stop"}]})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(delta, finish_reason=None):
+            event = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            data = f"data: {json.dumps(event)}\n\n".encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        if tool:
+            send({"role": "assistant", "content": None,
+                  "tool_calls": [{"index": 0, **tool_call, "function": {**tool_call["function"], "arguments": ""}}]})
+        else:
+            send({"role": "assistant", "content": ""})
+        delay = 1 / self.server.tokens_per_second if self.server.tokens_per_second else 0
+        for start in range(0, len(content), CHARS_PER_TOKEN):
+            piece = content[start:start + CHARS_PER_TOKEN]
+            time.sleep(delay)
+            send({"tool_calls": [{"index": 0, "function": {"arguments": piece}}]} if tool else {"content": piece})
+        send({}, "tool_calls" if tool else "stop")
+        data = b"data: [DONE]\n\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n0\r\n\r\n")
+        self.wfile.flush()
+
+    def _embeddings(self, body):
+        inputs = body.get("input", [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        # Token arrays cannot be decoded without the tokenizer, embed their ids as words instead
+        texts = [text if isinstance(text, str) else " ".join(map(str, text)) for text in inputs]
+        vectors = self.server.embeddings.embed_documents(texts)
+        self._send_json(200, {"object": "list", "model": body.get("model", "text-embedding-ada-002"),
+                              "data": [{"object": "embedding", "index": i, "embedding": vector}
+                                       for i, vector in enumerate(vectors)],
+                              "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+    def _rerank(self, body):
+        documents = [document["text"] if isinstance(document, dict) else document for document in body["documents"]]
+        if not documents:
+            self._send_json(200, {"id": uuid.uuid4().hex, "results": [], "meta": {}})
+            return
+        query = np.array(self.server.embeddings.embed_query(body["query"]))
+        scores = np.array(self.server.embeddings.embed_documents(documents)) @ query
+        top_n = body.get("top_n") or len(documents)
+        order = np.argsort(-scores, kind="stable")[:top_n]
+        self._send_json(200, {"id": uuid.uuid4().hex, "meta": {"api_version": {"version": "1"}},
+                              "results": [{"index": int(i), "relevance_score": float((scores[i] + 1) / 2)}
+                                          for i in order]})
+
+
+def main(argv=None):
+    """
+    Function to run the mock server from the command line until it is interrupted.
+
+    Run it from the repository root with "python -m src.benchmark.mockServer --port 8900". The
+    first line printed is the URL of the server, point OPENAI_BASE_URL to it with /v1 appended
+    and CO_API_URL to it as it is.
+
+    Args:
+    argv (list): The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Serve local stand-ins for the OpenAI and Cohere APIs.")
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on, any free port by default.")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY, help="Seconds every request waits.")
+    parser.add_argument("--tokens-per-second", type=float, default=DEFAULT_TOKENS_PER_SECOND,
+                        help="Rate of the streamed tokens, 0 for no delay.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the requests answered with an error.")
+    parser.add_argument("--error-status", type=int, default=503, help="Status of the injected errors.")
+    parser.add_argument("--answer-words", type=int, default=DEFAULT_ANSWER_WORDS, help="Number of words per answer.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the jitter and the injected errors.")
+    args = parser.parse_args(argv)
+
+    server = MockApiServer(args.port, args.latency, args.tokens_per_second, args.error_rate, args.error_status,
+                           args.answer_words, seed=args.seed)
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats()), file=sys.stderr, flush=True)
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# Import the required libraries
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from src.benchmark.fakes import FakeEmbeddings, FakeReranker, tokenize
+from src.common.customHybridRetriever import Retriever, CHUNK_SIZE, CHUNK_OVERLAP
+from src.common.queryCache import MemoizedQueryEmbeddings
+
+# Defaults of the benchmark
+DEFAULT_NUM_PARAGRAPHS = 4000
+DEFAULT_NUM_QUERIES = 200
+DEFAULT_QUERY_WORDS = 8
+DEFAULT_SEED = 13
+
+# Stages measured, in pipeline order
+STAGES = ("bm25", "faiss", "ensemble", "reranked", "reranked_cached")
+
+
+def generate_corpus(path, num_paragraphs=DEFAULT_NUM_PARAGRAPHS, seed=DEFAULT_SEED):
+    """
+    Function to write a synthetic corpus with a Zipf-like word distribution.
+
+    The same seed always gives the same file.
+
+    Args:
+    path (str): The path of the text file.
+    num_paragraphs (int): The number of paragraphs.
+    seed (int): The random seed.
+    """
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ren", "tu", "sa", "vek", "dor", "an", "pli", "zo", "qua", "fe", "nis", "tra"]
+    vocabulary = sorted({"".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))) for _ in range(20000)})
+    rng.shuffle(vocabulary)
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+
+    with open(path, "w", encoding="UTF-8") as f:
+        for _ in range(num_paragraphs):
+            sentences = []
+            for _ in range(rng.randint(2, 8)):
+                words = rng.choices(vocabulary, weights=weights, k=rng.randint(6, 24))
+                sentences.append(" ".join(words).capitalize() + ".")
+            f.write(" ".join(sentences) + "\n\n")
+
+
+def make_queries(docs, num_queries=DEFAULT_NUM_QUERIES, query_words=DEFAULT_QUERY_WORDS, seed=DEFAULT_SEED):
+    """
+    Function to draw known-item queries from the chunks of the index.
+
+    Every query is a run of consecutive words of one chunk, which is the relevant document of the query.
+
+    Args:
+    docs (list): The chunks of the index.
+    num_queries (int): The number of queries.
+    query_words (int): The number of words of every query.
+    seed (int): The random seed.
+
+    Returns:
+    list: The (query, relevant chunk text) pairs.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for doc in rng.sample(docs, min(num_queries, len(docs))):
+        words = tokenize(doc.page_content)
+        start = rng.randint(0, max(len(words) - query_words, 0))
+        queries.append((" ".join(words[start:start + query_words]), doc.page_content))
+    return queries
+
+
+def summarize(latencies, hits, k):
+    """
+    Function to summarize the measurements of a stage.
+
+    Args:
+    latencies (list): The latencies in seconds.
+    hits (list): Whether the relevant chunk was in the top k, per query.
+    k (int): The cut-off of the recall.
+
+    Returns:
+    dict: The latency percentiles in milliseconds and the recall@k.
+    """
+    latencies = np.array(latencies) * 1000
+    return {
+        "queries": len(latencies),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "mean_ms": round(float(latencies.mean()), 3),
+        "k": k,
+        "recall_at_k": round(float(np.mean(hits)), 4),
+    }
+
+
+def get_commit():
+    """
+    Function to get the commit the benchmark runs on.
+
+    Returns:
+    str: The commit hash, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _make_retriever(work_dir, embeddings):
+    """
+    Function to create a retriever over the benchmark folder with the offline stand-ins.
+
+    Args:
+    work_dir (str): The folder holding the index and the embedding cache.
+    embeddings (FakeEmbeddings): The embeddings.
+
+    Returns:
+    Retriever: The retriever, not loaded yet.
+    """
+    retriever = Retriever(work_dir, os.path.join(work_dir, "hybrid_db"))
+    retriever.embeddings = embeddings
+    retriever.query_embeddings = MemoizedQueryEmbeddings(embeddings)
+    retriever.re_ranker = FakeReranker()
+    retriever.embedding_cache_path = os.path.join(work_dir, "embedding_cache.sqlite")
+    return retriever
+
+
+def run_benchmark(corpus_path, work_dir, num_queries=DEFAULT_NUM_QUERIES, query_words=DEFAULT_QUERY_WORDS,
+                  seed=DEFAULT_SEED):
+    """
+    Function to run the benchmark.
+
+    Args:
+    corpus_path (str): The text or PDF file to index.
+    work_dir (str): An empty folder for the index and the embedding cache.
+    num_queries (int): The number of queries.
+    query_words (int): The number of words of every query.
+    seed (int): The random seed of the queries.
+
+    Returns:
+    dict: The results.
+    """
+    embeddings = FakeEmbeddings()
+
+    # Build the index, with a cold embedding cache
+    retriever = _make_retriever(work_dir, embeddings)
+    started = time.perf_counter()
+    retriever.create_vector_store(corpus_path)
+    build_seconds = time.perf_counter() - started
+    docs = list(retriever.index_bundle.iter_documents())
+    queries = make_queries(docs, num_queries, query_words, seed)
+
+    # Load the index in a fresh retriever, the first query maps the files and builds the BM25 weights
+    retriever = _make_retriever(work_dir, embeddings)
+    tracemalloc.start()
+    started = time.perf_counter()
+    retriever._load_params()
+    load_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    retriever._retrieve_with_rerank(queries[0][0])
+    first_query_seconds = time.perf_counter() - started
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    bm25_retriever = retriever.bm25_retriever
+    faiss_retriever = retriever.ensemble_retriever.retrievers[1]
+    k = bm25_retriever.k
+
+    def reranked(query):
+        # Time the whole pipeline, not the caches of the previous stages
+        retriever.query_cache.clear()
+        retriever.query_embeddings.clear()
+        return retriever._retrieve_with_rerank(query)
+
+    def uncached(leg):
+        def invoke(query):
+            retriever.query_embeddings.clear()
+            return leg.invoke(query)
+        return invoke
+
+    stage_functions = {
+        "bm25": bm25_retriever.invoke,
+        "faiss": uncached(faiss_retriever),
+        "ensemble": uncached(retriever.ensemble_retriever),
+        "reranked": reranked,
+        "reranked_cached": retriever._retrieve_with_rerank,
+    }
+
+    stages = {}
+    for stage in STAGES:
+        function = stage_functions[stage]
+        if stage == "reranked_cached":
+            # Answer every query once, then time the cache hits
+            for query, _ in queries:
+                retriever._retrieve_with_rerank(query)
+        latencies, hits = [], []
+        for query, relevant in queries:
+            started = time.perf_counter()
+            result = function(query)
+            latencies.append(time.perf_counter() - started)
+            hits.append(any(doc.page_content == relevant for doc in result[:k]))
+        stages[stage] = summarize(latencies, hits, k)
+
+    return {
+        "commit": get_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "config": {
+            "corpus": os.path.abspath(corpus_path),
+            "corpus_bytes": os.path.getsize(corpus_path),
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+            "embedding_model": embeddings.model,
+            "num_queries": len(queries),
+            "query_words": query_words,
+            "seed": seed,
+        },
+        "build": {
+            "seconds": round(build_seconds, 4),
+            "documents": len(retriever.index_bundle),
+        },
+        "load": {
+            "seconds": round(load_seconds, 4),
+            "first_query_seconds": round(first_query_seconds, 4),
+            "index_bytes": retriever.index_bundle.nbytes,
+            "traced_peak_bytes": traced_peak,
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        },
+        "stages": stages,
+    }
+
+
+def main(argv=None):
+    """
+    Function to run the benchmark from the command line.
+
+    Run it from the repository root with "python -m src.benchmark.retrievalBenchmark --output benchmark.json".
+    Importing the retriever reads .streamlit/secrets.toml, placeholder keys are enough as no API is called.
+
+    Args:
+    argv (list): The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the latency and recall of the course retriever offline.")
+    parser.add_argument("--corpus", help="Text or PDF file to index, defaults to a generated synthetic corpus.")
+    parser.add_argument("--paragraphs", type=int, default=DEFAULT_NUM_PARAGRAPHS,
+                        help="Number of paragraphs of the generated corpus.")
+    parser.add_argument("--queries", type=int, default=DEFAULT_NUM_QUERIES, help="Number of queries.")
+    parser.add_argument("--query-words", type=int, default=DEFAULT_QUERY_WORDS, help="Number of words per query.")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed of the corpus and the queries.")
+    parser.add_argument("--output", help="JSON file to write the results to, defaults to stdout.")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="retrieval-benchmark-") as work_dir:
+        corpus_path = args.corpus
+        if corpus_path is None:
+            corpus_path = os.path.join(work_dir, "corpus.txt")
+            generate_corpus(corpus_path, args.paragraphs, args.seed)
+        results = run_benchmark(corpus_path, os.path.join(work_dir, "index"), args.queries, args.query_words,
+                                args.seed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
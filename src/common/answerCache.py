@@ -0,0 +1,220 @@
+# Import the required libraries
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from src.common.queryCache import normalize_query
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Number of answers kept per course
+DEFAULT_MAX_ENTRIES = 256
+
+# Thread pool precomputing the answers of the starter questions of every course
+_executor = ThreadPoolExecutor(max_workers=st.secrets.get("ANSWER_CACHE_WARM_THREADS", 2),
+                               thread_name_prefix="answer-cache")
+
+
+class AnswerCache:
+    """
+    Cache of the answers of one course shared by all the sessions.
+
+    It holds the answers of the starter questions of the course, precomputed with warm and served
+    to the sessions asking them without any chat history. Only the questions passed to warm are
+    cached, any other question may carry what a user typed and is never shared. The least
+    recently used answers are evicted beyond max_entries. The whole cache is tied to a version,
+    made of the prompts, index and model the answers come from, and is cleared when it changes.
+
+    Attributes:
+    max_entries (int): The maximum number of cached answers.
+    hits (int): The number of questions served from the cache.
+    misses (int): The number of questions not in the cache.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        The constructor for the AnswerCache class.
+
+        Args:
+        max_entries (int): The maximum number of cached answers.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._questions = frozenset()
+        self._warming = None
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        """
+        Function to clear the cache when the answers it holds are outdated, called with the lock held.
+
+        Args:
+        version (tuple): The version of the answers.
+        """
+        if version != self._version:
+            if self._entries:
+                logger.info("Prompts or course index changed, clearing the answer cache")
+            self._entries.clear()
+            self._version = version
+
+    def is_cacheable(self, question):
+        """
+        Function to check whether the answer of a question may be shared, i.e. it is a starter question.
+
+        Args:
+        question (str): The question.
+
+        Returns:
+        bool: True when the question was passed to warm.
+        """
+        return normalize_query(question) in self._questions
+
+    def get(self, question, version):
+        """
+        Function to look up the cached answer of a question.
+
+        Args:
+        question (str): The question.
+        version (tuple): The version of the answers.
+
+        Returns:
+        dict: The cached response, or None on a miss.
+        """
+        key = normalize_query(question)
+        if key not in self._questions:
+            return None
+        with self._lock:
+            self._check_version(version)
+            response = self._entries.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        logger.info(f"Answer cache hit for the question {question}, hit rate {self.stats()['hit_rate']:.2f}")
+        return response
+
+    def put(self, question, version, response):
+        """
+        Function to cache the answer of a question, ignored unless it is a starter question.
+
+        Args:
+        question (str): The question.
+        version (tuple): The version of the answers the response comes from.
+        response (dict): The response.
+        """
+        key = normalize_query(question)
+        if key not in self._questions:
+            return
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def warm(self, questions, version, answer):
+        """
+        Function to precompute the answers of some questions in the background.
+
+        The questions become the only ones whose answers are cached. Nothing is computed when they
+        are already being warmed or were warmed for this version.
+
+        Args:
+        questions (list): The questions.
+        version (tuple): The version of the answers.
+        answer (callable): Function returning the response to a question, run off the script thread.
+        """
+        with self._lock:
+            self._questions = frozenset(normalize_query(question) for question in questions)
+            if not questions or self._warming == version:
+                return
+            self._warming = version
+        try:
+            _executor.submit(self._warm, list(questions), version, answer)
+        except Exception:
+            self._end_warming(version)
+            raise
+
+    def _end_warming(self, version):
+        """
+        Function to let a failed warm of a version be retried by the next call to warm.
+
+        Args:
+        version (tuple): The version of the answers.
+        """
+        with self._lock:
+            if self._warming == version:
+                self._warming = None
+
+    def _warm(self, questions, version, answer):
+        """
+        Function to precompute the answers of some questions, run on the warming pool.
+
+        When some answers could not be computed the warm is retried on the next call to warm.
+
+        Args:
+        questions (list): The questions.
+        version (tuple): The version of the answers.
+        answer (callable): Function returning the response to a question.
+        """
+        failed = 0
+        for question in questions:
+            with self._lock:
+                if self._warming != version or normalize_query(question) in self._entries:
+                    continue
+            try:
+                response = answer(question)
+            except Exception as e:
+                logger.warning(f"Could not precompute the answer of the question {question}: {e}")
+                failed += 1
+                continue
+            if response is None:
+                failed += 1
+                continue
+            self.put(question, version, response)
+        if failed:
+            logger.warning(f"Answer cache warm failed for {failed} of {len(questions)} questions, it will be retried")
+            self._end_warming(version)
+        else:
+            logger.info(f"Answer cache warmed with {len(questions)} questions")
+
+    def stats(self):
+        """
+        Function to get the statistics of the cache.
+
+        Returns:
+        dict: The entries, hits, misses and hit rate.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+_answer_caches = {}
+_answer_caches_lock = threading.Lock()
+
+
+def get_answer_cache(code):
+    """
+    Function to get the process-wide answer cache of a course.
+
+    Args:
+    code (str): The course code.
+
+    Returns:
+    AnswerCache: The cache.
+    """
+    with _answer_caches_lock:
+        if code not in _answer_caches:
+            _answer_caches[code] = AnswerCache(st.secrets.get("ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+        return _answer_caches[code]
@@ -0,0 +1,199 @@
+# Import the required libraries
+import re
+import json
+
+# Escapes of a JSON string, besides \uXXXX
+JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+# Character standing in for a surrogate escape without its pair
+REPLACEMENT_CHARACTER = "\ufffd"
+
+# Unicode escape with its four hex digits
+_UNICODE_ESCAPE = re.compile(r"\\u[0-9a-fA-F]{4}")
+
+# Unicode escape cut before its four hex digits
+_PARTIAL_UNICODE_ESCAPE = re.compile(r"\\u[0-9a-fA-F]{0,3}$")
+
+
+def repair_json(text):
+    """
+    Function to parse the JSON object of a model output, repairing it when it is cut short or sloppy.
+
+    Text around the object, e.g. a markdown code fence, is ignored and trailing commas are
+    dropped. When the output stops mid-object the open string is closed, along with every
+    open array and object. If that is still not valid JSON the output is cut back to the last
+    complete value, so a truncated response keeps everything it finished.
+
+    Args:
+    text (str): The model output.
+
+    Returns:
+    dict: The parsed object, None when no object can be recovered.
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+
+    out = []
+    closers = []
+    # Positions the output can be cut back to, with the closers open there
+    cuts = []
+    in_string = False
+    escaped = False
+    for char in text[start:]:
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char in "}]":
+            if not closers or closers[-1] != char:
+                break
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            closers.pop()
+            out.append(char)
+            if not closers:
+                break
+            continue
+        if char == ",":
+            cuts.append((len(out), list(closers)))
+        out.append(char)
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+            cuts.append((len(out), list(closers)))
+
+    repaired = "".join(out)
+    if in_string:
+        # Drop an escape cut in the middle before closing the string
+        if escaped:
+            repaired = repaired[:-1]
+        repaired = _PARTIAL_UNICODE_ESCAPE.sub("", repaired) + '"'
+
+    candidates = [(repaired, closers)] + [(repaired[:position], open_closers) for position, open_closers in reversed(cuts)]
+    for candidate, open_closers in candidates:
+        candidate = candidate.rstrip()
+        if candidate.endswith(","):
+            candidate = candidate[:-1]
+        try:
+            output = json.loads(candidate + "".join(reversed(open_closers)))
+        except ValueError:
+            continue
+        if isinstance(output, dict):
+            return output
+    return None
+
+
+class JsonFieldStream:
+    """
+    Incremental decoder of one string field of a JSON object streamed by a model.
+
+    The model output is fed chunk by chunk as it arrives. Everything before the field is
+    skipped, the value of the field is decoded as soon as its characters arrive, and
+    everything after its closing quote is ignored, so the field can be shown while the
+    rest of the object is still being generated.
+
+    Attributes:
+    field (str): The name of the field.
+    started (bool): Whether the value of the field started.
+    done (bool): Whether the closing quote of the value was seen.
+    text (str): The decoded value so far.
+    """
+    def __init__(self, field):
+        """
+        The constructor for the JsonFieldStream class.
+
+        Args:
+        field (str): The name of the field.
+        """
+        self.field = field
+        self.started = False
+        self.done = False
+        self.text = ""
+        self._start = re.compile(r'"' + re.escape(field) + r'"\s*:\s*"')
+        self._buffer = ""
+
+    def feed(self, chunk):
+        """
+        Function to feed the next chunk of the model output.
+
+        Args:
+        chunk (str): The chunk.
+
+        Returns:
+        str: The newly decoded characters of the value, possibly empty.
+        """
+        if self.done:
+            return ""
+        self._buffer += chunk
+
+        if not self.started:
+            match = self._start.search(self._buffer)
+            if match is None:
+                # Keep just enough to find the key when it is split across chunks
+                self._buffer = self._buffer[-(len(self.field) + 64):]
+                return ""
+            self.started = True
+            self._buffer = self._buffer[match.end():]
+
+        decoded = []
+        i = 0
+        buffer = self._buffer
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self.done = True
+                i = len(buffer)
+                break
+            if char != "\\":
+                decoded.append(char)
+                i += 1
+                continue
+
+            # Wait for the rest of an escape split across chunks
+            if i + 1 >= len(buffer):
+                break
+            escape = buffer[i + 1]
+            if escape != "u":
+                decoded.append(JSON_ESCAPES.get(escape, escape))
+                i += 2
+                continue
+            if i + 6 > len(buffer):
+                break
+            try:
+                code = int(buffer[i + 2:i + 6], 16)
+            except ValueError:
+                # Not a valid escape, keep it as it is
+                decoded.append(buffer[i:i + 6])
+                i += 6
+                continue
+            if 0xD800 <= code < 0xDC00:
+                # High surrogate, decode it together with the low one that should follow
+                following = buffer[i + 6:i + 12]
+                if "\\u".startswith(following[:2]) and len(following) < 6:
+                    break
+                low = int(following[2:], 16) if _UNICODE_ESCAPE.fullmatch(following) else None
+                if low is not None and 0xDC00 <= low < 0xE000:
+                    decoded.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                    i += 12
+                    continue
+                decoded.append(REPLACEMENT_CHARACTER)
+            elif 0xDC00 <= code < 0xE000:
+                # Low surrogate without a high one before it
+                decoded.append(REPLACEMENT_CHARACTER)
+            else:
+                decoded.append(chr(code))
+            i += 6
+
+        self._buffer = buffer[i:]
+        text = "".join(decoded)
+        self.text += text
+        return text
@@ -1,20 +1,236 @@
 # Import the required libraries
-import random
-import time
 import ast
 import json
+import uuid
+import asyncio
+import functools
+import threading
+import contextvars
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from langchain.prompts import PromptTemplate, ChatPromptTemplate, HumanMessagePromptTemplate
 from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_openai import OpenAIEmbeddings
-from src.common.customHybridRetriever import Retriever
+from src.common.retrieverRegistry import get_registry
+from src.common.federatedSearch import FederatedRetriever
+from src.common.answerStream import JsonFieldStream, repair_json
+from src.common.promptRegistry import get_prompt_registry
+from src.common.chatMemory import ChatMemory
+from src.common.answerCache import get_answer_cache
+from src.common.chatRuntime import get_chat_model, get_embeddings, run_sync, iterate_sync
+from src.common.contextAssembler import count_tokens
+from src.common.metrics import Trace, span
+from src.common.rateLimiter import set_request_class, INTERACTIVE
+from src.common.queryCache import normalize_query
 from src.common.logger import Logger
 
 # Create the logger object
 logger = Logger.get_logger()
 
+# Retrieve the context while the question is resolved, and keep it when the resolved question
+# is at least this similar to the raw one
+SPECULATIVE_RETRIEVAL = st.secrets.get("SPECULATIVE_RETRIEVAL", True)
+SPECULATION_SIMILARITY_THRESHOLD = st.secrets.get("SPECULATION_SIMILARITY_THRESHOLD", 0.8)
+
+# Thread pool running the blocking retrievals, search and rerank, of every session in the process
+_executor = ThreadPoolExecutor(max_workers=st.secrets.get("CHAT_RETRIEVAL_THREADS", 8),
+                               thread_name_prefix="chat-retrieval")
+
+
+def get_question_similarity(question, other):
+    """
+    Function to compare two questions by their words.
+
+    Args:
+    question (str): The first question.
+    other (str): The second question.
+
+    Returns:
+    float: The Jaccard similarity of their normalized words, 1 for identical questions.
+    """
+    words, other_words = set(normalize_query(question).split()), set(normalize_query(other).split())
+    union = words | other_words
+    return len(words & other_words) / len(union) if union else 1.0
+
+
+# Schema of the JSON response of the chatbot
+RESPONSE_SCHEMAS = [
+    ResponseSchema(name="answer", description="Your answer to the given question in markdown format", type = 'markdown'),
+    ResponseSchema(name="follow_up_questions", description="A list of 3 follow-up questions that the user may have based on the question.", type = 'list')
+]
+
+# Function the model is made to call with the response, so that the provider enforces its schema
+RESPONSE_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "answer_question",
+        "description": "Return the answer to the question and the follow-up questions.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "answer": {"type": "string", "description": RESPONSE_SCHEMAS[0].description},
+                "follow_up_questions": {"type": "array", "items": {"type": "string"},
+                                        "description": RESPONSE_SCHEMAS[1].description},
+            },
+            "required": ["answer", "follow_up_questions"],
+        },
+    },
+}
+
+# Whether the response is requested through function calling, turn off for models without it
+STRUCTURED_OUTPUT = st.secrets.get("STRUCTURED_OUTPUT", True)
+
+# Whether the answers of the questions asked without history are shared by the sessions of a course
+ANSWER_CACHE = st.secrets.get("ANSWER_CACHE", True)
+
+
+def get_response_model(chat_model):
+    """
+    Function to get the model returning the chatbot response.
+
+    Args:
+    chat_model (ChatOpenAI): The chat model.
+
+    Returns:
+    Runnable: The chat model made to call RESPONSE_TOOL, the chat model itself without STRUCTURED_OUTPUT.
+    """
+    if not STRUCTURED_OUTPUT:
+        return chat_model
+    return chat_model.bind_tools([RESPONSE_TOOL], tool_choice=RESPONSE_TOOL["function"]["name"])
+
+
+def get_message_text(chunk):
+    """
+    Function to get the text of a streamed message chunk, the arguments of its function call if any.
+
+    Args:
+    chunk (AIMessageChunk): The chunk.
+
+    Returns:
+    str: The text of the chunk.
+    """
+    tool_calls = chunk.additional_kwargs.get("tool_calls") or []
+    arguments = "".join([(tool_call.get("function") or {}).get("arguments") or "" for tool_call in tool_calls])
+    return arguments + chunk.content
+
+
+def parse_response(content, answer):
+    """
+    Function to parse the JSON response of the model.
+
+    Args:
+    content (str): The response of the model.
+    answer (JsonFieldStream): The answer streamed out of the response.
+
+    Returns:
+    dict: The answer and the follow-up questions, None when no answer can be recovered.
+    """
+    try:
+        output = json.loads(content)
+    except ValueError:
+        logger.warning(f"Repairing the response: {content}")
+        output = repair_json(content)
+    if not isinstance(output, dict):
+        output = {}
+
+    text = output.get("answer")
+    if not isinstance(text, str) or not text:
+        # Fall back to what was streamed, e.g. when the answer was cut short in an invalid object
+        text = answer.text
+    if not text:
+        return None
+
+    follow_up_questions = output.get("follow_up_questions")
+    if isinstance(follow_up_questions, str):
+        follow_up_questions = [follow_up_questions]
+    if not isinstance(follow_up_questions, list):
+        follow_up_questions = []
+    return {'answer': text,
+            'follow_up_questions': [question for question in follow_up_questions if isinstance(question, str)]}
+
+def get_response_messages(question, context, history, document_link):
+    """
+    Function to build the messages asking for the response to a question.
+
+    The JSON format instructions are only given to models answering in plain text, without STRUCTURED_OUTPUT.
+
+    Args:
+    question (str): The resolved question.
+    context (str): The context of the question.
+    history (str): The history of the conversation.
+    document_link (str): The document link of the course.
+
+    Returns:
+    list: The messages.
+    """
+    prompt_registry = get_prompt_registry()
+    if STRUCTURED_OUTPUT:
+        # The schema comes with RESPONSE_TOOL, JSON instructions would contradict the forced function call
+        format_instructions = f"Return them by calling the {RESPONSE_TOOL['function']['name']} function."
+    else:
+        _, format_instructions = prompt_registry.get_output_parser(RESPONSE_SCHEMAS)
+        format_instructions += "\n\nDONT FORGET TO PUT COMMA(,) between the keys in JSON output"
+    prompt = prompt_registry.get_chat_prompt(
+        "RESPONSE_PROMPT", ["history", "context", "question"],
+        suffix=document_link + ".'",
+        partial_variables={"format_instructions": format_instructions}
+    )
+    return prompt.format_prompt(history=history, context=context, question=question).to_messages()
+
+
+def get_answer_version(retriever):
+    """
+    Function to get the version of the answers of a course, which changes with the prompts, index or model.
+
+    Args:
+    retriever (Retriever): The retriever of the course.
+
+    Returns:
+    tuple: The version.
+    """
+    return (get_prompt_registry().get_version(), retriever.index_bundle.build_id, st.secrets["OPENAI_MODEL"])
+
+
+def answer_starter_question(config_param, retriever, question):
+    """
+    Function to answer a question without history with the house key, off the script thread.
+
+    Args:
+    config_param (dict): The configuration of the course.
+    retriever (Retriever): The retriever of the course.
+    question (str): The question.
+
+    Returns:
+    dict: The response, None when no answer could be recovered.
+    """
+    chat_model = get_chat_model(st.secrets["OPENAI_KEY"], st.secrets["OPENAI_MODEL"])
+    messages = get_response_messages(question, retriever.parse_response_with_rerank(question), "",
+                                     config_param["DOCUMENT_LINK"])
+    return parse_response(get_message_text(get_response_model(chat_model).invoke(messages)), JsonFieldStream("answer"))
+
+
+def warm_answer_cache(config_param, retriever):
+    """
+    Function to precompute the answers of the starter questions of a course, e.g. when its index is loaded.
+
+    Courses searching FEDERATED_COURSES are not cached, their answers depend on several indexes.
+
+    Args:
+    config_param (dict): The configuration of the course.
+    retriever (Retriever): The retriever of the course.
+    """
+    if not ANSWER_CACHE or config_param.get("FEDERATED_COURSES") or "APP_CODE" not in config_param:
+        return
+    get_answer_cache(config_param["APP_CODE"]).warm(
+        config_param.get("CHAT_BOT_STARTER_FOLLOW_UP_QUESTIONS") or [], get_answer_version(retriever),
+        lambda question: answer_starter_question(config_param, retriever, question))
+
+
+# Warm the starter questions every time a course index is loaded or reloaded after a rebuild
+get_registry().add_load_listener(warm_answer_cache)
+
+
 class ChatBot:
     """
     Class to handle the chatbot functionality.
@@ -23,8 +239,13 @@ class ChatBot:
     OPENAI_KEY (str): The OpenAI key.
     OPENAI_MODEL (str): The OpenAI model.
     embeddings (OpenAIEmbeddings): The OpenAI embeddings.
-    chat_model (ChatOpenAI): The OpenAI chat model.
-    chat_history (str): The chat history.
+    chat_model (ChatOpenAI): The OpenAI chat model, shared by the sessions using the same key.
+    response_model (Runnable): The chat model made to return the response through RESPONSE_TOOL.
+    chat_memory (ChatMemory): The bounded memory of the conversation.
+    last_response (dict): The parsed response to the last question, with its follow-up questions.
+    federated_retriever (FederatedRetriever): The retriever over the course and its FEDERATED_COURSES, if any.
+    answer_cache (AnswerCache): The answers of the starter questions shared by the sessions of the course, None when they are not cached.
+    session_id (str): The identifier of the session, its requests with the house key are queued fairly with the others.
     """
     def __init__(self):
         """
@@ -34,12 +255,63 @@ class ChatBot:
             OPENAI_KEY = st.secrets["OPENAI_KEY"]
             st.session_state.openai_key = OPENAI_KEY
         self.OPENAI_MODEL =  st.secrets["OPENAI_MODEL"]
-        self.embeddings = OpenAIEmbeddings(api_key=st.session_state.openai_key)
-        self.chat_model = ChatOpenAI(temperature=0, model_name=self.OPENAI_MODEL, openai_api_key=st.session_state.openai_key)
-        self.chat_history = ""
-        st.session_state.retriever = Retriever()
-        st.session_state.retriever._load_params()
+        self.session_id = uuid.uuid4().hex
+        self.embeddings = get_embeddings(st.session_state.openai_key)
+        self.set_openai_key(st.session_state.openai_key)
+        self.chat_memory = ChatMemory(
+            self.OPENAI_MODEL,
+            max_turns=st.secrets.get("CHAT_MEMORY_TURNS", 3),
+            max_tokens=st.secrets.get("CHAT_MEMORY_MAX_TOKENS", 1500),
+            max_answer_tokens=st.secrets.get("CHAT_MEMORY_ANSWER_TOKENS", 300),
+            max_summary_tokens=st.secrets.get("CHAT_MEMORY_SUMMARY_TOKENS", 200),
+            summarize=self.summarize_history if st.secrets.get("CHAT_MEMORY_SUMMARIZE", False) else None
+        )
+        self.last_response = None
+        st.session_state.retriever = get_registry().acquire(st.session_state.config_param, owner=self)
+
+        # Search the related courses too when the course lists some in FEDERATED_COURSES
+        self.federated_retriever = None
+        federated_courses = st.session_state.config_param.get("FEDERATED_COURSES")
+        if federated_courses:
+            codes = [st.session_state.config_param["APP_CODE"]] + list(federated_courses)
+            # The course configurations are loaded by the page, read them only when they are missing
+            config_list = st.session_state.get("config_list")
+            if config_list is None:
+                with open("data/config_list.json", "r") as config_file:
+                    config_list = json.load(config_file)
+            self.federated_retriever = FederatedRetriever.from_codes(
+                config_list, codes,
+                normalization=st.secrets.get("FEDERATED_SCORE_NORMALIZATION", "minmax"))
+
+        # Share the answers of the starter questions asked without history, warming them if the prompts changed
+        self.answer_cache = None
+        if ANSWER_CACHE and self.federated_retriever is None:
+            self.answer_cache = get_answer_cache(st.session_state.config_param["APP_CODE"])
+            warm_answer_cache(st.session_state.config_param, st.session_state.retriever)
     
+    def set_openai_key(self, openai_key):
+        """
+        Function to switch the chat models to an OpenAI key.
+
+        Args:
+        openai_key (str): The OpenAI key.
+        """
+        self.chat_model = get_chat_model(openai_key, self.OPENAI_MODEL)
+        self.response_model = get_response_model(self.chat_model)
+
+    def _get_context_retriever(self):
+        """
+        Function to get the retriever building the context of the questions.
+
+        Returns:
+        Retriever: The course retriever, or the federated retriever when the course has one.
+        """
+        if "retriever" not in st.session_state:
+            st.session_state.retriever = get_registry().acquire(st.session_state.config_param, owner=self)
+        if self.federated_retriever is not None:
+            return self.federated_retriever
+        return st.session_state.retriever
+
     def get_question_context(self, question):
         """
         Function to get the context for the given question.
@@ -47,14 +319,71 @@ class ChatBot:
         Args:
         question (str): The question.
         
+        Returns:
+        str: The context for the question.
+        """
+        return run_sync(self.aget_question_context(question, self._get_context_retriever()))
+
+    async def aget_question_context(self, question, retriever, cancelled=None):
+        """
+        Function to get the context for the given question, searching and reranking on the retrieval pool.
+
+        Args:
+        question (str): The question.
+        retriever (Retriever): The retriever building the context.
+        cancelled (threading.Event): Set when the context is no longer needed, the retrieval thread
+            then stops before its next stage.
+
         Returns:
         str: The context for the question.
         """
         logger.info(f"Getting the context for the question: {question}")
-        if "retriever" not in st.session_state:
-            st.session_state.retriever = Retriever()
-            st.session_state.retriever._load_params()
-        return st.session_state.retriever.parse_response_with_rerank(question)
+        # The retrieval threads record their stages in the trace of the question
+        context = contextvars.copy_context()
+        with span("retrieval"):
+            return await asyncio.get_running_loop().run_in_executor(
+                _executor, context.run,
+                functools.partial(retriever.parse_response_with_rerank, question, cancelled=cancelled))
+
+    async def aresolve_question_and_context(self, question, retriever):
+        """
+        Function to resolve the question and get its context, overlapping the two when possible.
+
+        Without a chat history there is nothing to resolve against, so the resolution is skipped.
+        Otherwise the context of the raw question is retrieved while the question is resolved, and
+        kept when the resolved question is the same or close enough. It is only retrieved again
+        for the resolved question when that one changed materially.
+
+        Args:
+        question (str): The question.
+        retriever (Retriever): The retriever building the context.
+
+        Returns:
+        tuple: The resolved question and its context.
+        """
+        if not len(self.chat_memory):
+            return question, await self.aget_question_context(question, retriever)
+        if not SPECULATIVE_RETRIEVAL:
+            question = await self.aresolve_question(question)
+            return question, await self.aget_question_context(question, retriever)
+
+        # Retrieve with the raw question while it is resolved. Cancelling the task does not stop the
+        # retrieval thread, the event does, before the search and the paid rerank
+        cancelled = threading.Event()
+        speculative_context = asyncio.ensure_future(self.aget_question_context(question, retriever, cancelled))
+        resolved_question = await self.aresolve_question(question)
+
+        if get_question_similarity(question, resolved_question) >= SPECULATION_SIMILARITY_THRESHOLD:
+            try:
+                context = await speculative_context
+                logger.info(f"Kept the context of the question {question} for {resolved_question}")
+                return resolved_question, context
+            except Exception as e:
+                logger.warning(f"Speculative retrieval failed for the question {question}: {e}")
+        else:
+            cancelled.set()
+            speculative_context.cancel()
+        return resolved_question, await self.aget_question_context(resolved_question, retriever)
     
     def resolve_question(self, question):
         """
@@ -63,27 +392,48 @@ class ChatBot:
         Args:
         question (str): The question.
 
+        Returns:
+        str: The resolved question.
+        """
+        return run_sync(self.aresolve_question(question))
+
+    async def aresolve_question(self, question):
+        """
+        Function to resolve the question using the ambiguity resolution prompt, on the shared event loop.
+
+        Args:
+        question (str): The question.
+
         Returns:
         str: The resolved question.
         """
         logger.info(f"Resolving the ambiguity for the question: {question}")
-        # Create the language model
-        llm = ChatOpenAI(model=self.OPENAI_MODEL, temperature=0, api_key=st.session_state.openai_key)
-    
-        # Load the ambiguity resolution prompt
-        ambiguity_resolution_prompt = json.load(open("data/prompts.json", "r"))["AMBIGUITY_RESOLUTION_PROMPT"]
-        prompt = PromptTemplate(
-            template=ambiguity_resolution_prompt,
-            input_variables=["history", "question"]
-        )
+        # Get the ambiguity resolution prompt
+        prompt = get_prompt_registry().get_prompt("AMBIGUITY_RESOLUTION_PROMPT", ["history", "question"])
         
         # Format the prompt
-        _input = prompt.format_prompt(history=self.chat_history.split("\nUser:")[-3:], question=question)
+        _input = prompt.format_prompt(history=self.chat_memory.get_history(), question=question)
 
         # Get the response
-        output = llm(_input.to_messages())
+        with span("resolve"):
+            output = await self.chat_model.ainvoke(_input.to_messages())
         return output.content
 
+    def summarize_history(self, summary, turns):
+        """
+        Function to fold older turns of the conversation into its summary, run off the script thread.
+
+        Args:
+        summary (str): The current summary.
+        turns (str): The turns to add to it.
+
+        Returns:
+        str: The updated summary.
+        """
+        prompt = get_prompt_registry().get_prompt("HISTORY_SUMMARY_PROMPT", ["summary", "turns"])
+        _input = prompt.format_prompt(summary=summary or "None", turns=turns)
+        return self.chat_model.invoke(_input.to_messages()).content
+
     def get_response(self, question):
         """
         Function to get the response to the given question.
@@ -94,86 +444,118 @@ class ChatBot:
         Returns:
         dict: The response to the question.
         """
-        logger.info(f"Getting the response for the question: {question}")
-        # Resolve the question
-        question = self.resolve_question(question)
-
-        # Create the output parser
-        response_schemas = [
-                ResponseSchema(name="answer", description="Your answer to the given question in markdown format", type = 'markdown'),
-                ResponseSchema(name="follow_up_questions", description="A list of 3 follow-up questions that the user may have based on the question.", type = 'list')
-            ]
-        output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-        format_instructions = output_parser.get_format_instructions()
-
-        # Get the context
-        context = self.get_question_context(question)
-        logger.info(f"Context for the question {question}: {context}")
-        # Get the response prompt
-        response_prompt = json.load(open("data/prompts.json", "r"))["RESPONSE_PROMPT"]
-
-
-   
-        # Create the prompt
-        prompt = ChatPromptTemplate(
-            messages=[
-                HumanMessagePromptTemplate.from_template(response_prompt + st.session_state.config_param["DOCUMENT_LINK"] + ".'")
-            ],
-            input_variables=["history", "context", "question"],
-            partial_variables={"format_instructions": format_instructions}
-        )
+        for _ in self.stream_response(question):
+            pass
+        return self.last_response
 
-        # Format the prompt
-        _input = prompt.format_prompt(history=self.chat_history.split("\nUser:")[-3:], context=context, question=question)
+    def stream_response(self, question):
+        """
+        Function to stream the answer to the given question as the model generates it.
 
-        # Get the response
-        output = self.chat_model(_input.to_messages())
-        
-        valid_json = False
-        runs = 0
-        while (valid_json == False):
-            try:
-                # Parse the output
-                json_output = output_parser.parse(output.content)
-                valid_json = True
-                logger.info(f"Response for the question {question}: {output.content}")
+        The pipeline runs on the shared event loop, this generator only relays its output.
+        The session state is read here, on the script thread, since the loop cannot access it.
 
-                # Update the chat history
-                self.chat_history += f"""\n
-                User: {question}
-                You: {str(json_output['answer'])}"""
+        Args:
+        question (str): The question.
 
-            except Exception as e:
-                # If the output is not in JSON format, regenerate the answer for 5 runs
-                logger.warning(f"Error in parsing the response for the question {question}: {e}")
-                runs+=1
-                if runs < 4:
-
-                    # Load the error prompt
-                    retry_prompt = json.load(open("data/prompts.json", "r"))["RETRY_PROMPT"]
-                    error_prompt = ChatPromptTemplate(
-                        messages=[
-                                HumanMessagePromptTemplate.from_template(retry_prompt)
-                                ],
-                        input_variables=["e","history","context","question"],
-                        partial_variables={"format_instructions": format_instructions}
-                    )
-
-                    # Format the error prompt
-                    _error_input = error_prompt.format_prompt(e=e, history=self.chat_history.split("\nUser:")[-3:], context = context, question=question)
-
-                    # Get the response
-                    output = self.chat_model(_error_input.to_messages())
-
-                # If the answer cannot be generated, return an error message
-                else:
-                    return {'answer': f"Something went wrong! Please try again!",
-                        'follow_up_questions': []}
-                    
-        return json_output
+        Yields:
+        str: The next piece of the answer.
+        """
+        yield from iterate_sync(self.astream_response(question, st.session_state.config_param,
+                                                      self._get_context_retriever()))
+
+    async def astream_response(self, question, config_param, retriever):
+        """
+        Function to stream the answer to the given question as the model generates it.
+
+        The answer field of the JSON response is yielded as soon as its tokens arrive. Once the
+        stream ends the whole response is parsed, and kept with its follow-up questions in
+        last_response.
+
+        Args:
+        question (str): The question.
+        config_param (dict): The configuration of the course.
+        retriever (Retriever): The retriever building the context.
+
+        Yields:
+        str: The next piece of the answer.
+        """
+        logger.info(f"Getting the response for the question: {question}")
+        # Time the stages of the answer, the coroutines and threads working on it record into the trace
+        trace = Trace(config_param.get("APP_CODE"))
+        trace.activate()
+        # Queue the requests of the answer ahead of the background work sharing the house key
+        set_request_class(self.session_id, INTERACTIVE)
+        try:
+            # Serve the starter questions asked without history from the answers shared by the sessions
+            answer_version = None
+            if self.answer_cache is not None and not len(self.chat_memory) and self.answer_cache.is_cacheable(question):
+                answer_version = get_answer_version(retriever)
+                json_output = self.answer_cache.get(question, answer_version)
+                trace.record("answer_cache", "miss" if json_output is None else "hit")
+                if json_output is not None:
+                    yield json_output['answer']
+                    self.chat_memory.add_turn(question, json_output['answer'])
+                    self.last_response = json_output
+                    return
+                # Warm the starter questions again if the prompts changed since they were
+                warm_answer_cache(config_param, retriever)
+
+            # Resolve the question and get its context
+            question, context = await self.aresolve_question_and_context(question, retriever)
+            logger.info(f"Context for the question {question}: {context}")
+
+            # Get the response prompt
+            with trace.span("prompt_build"):
+                history = self.chat_memory.get_history()
+                messages = get_response_messages(question, context, history, config_param["DOCUMENT_LINK"])
+            trace.record("context_tokens", count_tokens(context, self.OPENAI_MODEL))
+            trace.record("history_tokens", count_tokens(history, self.OPENAI_MODEL))
+            trace.record("prompt_tokens", count_tokens("\n".join([message.content for message in messages]), self.OPENAI_MODEL))
+
+            # Stream the answer out of the JSON response while the rest of it is generated
+            answer = JsonFieldStream("answer")
+            content = ""
+            with trace.span("generation"):
+                async for chunk in self.response_model.astream(messages):
+                    text = get_message_text(chunk)
+                    content += text
+                    text = answer.feed(text)
+                    if text:
+                        if "first_token_ms" not in trace.values:
+                            trace.record("first_token_ms", round(trace.elapsed() * 1000, 2))
+                        yield text
+            trace.record("completion_tokens", count_tokens(content, self.OPENAI_MODEL))
+
+            # The schema is enforced by the provider, a cut or sloppy response is repaired locally
+            with trace.span("parse"):
+                json_output = parse_response(content, answer)
+            if json_output is None:
+                logger.error(f"No answer could be recovered for the question {question}: {content}")
+                trace.record("error", "unparsable_response")
+                json_output = {'answer': f"Something went wrong! Please try again!", 'follow_up_questions': []}
+                yield json_output['answer']
+                self.last_response = json_output
+                return
+            logger.info(f"Response for the question {question}: {content}")
+            if not json_output['answer'].startswith(answer.text):
+                yield ("\n\n" if answer.text else "") + json_output['answer']
+            elif len(json_output['answer']) > len(answer.text):
+                yield json_output['answer'][len(answer.text):]
+
+            # Share the answer of the starter question with the other sessions, it was not resolved against any history
+            if answer_version is not None:
+                self.answer_cache.put(question, answer_version, json_output)
+
+            # Update the chat history
+            self.chat_memory.add_turn(question, json_output['answer'])
+            self.last_response = json_output
+        except Exception as e:
+            trace.record("error", type(e).__name__)
+            raise
+        finally:
+            trace.finish()
 
-    
-            
     def main(self):
         """
         The main function to run the chatbot.
@@ -211,13 +593,13 @@ class ChatBot:
 
         if st.session_state.keyOwner != "None":
 
-            # Streamed response emulator
+            # Stream the answer tokens as the model generates them
             def response_generator(question):
+                stream = self.stream_response(question)
                 with st.spinner("Getting you the answer..."):
-                    response = self.get_response(question)
-                for word in response['answer']:
-                    yield word
-                    time.sleep(random.random()/100)
+                    first_token = next(stream, "")
+                yield first_token
+                yield from stream
 
             # Display chat messages from history on app rerun
             for message in st.session_state.messages:
@@ -255,7 +637,7 @@ class ChatBot:
 
                 # Check if the key is valid
                 try:
-                    self.chat_model = ChatOpenAI(temperature=0, model_name = self.OPENAI_MODEL, openai_api_key = st.session_state.openai_key)
+                    self.set_openai_key(st.session_state.openai_key)
                     # Check if key is valid
                     self.get_response("Hello")
                     st.session_state.keyOwner = "USER"
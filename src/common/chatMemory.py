@@ -0,0 +1,157 @@
+# Import the required libraries
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from src.common.contextAssembler import ContextAssembler
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Defaults of the memory, overridable through the secrets
+DEFAULT_MAX_TURNS = 3
+DEFAULT_MAX_TOKENS = 1500
+DEFAULT_MAX_ANSWER_TOKENS = 300
+DEFAULT_MAX_SUMMARY_TOKENS = 200
+
+# Thread pool summarizing the older turns of every session, off the path of the answers
+_executor = ThreadPoolExecutor(max_workers=st.secrets.get("CHAT_MEMORY_SUMMARY_THREADS", 2),
+                               thread_name_prefix="summary")
+
+
+class _Turn:
+    """
+    One question of the conversation and its answer.
+
+    Attributes:
+    question (str): The question.
+    answer (str): The answer, cut to the answer budget.
+    text (str): The turn as shown in the prompts.
+    tokens (int): The number of tokens of the text.
+    """
+    def __init__(self, question, answer, assembler):
+        """
+        The constructor for the _Turn class.
+
+        Args:
+        question (str): The question.
+        answer (str): The answer, cut to the answer budget.
+        assembler (ContextAssembler): The assembler counting the tokens.
+        """
+        self.question = question
+        self.answer = answer
+        self.text = f"User: {question}\nYou: {answer}"
+        self.tokens = assembler.count_tokens(self.text)
+
+
+class ChatMemory:
+    """
+    Bounded memory of a conversation.
+
+    The last turns are kept in a ring buffer, each with its token count measured once when it
+    is added, and answers are cut to a token budget before they are stored, so the history sent
+    with every question has a constant size however long the session. Turns falling out of the
+    buffer can be folded into a rolling summary, computed on a background thread so that no
+    answer waits for it.
+
+    Attributes:
+    max_turns (int): The number of turns kept.
+    max_tokens (int): The token budget of the history, summary included.
+    max_answer_tokens (int): The number of tokens kept of every answer.
+    max_summary_tokens (int): The number of tokens kept of the summary.
+    summary (str): The summary of the turns that left the buffer.
+    """
+    def __init__(self, model, max_turns=DEFAULT_MAX_TURNS, max_tokens=DEFAULT_MAX_TOKENS,
+                 max_answer_tokens=DEFAULT_MAX_ANSWER_TOKENS, max_summary_tokens=DEFAULT_MAX_SUMMARY_TOKENS,
+                 summarize=None):
+        """
+        The constructor for the ChatMemory class.
+
+        Args:
+        model (str): The chat model whose tokenizer measures the budgets.
+        max_turns (int): The number of turns kept.
+        max_tokens (int): The token budget of the history, summary included.
+        max_answer_tokens (int): The number of tokens kept of every answer.
+        max_summary_tokens (int): The number of tokens kept of the summary.
+        summarize (callable): Function taking the current summary and the text of the turns that
+            left the buffer, and returning the new summary. No summary is kept when None.
+        """
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.max_answer_tokens = max_answer_tokens
+        self.max_summary_tokens = max_summary_tokens
+        self.summary = ""
+        self._summarize = summarize
+        self._summary_tokens = 0
+        self._turns = deque(maxlen=max_turns)
+        self._evicted = []
+        self._summarizing = False
+        self._assembler = ContextAssembler(model)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._turns)
+
+    def add_turn(self, question, answer):
+        """
+        Function to remember a question and its answer.
+
+        Args:
+        question (str): The question.
+        answer (str): The answer.
+        """
+        turn = _Turn(question, self._assembler.truncate(answer, self.max_answer_tokens), self._assembler)
+        with self._lock:
+            if len(self._turns) == self.max_turns and self._summarize is not None:
+                self._evicted.append(self._turns[0])
+            self._turns.append(turn)
+            if not self._evicted or self._summarizing:
+                return
+            self._summarizing = True
+        _executor.submit(self._update_summary)
+
+    def _update_summary(self):
+        """
+        Function to fold the turns that left the buffer into the summary, run on the summary pool.
+        """
+        while True:
+            with self._lock:
+                if not self._evicted:
+                    self._summarizing = False
+                    return
+                turns, self._evicted = self._evicted, []
+                summary = self.summary
+            try:
+                summary = self._summarize(summary, "\n".join([turn.text for turn in turns]))
+            except Exception as e:
+                # The history still has the last turns, only the older ones are forgotten
+                logger.warning(f"Could not summarize {len(turns)} turns of the conversation: {e}")
+                continue
+            summary = self._assembler.truncate(summary.strip(), self.max_summary_tokens)
+            tokens = self._assembler.count_tokens(summary)
+            with self._lock:
+                self.summary, self._summary_tokens = summary, tokens
+
+    def get_history(self):
+        """
+        Function to get the history to send with the next question.
+
+        Returns:
+        str: The summary, if any, then the most recent turns fitting the token budget, oldest first.
+        """
+        with self._lock:
+            summary, budget = self.summary, self.max_tokens - self._summary_tokens
+            turns = list(self._turns)
+
+        kept = []
+        for turn in reversed(turns):
+            # Always keep the last turn, it is the one most questions refer to
+            if kept and turn.tokens > budget:
+                break
+            kept.append(turn.text)
+            budget -= turn.tokens
+        kept.reverse()
+        if summary:
+            kept.insert(0, f"Summary of the earlier conversation: {summary}")
+        return "\n".join(kept)
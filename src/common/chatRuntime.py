@@ -0,0 +1,205 @@
+# Import the required libraries
+import queue
+import asyncio
+import threading
+from collections import OrderedDict
+import httpx
+import openai
+import streamlit as st
+from langchain_openai.chat_models import ChatOpenAI
+from langchain_openai.embeddings import OpenAIEmbeddings
+from src.common.rateLimiter import RateLimitedTransport, AsyncRateLimitedTransport, get_scheduler
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Defaults of the connection pool, overridable through the secrets
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_KEEPALIVE_EXPIRY = 60
+
+# Number of chat models kept, one per API key, model and temperature
+DEFAULT_MAX_CHAT_MODELS = 256
+
+_lock = threading.Lock()
+_loop = None
+_http_client = None
+_async_http_client = None
+_chat_models = OrderedDict()
+
+
+def get_event_loop():
+    """
+    Function to get the process-wide event loop running the chat pipelines of every session.
+
+    The loop runs forever on a daemon thread, so the network waits of all the sessions are
+    multiplexed on it instead of each holding a thread.
+
+    Returns:
+    asyncio.AbstractEventLoop: The running loop.
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="chat-event-loop", daemon=True).start()
+        return _loop
+
+
+def run_sync(coroutine):
+    """
+    Function to run a coroutine on the shared event loop and wait for its result.
+
+    Args:
+    coroutine (coroutine): The coroutine.
+
+    Returns:
+    The result of the coroutine.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+
+def iterate_sync(async_generator):
+    """
+    Function to iterate an async generator on the shared event loop from a synchronous caller.
+
+    The whole generator runs in one task, so the context variables it sets, e.g. the trace of
+    the question or the request class of the session, hold across its items.
+
+    Args:
+    async_generator (AsyncGenerator): The generator.
+
+    Yields:
+    The items of the generator.
+    """
+    items = queue.Queue()
+    finished = threading.Event()
+    task = asyncio.run_coroutine_threadsafe(_drain(async_generator, items, finished), get_event_loop())
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == "item":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+    finally:
+        # Let the generator clean up when the caller stops early
+        if not finished.is_set():
+            task.cancel()
+            finished.wait()
+
+
+async def _drain(async_generator, items, finished):
+    """
+    Function to run an async generator, passing its items to the synchronous caller of iterate_sync.
+
+    Args:
+    async_generator (AsyncGenerator): The generator.
+    items (queue.Queue): The queue of the items, followed by the error raised or the end of the generator.
+    finished (threading.Event): Set once the generator is closed.
+    """
+    try:
+        async for item in async_generator:
+            items.put(("item", item))
+    except Exception as e:
+        items.put(("error", e))
+    finally:
+        await async_generator.aclose()
+        items.put(("done", None))
+        finished.set()
+
+
+def _get_limits():
+    """
+    Function to get the limits of the connection pools.
+
+    Returns:
+    httpx.Limits: The limits.
+    """
+    return httpx.Limits(
+        max_connections=st.secrets.get("OPENAI_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS),
+        max_keepalive_connections=st.secrets.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", DEFAULT_MAX_KEEPALIVE_CONNECTIONS),
+        keepalive_expiry=st.secrets.get("OPENAI_KEEPALIVE_EXPIRY", DEFAULT_KEEPALIVE_EXPIRY),
+    )
+
+
+def _get_http_clients():
+    """
+    Function to get the keep-alive connection pools shared by all the OpenAI clients, called with the lock held.
+
+    The requests sent with the house key wait for the process-wide scheduler of the key, so
+    sessions on the free trial share its rate limits fairly instead of hitting them.
+
+    Returns:
+    tuple: The synchronous and asynchronous httpx clients.
+    """
+    global _http_client, _async_http_client
+    if _http_client is None:
+        limits = _get_limits()
+        scheduler = get_scheduler("openai")
+        _http_client = httpx.Client(
+            transport=RateLimitedTransport(httpx.HTTPTransport(limits=limits), scheduler, st.secrets["OPENAI_KEY"]),
+            timeout=openai.DEFAULT_TIMEOUT)
+        _async_http_client = httpx.AsyncClient(
+            transport=AsyncRateLimitedTransport(httpx.AsyncHTTPTransport(limits=limits), scheduler,
+                                                st.secrets["OPENAI_KEY"]),
+            timeout=openai.DEFAULT_TIMEOUT)
+    return _http_client, _async_http_client
+
+
+def get_chat_model(api_key, model, temperature=0):
+    """
+    Function to get the shared chat model of an API key and model.
+
+    All the chat models send their requests through the same keep-alive connection pools, one
+    for the synchronous calls and one for the calls made on the shared event loop, so sessions
+    reuse the open connections instead of each paying for new TLS handshakes.
+
+    Args:
+    api_key (str): The OpenAI key.
+    model (str): The name of the model.
+    temperature (float): The sampling temperature.
+
+    Returns:
+    ChatOpenAI: The chat model.
+    """
+    key = (api_key, model, temperature)
+    with _lock:
+        chat_model = _chat_models.get(key)
+        if chat_model is not None:
+            _chat_models.move_to_end(key)
+            return chat_model
+
+        http_client, async_http_client = _get_http_clients()
+        chat_model = ChatOpenAI(
+            temperature=temperature, model_name=model, openai_api_key=api_key,
+            client=openai.OpenAI(api_key=api_key, http_client=http_client).chat.completions,
+            async_client=openai.AsyncOpenAI(api_key=api_key, http_client=async_http_client).chat.completions,
+        )
+        _chat_models[key] = chat_model
+        while len(_chat_models) > st.secrets.get("CHAT_MODELS_MAX", DEFAULT_MAX_CHAT_MODELS):
+            _chat_models.popitem(last=False)
+        logger.debug(f"Created the shared chat model of {model}, {len(_chat_models)} chat models pooled")
+        return chat_model
+
+
+def get_embeddings(api_key):
+    """
+    Function to get OpenAI embeddings sending their requests through the shared connection pools.
+
+    Args:
+    api_key (str): The OpenAI key.
+
+    Returns:
+    OpenAIEmbeddings: The embeddings.
+    """
+    with _lock:
+        http_client, async_http_client = _get_http_clients()
+    return OpenAIEmbeddings(
+        openai_api_key=api_key,
+        client=openai.OpenAI(api_key=api_key, http_client=http_client).embeddings,
+        async_client=openai.AsyncOpenAI(api_key=api_key, http_client=async_http_client).embeddings,
+    )
@@ -0,0 +1,314 @@
+# Import the required libraries
+import re
+from functools import lru_cache
+import tiktoken
+from langchain_core.documents import Document
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Defaults of the assembler, overridable through the secrets
+DEFAULT_MAX_TOKENS = 3000
+DEFAULT_DUPLICATE_THRESHOLD = 0.8
+
+# Bounds of the text overlap looked for between chunks without a start index
+MIN_OVERLAP_CHARS = 20
+MAX_OVERLAP_CHARS = 400
+
+# Characters per token assumed when the tokenizer is unavailable
+CHARS_PER_TOKEN = 4
+
+# Number of words per shingle of the near-duplicate check
+SHINGLE_SIZE = 5
+
+# Metadata that must be equal for two chunks to come from the same text
+MERGE_KEYS = ("course", "source")
+
+_WORDS = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model):
+    """
+    Function to get the tokenizer of a model.
+
+    Args:
+    model (str): The name of the model.
+
+    Returns:
+    tiktoken.Encoding: The tokenizer, cl100k_base for models tiktoken does not know, None when
+        the tokenizer files cannot be loaded.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads its files on first use, estimate the tokens rather than fail the answer
+        logger.warning(f"Could not load the tokenizer of {model}, estimating tokens from characters: {e}")
+        return None
+
+
+def count_tokens(text, model):
+    """
+    Function to count the tokens of a text with the tokenizer of a model.
+
+    Args:
+    text (str): The text.
+    model (str): The name of the model.
+
+    Returns:
+    int: The number of tokens, estimated from the characters when the tokenizer is unavailable.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def get_shingles(text):
+    """
+    Function to get the word shingles of a text.
+
+    Args:
+    text (str): The text.
+
+    Returns:
+    set: The tuples of SHINGLE_SIZE consecutive lower-cased words.
+    """
+    words = _WORDS.findall(text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def get_text_overlap(first, second):
+    """
+    Function to find how much the end of a text repeats at the start of another.
+
+    Args:
+    first (str): The text coming first.
+    second (str): The text coming second.
+
+    Returns:
+    int: The length of the longest suffix of first that is a prefix of second, 0 below MIN_OVERLAP_CHARS.
+    """
+    for length in range(min(len(first), len(second), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+class _Passage:
+    """
+    Span of source text made of one or more merged chunks.
+
+    Attributes:
+    text (str): The text of the span.
+    metadata (dict): The metadata of the best ranked chunk.
+    start (int): The start index of the span in its source, None when unknown.
+    shingles (set): The word shingles of the text.
+    """
+    def __init__(self, doc):
+        """
+        The constructor for the _Passage class.
+
+        Args:
+        doc (Document): The chunk.
+        """
+        self.text = doc.page_content
+        self.metadata = doc.metadata
+        self.start = doc.metadata.get("start_index")
+        self.shingles = get_shingles(self.text)
+
+    @property
+    def end(self):
+        return None if self.start is None else self.start + len(self.text)
+
+    def merge_key(self):
+        return tuple(self.metadata.get(key) for key in MERGE_KEYS)
+
+    def merge(self, doc):
+        """
+        Function to merge a chunk into the span when they touch or overlap.
+
+        Args:
+        doc (Document): The chunk.
+
+        Returns:
+        bool: Whether the chunk was merged.
+        """
+        other = _Passage(doc)
+        if other.merge_key() != self.merge_key():
+            return False
+
+        if self.start is not None and other.start is not None:
+            # Offsets are known, merge spans that overlap or touch, allowing for stripped whitespace
+            first, second = (self, other) if other.start >= self.start else (other, self)
+            if second.start > first.end + 2:
+                return False
+            if second.end <= first.end:
+                text = first.text
+            else:
+                separator = "" if second.start <= first.end else "\n\n"
+                text = first.text + separator + second.text[max(first.end - second.start, 0):]
+            self.start = first.start
+        else:
+            # Chunks of older indexes have no offsets, look for the splitter overlap in the text
+            if other.text in self.text:
+                text = self.text
+            elif self.text in other.text:
+                text = other.text
+            elif get_text_overlap(self.text, other.text):
+                text = self.text + other.text[get_text_overlap(self.text, other.text):]
+            elif get_text_overlap(other.text, self.text):
+                text = other.text + self.text[get_text_overlap(other.text, self.text):]
+            else:
+                return False
+            self.start = None
+
+        self.text = text
+        self.shingles = get_shingles(text)
+        return True
+
+    def similarity(self, other):
+        """
+        Function to get the Jaccard similarity of the shingles of two spans.
+
+        Args:
+        other (_Passage): The other span.
+
+        Returns:
+        float: The similarity, between 0 and 1.
+        """
+        union = len(self.shingles | other.shingles)
+        return len(self.shingles & other.shingles) / union if union else 1.0
+
+
+class ContextAssembler:
+    """
+    Builds the prompt context out of reranked chunks.
+
+    Chunks that overlap or touch in their source are merged into one passage, so the splitter
+    overlap is sent once, and near-duplicate passages are dropped. Passages are then packed in
+    rerank order until the token budget, measured with the tokenizer of the chat model, is spent.
+
+    Attributes:
+    model (str): The chat model whose tokenizer measures the budget.
+    max_tokens (int): The token budget of the context.
+    duplicate_threshold (float): The shingle similarity above which a passage is a near-duplicate.
+    """
+    def __init__(self, model, max_tokens=DEFAULT_MAX_TOKENS, duplicate_threshold=DEFAULT_DUPLICATE_THRESHOLD):
+        """
+        The constructor for the ContextAssembler class.
+
+        Args:
+        model (str): The chat model whose tokenizer measures the budget.
+        max_tokens (int): The token budget of the context.
+        duplicate_threshold (float): The shingle similarity above which a passage is a near-duplicate.
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+        self.duplicate_threshold = duplicate_threshold
+
+    def count_tokens(self, text):
+        """
+        Function to count the tokens of a text.
+
+        Args:
+        text (str): The text.
+
+        Returns:
+        int: The number of tokens.
+        """
+        return count_tokens(text, self.model)
+
+    def truncate(self, text, max_tokens):
+        """
+        Function to cut a text to a number of tokens.
+
+        Args:
+        text (str): The text.
+        max_tokens (int): The number of tokens to keep.
+
+        Returns:
+        str: The start of the text.
+        """
+        encoding = get_encoding(self.model)
+        if encoding is None:
+            return text[:max_tokens * CHARS_PER_TOKEN]
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    def _merge(self, docs):
+        """
+        Function to merge the chunks into passages, in rerank order.
+
+        Args:
+        docs (list): The reranked chunks, best first.
+
+        Returns:
+        list: The passages, ranked by their best chunk.
+        """
+        passages = []
+        for doc in docs:
+            if any(passage.merge(doc) for passage in passages):
+                continue
+            candidate = _Passage(doc)
+            if any(candidate.similarity(passage) >= self.duplicate_threshold for passage in passages):
+                continue
+            passages.append(candidate)
+
+        # A merge can make a passage contain another one, before or after it
+        kept = []
+        for passage in passages:
+            if any(passage.text in other.text for other in kept):
+                continue
+            # The passage takes the best rank of the kept ones it contains
+            contained = [i for i, other in enumerate(kept) if other.text in passage.text]
+            if not contained:
+                kept.append(passage)
+                continue
+            kept[contained[0]] = passage
+            kept = [other for i, other in enumerate(kept) if i not in contained[1:]]
+        return kept
+
+    def pack(self, docs):
+        """
+        Function to select the passages that fit the token budget.
+
+        Args:
+        docs (list): The reranked chunks, best first.
+
+        Returns:
+        list: The passages as Documents, best first.
+        """
+        separator_tokens = self.count_tokens("\n\n")
+        packed = []
+        used = 0
+        for passage in self._merge(docs):
+            tokens = self.count_tokens(passage.text)
+            if used + tokens + separator_tokens * bool(packed) > self.max_tokens:
+                if packed:
+                    # Smaller passages further down may still fit
+                    continue
+                # Never return an empty context, cut the best passage to the budget instead
+                passage.text = self.truncate(passage.text, self.max_tokens)
+                tokens = self.max_tokens
+            packed.append(Document(page_content=passage.text, metadata=dict(passage.metadata)))
+            used += tokens + separator_tokens * (len(packed) > 1)
+        logger.debug(f"Context assembled from {len(docs)} chunks into {len(packed)} passages, {used} tokens")
+        return packed
+
+    def assemble(self, docs):
+        """
+        Function to build the context string out of the reranked chunks.
+
+        Args:
+        docs (list): The reranked chunks, best first.
+
+        Returns:
+        str: The passages joined by blank lines.
+        """
+        return '\n\n'.join([doc.page_content for doc in self.pack(docs)])
@@ -1,14 +1,30 @@
 # Import the required libraries
+import os
+import contextvars
 import streamlit as st
+from typing import Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import patch_config
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.retrievers import BM25Retriever
 from langchain.retrievers import EnsembleRetriever
-from langchain_community.document_loaders import TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.retrievers.document_compressors import CohereRerank
-from langchain.retrievers import ContextualCompressionRetriever
-import pickle
+from src.common.embeddingCache import CachedEmbeddings, EMBEDDING_CACHE_PATH
+from src.common.embeddingPipeline import (EmbeddingPipeline, stream_text, stream_chunks, DEFAULT_BATCH_SIZE,
+                                          DEFAULT_MAX_CONCURRENCY)
+from src.common.queryCache import (QueryCache, MemoizedQueryEmbeddings, DEFAULT_MAX_ENTRIES, DEFAULT_TTL_SECONDS,
+                                   DEFAULT_SIMILARITY_THRESHOLD)
+from src.common.sparseBM25 import SparseBM25Retriever
+from src.common.contextAssembler import ContextAssembler, DEFAULT_MAX_TOKENS, DEFAULT_DUPLICATE_THRESHOLD
+from src.common.vectorIndex import DEFAULT_VECTOR_INDEX_PARAMS
+from src.common.indexBundle import (IndexBundle, IndexBundleError, BundleVectorRetriever, BundleWriter,
+                                    write_bundle, update_bundle, get_file_hash, DEFAULT_COMPACTION_THRESHOLD)
+from src.common.chatRuntime import get_embeddings
+from src.common.rateLimiter import ScheduledCompressor
+from src.common.metrics import span, record
 from src.common.logger import Logger
 
 # Create the logger object
@@ -18,6 +34,85 @@ logger = Logger.get_logger()
 OPENAI_KEY = st.secrets["OPENAI_KEY"]
 COHERE_API_KEY = st.secrets["COHERE_API_KEY"]
 
+# Name of the index bundle folder inside RETRIEVER_DB_PATH
+INDEX_BUNDLE_DIR = "index_bundle"
+
+# Files of the legacy FAISS store inside HYBRID_DB_PATH, pulled from S3 on every course update
+LEGACY_FILES = ["index.faiss", "index.pkl"]
+
+# Chunking parameters used to build the index
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 100
+
+# Thread pool running the retrieval legs of every session in the process
+_executor = ThreadPoolExecutor(max_workers=st.secrets.get("RETRIEVER_THREADS", 16), thread_name_prefix="retriever")
+
+
+class RetrievalCancelled(Exception):
+    """
+    Raised when a retrieval is cancelled between its stages, e.g. a speculative one that was superseded.
+    """
+
+
+def check_cancelled(cancelled, stage):
+    """
+    Function to stop a retrieval before its next stage once it was cancelled.
+
+    Args:
+    cancelled (threading.Event): The event set when the retrieval is no longer needed, None when it cannot be.
+    stage (str): The stage about to start.
+    """
+    if cancelled is not None and cancelled.is_set():
+        raise RetrievalCancelled(f"Retrieval cancelled before the {stage}")
+
+
+class ConcurrentEnsembleRetriever(EnsembleRetriever):
+    """
+    EnsembleRetriever running its retrievers concurrently on a thread pool.
+
+    The lexical leg no longer waits for the dense leg's query embedding, so the retrieval takes
+    as long as the slowest leg. The fusion is the same weighted reciprocal rank fusion.
+
+    Attributes:
+    executor: The thread pool the retrievers run on.
+    leg_names: The names of the retrievers in the latency metrics.
+    """
+    executor: Any
+    leg_names: List[str] = []
+
+    @staticmethod
+    def _invoke_leg(name, retriever, query, config):
+        with span(name):
+            return retriever.invoke(query, config)
+
+    def rank_fusion(
+        self,
+        query: str,
+        run_manager: CallbackManagerForRetrieverRun,
+        *,
+        config: Optional[RunnableConfig] = None,
+    ) -> List[Document]:
+        # Start every retriever, then wait on all of them
+        futures = [
+            self.executor.submit(
+                contextvars.copy_context().run,
+                self._invoke_leg,
+                self.leg_names[i] if i < len(self.leg_names) else f"retriever_{i+1}",
+                retriever,
+                query,
+                patch_config(config, callbacks=run_manager.get_child(tag=f"retriever_{i+1}")),
+            )
+            for i, retriever in enumerate(self.retrievers)
+        ]
+        retriever_docs = [future.result() for future in futures]
+
+        # Enforce that retrieved docs are Documents for each list in retriever_docs
+        retriever_docs = [
+            [Document(page_content=doc) if isinstance(doc, str) else doc for doc in docs]
+            for docs in retriever_docs
+        ]
+        return self.weighted_reciprocal_rank(retriever_docs)
+
 
 class Retriever:
     """
@@ -25,105 +120,252 @@ class Retriever:
 
     Attributes:
     bm25_retriever: The BM25 retriever.
-    vector_store: The vector store.
-    faiss_retriever: The FAISS retriever.
-    embeddings: The OpenAI embeddings.
-    re_ranker: The Cohere re-ranker.
+    index_bundle: The index bundle holding the vectors, the BM25 postings and the docstore.
+    embeddings: The OpenAI embeddings, sent through the shared connection pools.
+    re_ranker: The Cohere re-ranker, waiting for the rate limits of the house key.
     params_loaded: Whether the parameters are loaded or not.
+    query_cache: The cache of reranked results, shared by every session using this retriever.
+    context_assembler: The assembler packing the reranked chunks into the prompt context.
+    retriever_db_path: The folder holding the index bundle.
+    hybrid_db_path: The folder of the legacy FAISS store.
+    embedding_cache_path: The SQLite file caching the document embeddings.
     """
-    def __init__(self):
+    def __init__(self, retriever_db_path=None, hybrid_db_path=None):
         """
         The constructor for the Retriever class.
+
+        Args:
+        retriever_db_path (str): The folder holding the index bundle. Defaults to the active course's RETRIEVER_DB_PATH.
+        hybrid_db_path (str): The folder of the legacy FAISS store. Defaults to the active course's HYBRID_DB_PATH.
         """
+        self.retriever_db_path = retriever_db_path or st.session_state.config_param["RETRIEVER_DB_PATH"]
+        self.hybrid_db_path = hybrid_db_path or st.session_state.config_param["HYBRID_DB_PATH"]
         self.bm25_retriever = None
-        self.vector_store = None
-        self.faiss_retriever = None
-        self.embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_KEY)
-        self.re_ranker = CohereRerank(cohere_api_key=COHERE_API_KEY)
+        self.index_bundle = None
+        self.embeddings = get_embeddings(OPENAI_KEY)
+        self.query_embeddings = MemoizedQueryEmbeddings(self.embeddings)
+        self.re_ranker = ScheduledCompressor(compressor=CohereRerank(cohere_api_key=COHERE_API_KEY))
         self.params_loaded = False
-        self.compression_retriever = None
+        self.embedding_cache_path = EMBEDDING_CACHE_PATH
+        self.query_cache = QueryCache(
+            max_entries=st.secrets.get("QUERY_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+            ttl=st.secrets.get("QUERY_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS),
+            similarity_threshold=st.secrets.get("QUERY_CACHE_SIMILARITY_THRESHOLD", DEFAULT_SIMILARITY_THRESHOLD)
+        )
+        self.context_assembler = ContextAssembler(
+            st.secrets.get("OPENAI_MODEL", "gpt-3.5-turbo"),
+            max_tokens=st.secrets.get("CONTEXT_MAX_TOKENS", DEFAULT_MAX_TOKENS),
+            duplicate_threshold=st.secrets.get("CONTEXT_DUPLICATE_THRESHOLD", DEFAULT_DUPLICATE_THRESHOLD)
+        )
 
-        
-    def create_vector_store(self, file_name="sample.txt"):
+    def _get_bundle_path(self):
+        """
+        Function to get the path of the index bundle.
+
+        Returns:
+        str: The path of the index bundle.
+        """
+        return os.path.join(self.retriever_db_path, INDEX_BUNDLE_DIR)
+
+    def _split_file(self, file_name):
+        """
+        Function to load and split a source file into chunks.
+
+        Args:
+        file_name (str): The name of the file.
+
+        Returns:
+        list: The chunks.
+        """
+        # Split the file the same way the embedding pipeline streams it, so chunks match across builds
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        return list(stream_chunks(stream_text(file_name), text_splitter, file_name))
+
+    def create_vector_store(self, file_name="sample.txt", progress_callback=None):
         """
         The function to create the vector store.
 
+        The file is streamed through the embedding pipeline, so memory stays bounded for large
+        text files and PDFs.
+
         Args:
-        file_name (str): The name of the file to create the vector store.
+        file_name (str): The name of the text or PDF file to create the vector store.
+        progress_callback (callable): Called with the statistics of the pipeline after every batch.
         """
+        # Embed the chunks, only the ones missing from the embedding cache reach the API
+        cached_embeddings = CachedEmbeddings(self.embeddings, self.embedding_cache_path)
+        pipeline = EmbeddingPipeline(
+            cached_embeddings.embed_documents, CHUNK_SIZE, CHUNK_OVERLAP,
+            batch_size=st.secrets.get("EMBEDDING_BATCH_SIZE", DEFAULT_BATCH_SIZE),
+            max_concurrency=st.secrets.get("EMBEDDING_CONCURRENCY", DEFAULT_MAX_CONCURRENCY),
+            progress_callback=progress_callback
+        )
 
-        db_path=st.session_state.config_param["HYBRID_DB_PATH"]
-        # Load the documents
-        loader = TextLoader(file_name, encoding='UTF-8')
-        documents = loader.load()
+        # Append every embedded batch to the index bundle, swapped in once they are all written
+        with BundleWriter(self._get_bundle_path(), self._get_build_params("text")) as writer:
+            pipeline.run(file_name, writer)
+        logger.info(f"Embedding cache for {file_name}: {cached_embeddings.stats()}")
+        self._load_params()
 
-        # Split the Documents
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=100)
-        docs = text_splitter.split_documents(documents)
+    def update_vector_store(self, file_name="sample.txt", compaction_threshold=DEFAULT_COMPACTION_THRESHOLD):
+        """
+        The function to update the vector store with a new version of its source file.
 
-        # Create the vector store
-        self.vector_store = FAISS.from_documents(docs, self.embeddings)
+        Only the chunks that changed are embedded and indexed, removed chunks are tombstoned and
+        the index is compacted once they exceed compaction_threshold of it.
 
-        # Save the vector store
-        self.vector_store.save_local(db_path)
-        st.session_state.config_param["HYBRID_DB_PATH"] = db_path
+        Args:
+        file_name (str): The name of the file to update the vector store from.
+        compaction_threshold (float): The share of removed chunks that triggers a compaction.
+        """
+        docs = self._split_file(file_name)
 
-        # Create the retriever
-        self.bm25_retriever = BM25Retriever.from_documents(docs)
-        self.bm25_retriever.k=5
+        # Embed through the cache, a compaction then re-embeds the kept chunks for free
+        cached_embeddings = CachedEmbeddings(self.embeddings, self.embedding_cache_path)
+        update_bundle(self._get_bundle_path(), docs, cached_embeddings.embed_documents,
+                      self._get_build_params("text"), compaction_threshold)
+        logger.info(f"Embedding cache for {file_name}: {cached_embeddings.stats()}")
+        self._load_params()
 
-        self._save_params()
-        self.params_loaded = True
+    def _get_build_params(self, source):
+        """
+        Function to get the parameters recorded in the index manifest.
 
-    def _save_params(self):
+        Args:
+        source (str): Where the chunks come from.
+
+        Returns:
+        dict: The build parameters.
         """
-        Function to save the parameters.
+        return {
+            "source": source,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+            "embedding_model": self.embeddings.model,
+            "bm25_tokenizer": st.secrets.get("BM25_TOKENIZER", "whitespace"),
+            "vector_index": {
+                "type": st.secrets.get("VECTOR_INDEX_TYPE", DEFAULT_VECTOR_INDEX_PARAMS["type"]),
+                "memory_budget_mb": st.secrets.get("VECTOR_INDEX_MEMORY_BUDGET_MB", DEFAULT_VECTOR_INDEX_PARAMS["memory_budget_mb"]),
+                "target_recall": st.secrets.get("VECTOR_INDEX_TARGET_RECALL", DEFAULT_VECTOR_INDEX_PARAMS["target_recall"]),
+            },
+        }
+
+    def is_stale(self):
         """
-        folder_name=st.session_state.config_param["RETRIEVER_DB_PATH"]
-        # Store the retrievers and vector store to be used later
-        with open(f"{folder_name}/bm25_retriever.pkl", "wb") as f:
-            pickle.dump(self.bm25_retriever, f)
-        with open(f"{folder_name}/faiss_retriever.pkl", "wb") as f:
-            pickle.dump(self.faiss_retriever, f)
+        Function to check whether the index bundle on disk was rebuilt or updated since it was loaded,
+        or the legacy store it was migrated from was replaced.
 
-    def _load_params(self):
+        Returns:
+        bool: Whether the loaded bundle is out of date.
         """
-        Function to load the parameters.
+        if self.index_bundle is None:
+            return False
+        try:
+            bundle = IndexBundle(self._get_bundle_path(), verify=False)
+        except IndexBundleError:
+            return True
+        return bundle.build_id != self.index_bundle.build_id or self._legacy_files_changed(bundle)
+
+    def _get_legacy_files(self):
+        """
+        Function to get the size, modification time and sha256 of the files of the legacy FAISS store.
+
+        Returns:
+        dict: The fingerprint of every file by name, None when the store is missing.
         """
+        paths = {name: os.path.join(self.hybrid_db_path, name) for name in LEGACY_FILES}
+        if not all(os.path.exists(path) for path in paths.values()):
+            return None
+        return {name: {"size": os.path.getsize(path), "mtime": os.path.getmtime(path), "sha256": get_file_hash(path)}
+                for name, path in paths.items()}
 
-        folder_name=st.session_state.config_param["RETRIEVER_DB_PATH"]
+    def _legacy_files_changed(self, bundle):
+        """
+        Function to check whether the legacy FAISS store was replaced since a bundle was migrated from it.
+
+        Only the bundles migrated from the legacy store are checked. The sha256 of a file is only
+        computed when its size or modification time changed.
 
-        # Load the embeddings, retrievers and vector store which were saved earlier
-        self.embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_KEY)
-        self.vector_store = FAISS.load_local(st.session_state.config_param["HYBRID_DB_PATH"], self.embeddings)
-        self.re_ranker = CohereRerank(cohere_api_key=COHERE_API_KEY)
+        Args:
+        bundle (IndexBundle): The bundle.
 
-        with open(f"{folder_name}/bm25_retriever.pkl", "rb") as f:
-            self.bm25_retriever = pickle.load(f)
-        with open(f"{folder_name}/faiss_retriever.pkl", "rb") as f:
-            self.faiss_retriever = pickle.load(f)
+        Returns:
+        bool: Whether the bundle must be migrated again.
+        """
+        build_params = bundle.manifest.get("build_params", {})
+        if build_params.get("source") != "legacy":
+            return False
+        recorded = build_params.get("legacy_files")
+        for name in LEGACY_FILES:
+            path = os.path.join(self.hybrid_db_path, name)
+            if not os.path.exists(path):
+                return False
+            # Bundles migrated before the fingerprints were recorded are migrated once more
+            entry = (recorded or {}).get(name)
+            if entry is None:
+                return True
+            if os.path.getsize(path) == entry["size"] and os.path.getmtime(path) == entry["mtime"]:
+                continue
+            if get_file_hash(path) != entry["sha256"]:
+                return True
+        return False
+
+    def _migrate_legacy_params(self):
+        """
+        Function to convert the FAISS store saved by earlier versions into an index bundle.
+
+        The stored vectors are reused as they are, so no embeddings are requested.
+        """
+        logger.info(f"Migrating the legacy vector store at {self.hybrid_db_path} to an index bundle")
+        legacy_files = self._get_legacy_files()
+        vector_store = FAISS.load_local(self.hybrid_db_path, self.embeddings)
+
+        # Recover the chunks and the vectors in index order
+        ids = [vector_store.index_to_docstore_id[i] for i in range(vector_store.index.ntotal)]
+        docs = [vector_store.docstore.search(_id) for _id in ids]
+        vectors = vector_store.index.reconstruct_n(0, vector_store.index.ntotal)
+
+        # Seed the embedding cache so that the next rebuild does not re-embed these chunks
+        CachedEmbeddings(self.embeddings, self.embedding_cache_path).put([doc.page_content for doc in docs], vectors)
+
+        write_bundle(self._get_bundle_path(), docs, vectors,
+                     dict(self._get_build_params("legacy"), legacy_files=legacy_files))
+
+    def _load_params(self):
+        """
+        Function to load the parameters.
+        """
+        bundle_path = self._get_bundle_path()
+        if not IndexBundle.exists(bundle_path):
+            self._migrate_legacy_params()
+        elif self._legacy_files_changed(IndexBundle(bundle_path, verify=False)):
+            logger.info(f"The legacy vector store at {self.hybrid_db_path} was updated since it was migrated")
+            self._migrate_legacy_params()
+
+        # Open the index bundle, the files are only mapped into memory when first queried
+        self.index_bundle = IndexBundle(bundle_path)
 
         # Load the retrievers for use
-        faiss_retriever = self.vector_store.as_retriever(search_kwargs={"k": 5})
-        ensemble_retriever = EnsembleRetriever(
+        self.bm25_retriever = SparseBM25Retriever(bundle=self.index_bundle, k=5)
+        faiss_retriever = BundleVectorRetriever(bundle=self.index_bundle, embeddings=self.query_embeddings, k=5)
+        self.ensemble_retriever = ConcurrentEnsembleRetriever(
             retrievers=[self.bm25_retriever, faiss_retriever], 
-            weights=[0.5, 0.5]
+            weights=[0.5, 0.5],
+            executor=_executor,
+            leg_names=["bm25", "faiss"]
         )
 
-        self.compression_retriever = ContextualCompressionRetriever(
-            base_compressor=self.re_ranker, 
-            base_retriever=ensemble_retriever
-        )
-        
         self.params_loaded = True
     
 
-    def _retrieve_with_rerank(self, query):
+    def _retrieve_with_rerank(self, query, cancelled=None):
         """
         Function to retrieve the documents using the re-ranker.
 
         Args:
         query (str): The query to retrieve the documents.
+        cancelled (threading.Event): Set when the documents are no longer needed, the retrieval then
+            stops before its next stage and raises RetrievalCancelled.
 
         Returns:
         list: The list of documents retrieved.
@@ -132,29 +374,51 @@ class Retriever:
         # Load the retrievers if they are not loaded
         if self.params_loaded == False:
             self._load_params()
-        
-        # Get the response
-        if self.compression_retriever is None:
-            self._load_params()
 
-        response = self.compression_retriever.invoke(query)
+        # Serve the query from the course cache when it was answered before
+        version = self.index_bundle.build_id
+        response = self.query_cache.get(query, version)
+        if response is not None:
+            logger.debug(f"Query cache hit for query {query}")
+            record("query_cache", "hit")
+            return response
+
+        # Skip the retrieval and the rerank when a near-duplicate query was answered before
+        check_cancelled(cancelled, "query embedding")
+        vector = self.query_embeddings.embed_query(query)
+        response = self.query_cache.get_similar(query, version, vector)
+        if response is not None:
+            logger.debug(f"Query cache near-duplicate hit for query {query}")
+            record("query_cache", "near_hit")
+            return response
+
+        # Run the BM25 and FAISS legs concurrently, the FAISS leg reuses the memoized query embedding
+        record("query_cache", "miss")
+        check_cancelled(cancelled, "search")
+        docs = self.ensemble_retriever.invoke(query)
+        check_cancelled(cancelled, "rerank")
+        with span("rerank"):
+            response = self.re_ranker.compress_documents(docs, query)
+        self.query_cache.put(query, version, response, vector)
         return response
     
-    def parse_response_with_rerank(self, query):
+    def parse_response_with_rerank(self, query, cancelled=None):
         """
         Function to parse the response from the re-ranker.
 
         Args:
         query (str): The query to retrieve the documents.
+        cancelled (threading.Event): Set when the response is no longer needed.
 
         Returns:
         str: The parsed response.
         """
         # Get the response
-        response = self._retrieve_with_rerank(query)
+        response = self._retrieve_with_rerank(query, cancelled)
         logger.debug(f"Response for query {query}: {response}")
         
-        # Parse and return the response
-        return '\n\n'.join([r.page_content for r in response])
+        # Merge overlapping chunks and pack them into the token budget of the context
+        with span("context_assembly"):
+            return self.context_assembler.assemble(response)
     
 
@@ -0,0 +1,163 @@
+# Import the required libraries
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Default location of the cache, shared by all the courses
+EMBEDDING_CACHE_PATH = "data/embedding_cache.sqlite"
+
+# SQLite limits the number of parameters of a single statement
+LOOKUP_BATCH_SIZE = 500
+
+
+def get_embedding_key(model, text):
+    """
+    Function to get the cache key of a chunk.
+
+    Args:
+    model (str): The name of the embedding model.
+    text (str): The text of the chunk.
+
+    Returns:
+    str: The hex digest identifying the embedding.
+    """
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that keeps every document embedding in a SQLite file keyed by the
+    hash of the model name and the chunk text, so only new or changed chunks reach the API.
+
+    Attributes:
+    embeddings: The wrapped embeddings.
+    model (str): The name of the embedding model, part of the cache key.
+    path (str): The path of the SQLite file.
+    hits (int): The number of chunks served from the cache.
+    misses (int): The number of chunks sent to the wrapped embeddings.
+    """
+    def __init__(self, embeddings, path=EMBEDDING_CACHE_PATH, model=None):
+        """
+        The constructor for the CachedEmbeddings class.
+
+        Args:
+        embeddings: The wrapped embeddings.
+        path (str): The path of the SQLite file.
+        model (str): The name of the embedding model. Defaults to the model of the wrapped embeddings.
+        """
+        self.embeddings = embeddings
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+        self.path = str(path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        """
+        Function to open a connection to the cache, one per call so that threads never share one.
+
+        Yields:
+        sqlite3.Connection: The connection, committed and closed on exit.
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, texts):
+        """
+        Function to look up the cached embeddings of the given texts.
+
+        Args:
+        texts (list): The texts to look up.
+
+        Returns:
+        dict: The embeddings found, keyed by cache key.
+        """
+        keys = list({get_embedding_key(self.model, text) for text in texts})
+        found = {}
+        with self._connect() as conn:
+            for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                batch = keys[start:start + LOOKUP_BATCH_SIZE]
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch)
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put(self, texts, vectors):
+        """
+        Function to store embeddings in the cache.
+
+        Args:
+        texts (list): The embedded texts.
+        vectors (list): The embeddings of the texts.
+        """
+        rows = [(get_embedding_key(self.model, text), np.asarray(vector, dtype=np.float32).tobytes())
+                for text, vector in zip(texts, vectors)]
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Function to embed documents, only calling the wrapped embeddings for cache misses.
+
+        Args:
+        texts (list): The texts to embed.
+
+        Returns:
+        list: The embeddings of the texts.
+        """
+        found = self.get(texts)
+        keys = [get_embedding_key(self.model, text) for text in texts]
+
+        # Embed every distinct missing text once
+        missing = list({key: text for key, text in zip(keys, texts) if key not in found}.values())
+        if missing:
+            vectors = self.embeddings.embed_documents(missing)
+            self.put(missing, vectors)
+            found.update({get_embedding_key(self.model, text): list(vector) for text, vector in zip(missing, vectors)})
+
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Function to embed a query, queries are not cached.
+
+        Args:
+        text (str): The query.
+
+        Returns:
+        list: The embedding of the query.
+        """
+        return self.embeddings.embed_query(text)
+
+    def stats(self):
+        """
+        Function to get the hit and miss counts of the cache.
+
+        Returns:
+        dict: The hits, misses and hit rate.
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
@@ -0,0 +1,262 @@
+# Import the required libraries
+import time
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import fitz
+import openai
+from langchain_core.documents import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Defaults of the pipeline
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+# Text carried over between pieces in blocks, beyond which a piece is cut even without a line break
+MAX_CARRY_BLOCKS = 4
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+# Errors worth retrying, the provider is rate limiting or briefly unreachable
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                    openai.InternalServerError)
+
+
+def stream_text(file_name, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Function to read a source file piece by piece.
+
+    PDFs are read one page at a time and every page end is a cut point, since PyMuPDF drops the
+    blank lines between paragraphs. Other files are read as UTF-8 text in blocks, cut at paragraph
+    breaks whenever possible, so that the splitter sees whole paragraphs.
+
+    Args:
+    file_name (str): The name of the file.
+    block_size (int): The number of characters per block for text files.
+
+    Yields:
+    str: The next piece of text.
+    """
+    if file_name.lower().endswith(".pdf"):
+        with fitz.open(file_name) as pdf:
+            for page in pdf:
+                yield page.get_text()
+    else:
+        with open(file_name, "r", encoding="UTF-8") as f:
+            yield from _cut_at_paragraphs(iter(lambda: f.read(block_size), ""), MAX_CARRY_BLOCKS * block_size)
+
+
+def _cut_at_paragraphs(pieces, max_carry=MAX_CARRY_BLOCKS * DEFAULT_BLOCK_SIZE):
+    """
+    Function to move the text after the last paragraph break of every piece to the next piece.
+
+    Pieces without a paragraph break are cut at their last line break instead, and once the text
+    carried over exceeds max_carry it is emitted as it is, so memory stays bounded.
+
+    Args:
+    pieces (iterable): The text pieces, in order.
+    max_carry (int): The number of characters carried over beyond which a piece is cut anyway.
+
+    Yields:
+    str: The next piece, ending on a paragraph or line break unless it has none.
+    """
+    carry = ""
+    for piece in pieces:
+        # The carried text starts with the previous break, which is not a cut point
+        start = max(len(carry) - len(carry.lstrip("\n")), 1)
+        piece = carry + piece
+        cut = piece.rfind("\n\n", start)
+        if cut == -1:
+            cut = piece.rfind("\n", start)
+        if cut == -1:
+            if len(piece) > max_carry:
+                carry = ""
+                yield piece
+            else:
+                carry = piece
+            continue
+        carry = piece[cut:]
+        yield piece[:cut]
+    if carry:
+        yield carry
+
+
+def stream_chunks(pieces, text_splitter, source):
+    """
+    Function to split a stream of text into chunks without holding the whole text in memory.
+
+    The text is buffered until the splitter produces more than one chunk. All chunks but the last
+    are emitted, and the last one is kept to be split again together with the next piece, so that
+    chunks never end on a piece boundary.
+
+    Args:
+    pieces (iterable): The text pieces, in order.
+    text_splitter (RecursiveCharacterTextSplitter): The splitter.
+    source (str): The source recorded in the chunk metadata.
+
+    Yields:
+    Document: The next chunk, with its source and start index in the metadata.
+    """
+    buffer = ""
+    buffer_start = 0
+    for piece in pieces:
+        buffer += piece
+        chunks = text_splitter.split_text(buffer)
+        if len(chunks) < 2:
+            continue
+
+        # Emit every complete chunk, then carry the text from the last chunk on
+        search_from = 0
+        for chunk in chunks[:-1]:
+            start = buffer.find(chunk, search_from)
+            search_from = start + 1
+            yield Document(page_content=chunk, metadata={"source": source, "start_index": buffer_start + start})
+        carry = buffer.find(chunks[-1], search_from)
+        buffer_start += carry
+        buffer = buffer[carry:]
+
+    for chunk in text_splitter.split_text(buffer) if buffer.strip() else []:
+        start = buffer.find(chunk)
+        yield Document(page_content=chunk, metadata={"source": source, "start_index": buffer_start + start})
+
+
+def batched(items, batch_size):
+    """
+    Function to group a stream of items into lists.
+
+    Args:
+    items (iterable): The items.
+    batch_size (int): The size of every batch but the last.
+
+    Yields:
+    list: The next batch.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def embed_with_retry(embed_documents, texts, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF_SECONDS, stats=None):
+    """
+    Function to embed a batch, backing off exponentially with jitter on rate limits and transient errors.
+
+    Args:
+    embed_documents (callable): Function embedding a list of texts.
+    texts (list): The texts of the batch.
+    max_retries (int): The number of retries before giving up.
+    backoff (float): The first delay in seconds, doubled on every retry.
+    stats (dict): Statistics of the pipeline, its "retries" count is incremented.
+
+    Returns:
+    list: The embeddings of the texts.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return embed_documents(texts)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * (2 ** attempt) * (1 + random.random())
+            logger.warning(f"Embedding batch failed with {type(e).__name__}, retrying in {delay:.1f}s")
+            if stats is not None:
+                stats["retries"] += 1
+            time.sleep(delay)
+
+
+class EmbeddingPipeline:
+    """
+    Streaming pipeline turning a source file into an index bundle.
+
+    The file is streamed, split into chunks and embedded in batches on a bounded number of
+    threads. Batches are appended to the bundle writer in order as they complete, and at most
+    max_concurrency batches are in flight at a time, so memory stays bounded by the size of the
+    index itself whatever the size of the source file.
+
+    Attributes:
+    embed_documents (callable): Function embedding a list of texts.
+    batch_size (int): The number of chunks per embedding request.
+    max_concurrency (int): The number of embedding requests in flight.
+    max_retries (int): The number of retries of a failed batch.
+    progress_callback (callable): Called with the statistics of the pipeline after every batch.
+    stats (dict): The statistics of the current run.
+    """
+    def __init__(self, embed_documents, chunk_size, chunk_overlap, batch_size=DEFAULT_BATCH_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES, progress_callback=None):
+        """
+        The constructor for the EmbeddingPipeline class.
+
+        Args:
+        embed_documents (callable): Function embedding a list of texts.
+        chunk_size (int): The chunk size of the splitter.
+        chunk_overlap (int): The chunk overlap of the splitter.
+        batch_size (int): The number of chunks per embedding request.
+        max_concurrency (int): The number of embedding requests in flight.
+        max_retries (int): The number of retries of a failed batch.
+        progress_callback (callable): Called with the statistics of the pipeline after every batch.
+        """
+        self.embed_documents = embed_documents
+        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.progress_callback = progress_callback
+        self.stats = None
+
+    def run(self, file_name, writer):
+        """
+        Function to stream a source file into a bundle writer.
+
+        Args:
+        file_name (str): The name of the source file.
+        writer (BundleWriter): The writer the embedded batches are appended to.
+
+        Returns:
+        dict: The statistics of the run.
+        """
+        self.stats = {"file_name": file_name, "chunks": 0, "batches": 0, "retries": 0, "elapsed": 0.0}
+        started = time.monotonic()
+        chunks = stream_chunks(stream_text(file_name), self.text_splitter, file_name)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="embedding") as executor:
+            in_flight = deque()
+            for batch in batched(chunks, self.batch_size):
+                in_flight.append((batch, executor.submit(
+                    embed_with_retry, self.embed_documents, [doc.page_content for doc in batch],
+                    self.max_retries, DEFAULT_BACKOFF_SECONDS, self.stats)))
+
+                # Stop reading the source while the embedding requests are saturated
+                if len(in_flight) >= self.max_concurrency:
+                    self._append(writer, *in_flight.popleft(), started)
+            while in_flight:
+                self._append(writer, *in_flight.popleft(), started)
+
+        logger.info(f"Embedding pipeline finished: {self.stats}")
+        return self.stats
+
+    def _append(self, writer, batch, future, started):
+        """
+        Function to wait for a batch and append it to the bundle writer.
+
+        Args:
+        writer (BundleWriter): The writer.
+        batch (list): The chunks of the batch.
+        future (Future): The embedding request of the batch.
+        started (float): The monotonic time the run started.
+        """
+        writer.add(batch, future.result())
+        self.stats["chunks"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["elapsed"] = time.monotonic() - started
+        logger.debug(f"Embedding pipeline progress: {self.stats}")
+        if self.progress_callback is not None:
+            self.progress_callback(dict(self.stats))
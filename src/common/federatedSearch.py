@@ -0,0 +1,250 @@
+# Import the required libraries
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import streamlit as st
+from src.common.retrieverRegistry import get_registry
+from src.common.customHybridRetriever import RetrievalCancelled
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Number of documents kept from every shard and from the merge
+DEFAULT_SHARD_K = 5
+DEFAULT_K = 5
+
+# Thread pool fanning the queries out to the shards, separate from the retriever pool so that a
+# shard waiting on its own retrieval legs can never starve them
+_executor = ThreadPoolExecutor(max_workers=st.secrets.get("FEDERATED_SEARCH_THREADS", 8),
+                               thread_name_prefix="federated")
+
+
+def min_max_scores(scores):
+    """
+    Function to scale the scores of a shard to [0, 1].
+
+    Args:
+    scores (np.ndarray): The scores of the shard.
+
+    Returns:
+    np.ndarray: The scaled scores, all ones when they are equal.
+    """
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def z_scores(scores):
+    """
+    Function to standardize the scores of a shard.
+
+    Args:
+    scores (np.ndarray): The scores of the shard.
+
+    Returns:
+    np.ndarray: The standardized scores, all zeros when they are equal.
+    """
+    std = scores.std()
+    if std == 0:
+        return np.zeros_like(scores)
+    return (scores - scores.mean()) / std
+
+
+def raw_scores(scores):
+    """
+    Function to keep the scores of a shard as they are.
+
+    Args:
+    scores (np.ndarray): The scores of the shard.
+
+    Returns:
+    np.ndarray: The scores.
+    """
+    return scores
+
+
+# Score normalizations by name
+NORMALIZERS = {
+    "minmax": min_max_scores,
+    "zscore": z_scores,
+    "none": raw_scores,
+}
+
+
+class FederatedRetriever:
+    """
+    Functionality to search several courses at once.
+
+    Every course is a shard served by the shared retriever of the registry, so shards already
+    loaded by other sessions are reused and the caches of every course keep working. A query is
+    sent to every shard in parallel, the reranked documents of each shard are normalized with
+    the chosen normalization of their relevance scores and the best ones overall are kept.
+
+    Attributes:
+    config_params (dict): The configurations of the searched courses by course code.
+    shard_k (int): The number of documents kept from every shard.
+    k (int): The number of documents returned.
+    normalization (str): The score normalization, one of NORMALIZERS.
+    """
+    def __init__(self, config_params, shard_k=DEFAULT_SHARD_K, k=DEFAULT_K, normalization="minmax"):
+        """
+        The constructor for the FederatedRetriever class.
+
+        Args:
+        config_params (dict): The configurations of the courses to search by course code.
+            Courses without a retriever are skipped.
+        shard_k (int): The number of documents kept from every shard.
+        k (int): The number of documents returned.
+        normalization (str): The score normalization, one of NORMALIZERS.
+        """
+        if normalization not in NORMALIZERS:
+            raise ValueError(f"Unknown score normalization {normalization}, expected one of {list(NORMALIZERS)}")
+        self.config_params = {code: config_param for code, config_param in config_params.items()
+                              if config_param.get("RETRIEVER_DB_PATH") and config_param.get("HYBRID_DB_PATH")}
+        self.shard_k = shard_k
+        self.k = k
+        self.normalization = normalization
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_codes(cls, config_list, codes, **kwargs):
+        """
+        Function to create a federated retriever over some courses of the configuration list.
+
+        Args:
+        config_list (dict): The configurations of all the courses by course code.
+        codes (list): The codes of the courses to search.
+
+        Returns:
+        FederatedRetriever: The federated retriever.
+        """
+        return cls({code: config_list[code] for code in codes if code in config_list}, **kwargs)
+
+    def _get_shard(self, code):
+        """
+        Function to get the shared retriever of a course, holding a registry reference on it.
+
+        The retriever is kept between searches and only acquired again once the registry may have
+        found its index changed on disk.
+
+        Args:
+        code (str): The course code.
+
+        Returns:
+        Retriever: The shared retriever.
+        """
+        registry = get_registry()
+        with self._lock:
+            owner = self._shards.get(code)
+            if owner is None:
+                # One owner per shard, the registry keeps one reference per owner
+                owner = self._shards[code] = _ShardOwner()
+            if owner.retriever is not None and time.monotonic() - owner.acquired < registry.stale_check_interval:
+                return owner.retriever
+        retriever = registry.acquire(self.config_params[code], owner=owner)
+        with self._lock:
+            owner.retriever, owner.acquired = retriever, time.monotonic()
+        return retriever
+
+    def _search_shard(self, code, query, cancelled=None):
+        """
+        Function to get the reranked documents of one course.
+
+        Args:
+        code (str): The course code.
+        query (str): The query.
+        cancelled (threading.Event): Set when the documents are no longer needed.
+
+        Returns:
+        list: The documents, tagged with their course.
+        """
+        docs = self._get_shard(code)._retrieve_with_rerank(query, cancelled)[:self.shard_k]
+        return [doc.copy(update={"metadata": {**doc.metadata, "course": code}}) for doc in docs]
+
+    def search(self, query, codes=None, cancelled=None):
+        """
+        Function to search the courses and merge their results.
+
+        Args:
+        query (str): The query.
+        codes (list): The codes of the courses to search. Defaults to all the courses.
+        cancelled (threading.Event): Set when the results are no longer needed, the search then
+            raises RetrievalCancelled.
+
+        Returns:
+        list: The best documents over all the courses, best first.
+        """
+        codes = [code for code in (codes or self.config_params) if code in self.config_params]
+        futures = {code: _executor.submit(contextvars.copy_context().run, self._search_shard, code, query,
+                                         cancelled)
+                   for code in codes}
+
+        # Normalize every shard's scores on its own, a failing shard only loses its results
+        normalize = NORMALIZERS[self.normalization]
+        scored = []
+        for code, future in futures.items():
+            try:
+                docs = future.result()
+            except RetrievalCancelled:
+                raise
+            except Exception as e:
+                logger.error(f"Federated search failed on course {code}: {e}")
+                continue
+            if not docs:
+                continue
+            scores = normalize(np.array([doc.metadata.get("relevance_score", 0.0) for doc in docs], dtype=np.float64))
+            scored.extend(zip(scores.tolist(), docs))
+
+        # Stable sort, ties keep the shard order then the rank within the shard
+        scored.sort(key=lambda item: item[0], reverse=True)
+        logger.debug(f"Federated search over {codes} returned {len(scored)} documents")
+        return [doc for _, doc in scored[:self.k]]
+
+    def parse_response_with_rerank(self, query, codes=None, cancelled=None):
+        """
+        Function to search the courses and pack the documents into a context.
+
+        Args:
+        query (str): The query.
+        codes (list): The codes of the courses to search. Defaults to all the courses.
+        cancelled (threading.Event): Set when the context is no longer needed.
+
+        Returns:
+        str: The documents, each prefixed with its course.
+        """
+        docs = self.search(query, codes, cancelled)
+        if not docs:
+            return ""
+        # Pack with the assembler of the first shard, every shard is configured the same
+        assembler = self._get_shard(docs[0].metadata["course"]).context_assembler
+        return '\n\n'.join([f"[{doc.metadata['course']}] {doc.page_content}" for doc in assembler.pack(docs)])
+
+    def close(self):
+        """
+        Function to release the shards held in the registry.
+        """
+        with self._lock:
+            owners, self._shards = self._shards, {}
+        for owner in owners.values():
+            get_registry().release(owner)
+
+
+class _ShardOwner:
+    """
+    Placeholder owning one registry reference of a federated retriever.
+
+    Attributes:
+    retriever (Retriever): The retriever the reference was taken on, None before it is acquired.
+    acquired (float): The monotonic time the retriever was acquired at.
+    """
+    def __init__(self):
+        """
+        The constructor for the _ShardOwner class.
+        """
+        self.retriever = None
+        self.acquired = 0.0
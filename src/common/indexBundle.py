@@ -0,0 +1,765 @@
+# Import the required libraries
+import os
+import json
+import mmap
+import shutil
+import uuid
+import hashlib
+import threading
+from pathlib import Path
+import numpy as np
+import faiss
+from typing import Any, List
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from src.common.sparseBM25 import Tokenizer, SparseBM25Index
+from src.common.vectorIndex import select_vector_index, get_vector_index_params, apply_search_params
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Version of the on-disk layout, bump it whenever the files below change meaning
+FORMAT_VERSION = 2
+
+# Versions the reader understands, version 1 bundles have no chunk keys and no tombstones
+SUPPORTED_FORMAT_VERSIONS = (1, 2)
+
+# Files making up an index bundle
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.faiss"
+DOCSTORE_FILE = "docstore.jsonl"
+DOCSTORE_OFFSETS_FILE = "docstore_offsets.npy"
+BM25_VOCAB_FILE = "bm25_vocab.json"
+BM25_INDPTR_FILE = "bm25_indptr.npy"
+BM25_INDICES_FILE = "bm25_indices.npy"
+BM25_TF_FILE = "bm25_tf.npy"
+BM25_DOC_LEN_FILE = "bm25_doc_len.npy"
+CHUNK_KEYS_FILE = "chunk_keys.npy"
+TOMBSTONES_FILE = "tombstones.npy"
+BUNDLE_FILES = [VECTORS_FILE, DOCSTORE_FILE, DOCSTORE_OFFSETS_FILE, BM25_VOCAB_FILE, BM25_INDPTR_FILE,
+                BM25_INDICES_FILE, BM25_TF_FILE, BM25_DOC_LEN_FILE, CHUNK_KEYS_FILE, TOMBSTONES_FILE]
+
+# Size of the content key of a chunk, in bytes
+CHUNK_KEY_SIZE = 16
+
+# Share of tombstoned rows above which an update rewrites the whole bundle
+DEFAULT_COMPACTION_THRESHOLD = 0.2
+
+# Same parameters as rank_bm25.BM25Okapi so that results match the pickled retriever
+DEFAULT_BM25_PARAMS = {"k1": 1.5, "b": 0.75, "epsilon": 0.25}
+
+
+class IndexBundleError(Exception):
+    """
+    Raised when an index bundle is missing, has an unsupported format version or fails its integrity check.
+    """
+
+
+def get_corpus_hash(texts):
+    """
+    Function to compute the hash of a corpus of chunk texts.
+
+    Args:
+    texts (list): The chunk texts in index order.
+
+    Returns:
+    str: The hex digest of the corpus.
+    """
+    digest = hashlib.sha256()
+    for text in texts:
+        _update_corpus_hash(digest, text)
+    return digest.hexdigest()
+
+
+def _update_corpus_hash(digest, text):
+    """
+    Function to add a chunk text to a running corpus hash.
+
+    Args:
+    digest: The sha256 object of the corpus.
+    text (str): The chunk text.
+    """
+    encoded = text.encode("utf-8")
+    digest.update(len(encoded).to_bytes(8, "little"))
+    digest.update(encoded)
+
+
+def get_file_hash(path):
+    """
+    Function to compute the sha256 of a file without reading it into memory at once.
+
+    Args:
+    path (str): The path of the file.
+
+    Returns:
+    str: The hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_chunk_key(doc):
+    """
+    Function to get the content key of a chunk, used to diff a new chunk set against a bundle.
+
+    Args:
+    doc (Document): The chunk.
+
+    Returns:
+    bytes: The 16 byte key of the chunk.
+    """
+    payload = json.dumps([doc.page_content, doc.metadata], sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=CHUNK_KEY_SIZE).digest()
+
+
+def build_postings(texts, tokenizer, vocab=None):
+    """
+    Function to build the BM25 postings of a corpus as flat arrays.
+
+    The postings are stored document-major in CSR layout: the term ids and term frequencies of
+    document i are indices[indptr[i]:indptr[i+1]] and tf[indptr[i]:indptr[i+1]].
+
+    Args:
+    texts (list): The chunk texts in index order.
+    tokenizer (Tokenizer): The BM25 tokenizer.
+    vocab (dict): An existing vocabulary to extend, mapping terms to term ids.
+
+    Returns:
+    dict: The vocabulary and the postings arrays.
+    """
+    vocab = dict(vocab or {})
+    indptr = [0]
+    indices = []
+    tf = []
+    doc_len = []
+    for text in texts:
+        counts = {}
+        tokens = tokenizer(text)
+        for token in tokens:
+            term_id = vocab.setdefault(token, len(vocab))
+            counts[term_id] = counts.get(term_id, 0) + 1
+        indices.extend(counts.keys())
+        tf.extend(counts.values())
+        indptr.append(len(indices))
+        doc_len.append(len(tokens))
+
+    return {
+        "vocab": list(vocab),
+        "indptr": np.asarray(indptr, dtype=np.int64),
+        "indices": np.asarray(indices, dtype=np.int32),
+        "tf": np.asarray(tf, dtype=np.float32),
+        "doc_len": np.asarray(doc_len, dtype=np.float32),
+    }
+
+
+def get_tokenizer_name(build_params):
+    """
+    Function to get the BM25 tokenizer requested by the build parameters.
+
+    Args:
+    build_params (dict): The parameters used to build the chunks and embeddings.
+
+    Returns:
+    str: The name of the tokenizer.
+    """
+    return (build_params or {}).get("bm25_tokenizer", "whitespace")
+
+
+def _create_tmp_path(bundle_path):
+    """
+    Function to create the temporary folder a bundle is written to before being swapped in.
+
+    Args:
+    bundle_path (Path): The folder of the bundle.
+
+    Returns:
+    Path: The temporary folder.
+    """
+    tmp_path = bundle_path.with_name(bundle_path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    return tmp_path
+
+
+def _write_docstore(path, documents, offsets, mode="wb"):
+    """
+    Function to write chunks to a docstore as JSON lines, recording the byte offset of every line.
+
+    Args:
+    path (Path): The docstore file.
+    documents (list): The chunks to write.
+    offsets (list): The offsets so far, extended in place.
+    mode (str): "wb" to create the docstore, "ab" to append to it.
+    """
+    with open(path, mode) as f:
+        for doc in documents:
+            line = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}).encode("utf-8") + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+
+
+def _write_postings(tmp_path, postings):
+    """
+    Function to write the BM25 postings arrays.
+
+    Args:
+    tmp_path (Path): The folder of the bundle being written.
+    postings (dict): The vocabulary list and the postings arrays.
+    """
+    with open(tmp_path / BM25_VOCAB_FILE, "w", encoding="utf-8") as f:
+        json.dump(postings["vocab"], f)
+    np.save(tmp_path / BM25_INDPTR_FILE, postings["indptr"])
+    np.save(tmp_path / BM25_INDICES_FILE, postings["indices"])
+    np.save(tmp_path / BM25_TF_FILE, postings["tf"])
+    np.save(tmp_path / BM25_DOC_LEN_FILE, postings["doc_len"])
+
+
+def _finalize_bundle(tmp_path, bundle_path, corpus_hash, num_live, num_rows, dimension, build_params, vector_index=None):
+    """
+    Function to write the manifest of a bundle and swap it in place of the previous one.
+
+    Args:
+    tmp_path (Path): The folder the bundle was written to.
+    bundle_path (Path): The final folder of the bundle.
+    corpus_hash (str): The hash of the live chunks, in source order.
+    num_live (int): The number of live chunks.
+    num_rows (int): The number of rows in the bundle, including tombstoned ones.
+    dimension (int): The dimension of the vectors.
+    build_params (dict): The parameters used to build the chunks and embeddings.
+    vector_index (dict): The type, search parameters and measured recall of the FAISS index.
+
+    Returns:
+    dict: The manifest of the bundle.
+    """
+    # Write the manifest last, it is what marks the bundle as complete
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "build_id": uuid.uuid4().hex,
+        "corpus_hash": corpus_hash,
+        "num_documents": num_rows,
+        "num_live_documents": num_live,
+        "dimension": int(dimension),
+        "build_params": dict(build_params or {}, bm25=dict(DEFAULT_BM25_PARAMS, tokenizer=get_tokenizer_name(build_params))),
+        "vector_index": vector_index or {"type": "flat", "factory": "Flat", "search_params": {}},
+        "files": {
+            name: {"size": os.path.getsize(tmp_path / name), "sha256": get_file_hash(tmp_path / name)}
+            for name in BUNDLE_FILES
+        },
+    }
+    with open(tmp_path / MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    # Swap the new bundle in place of the old one
+    old_path = bundle_path.with_name(bundle_path.name + ".old")
+    shutil.rmtree(old_path, ignore_errors=True)
+    if bundle_path.exists():
+        os.replace(bundle_path, old_path)
+    os.replace(tmp_path, bundle_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return manifest
+
+
+class BundleWriter:
+    """
+    Writer building an index bundle batch by batch.
+
+    Chunks are appended to the docstore on disk as they are added, so only the vectors and the
+    BM25 postings are held in memory. The bundle is written to a temporary folder next to
+    bundle_path and swapped in by close, so readers never observe a half written bundle. Used as
+    a context manager, the writer closes on a clean exit and aborts when an exception is raised.
+
+    Attributes:
+    bundle_path (Path): The folder of the bundle.
+    build_params (dict): The parameters used to build the chunks and embeddings.
+    num_documents (int): The number of chunks added so far.
+    manifest (dict): The manifest of the written bundle, None until it is closed.
+    """
+    def __init__(self, bundle_path, build_params=None):
+        """
+        The constructor for the BundleWriter class.
+
+        Args:
+        bundle_path (str): The folder to write the bundle to.
+        build_params (dict): The parameters used to build the chunks and embeddings.
+        """
+        self.bundle_path = Path(bundle_path)
+        self.build_params = build_params
+        self.num_documents = 0
+        self.manifest = None
+        self._tmp_path = _create_tmp_path(self.bundle_path)
+        self._tokenizer = Tokenizer(get_tokenizer_name(build_params))
+        self._index = None
+        self._offsets = [0]
+        self._vocab = {}
+        self._postings = []
+        self._chunk_keys = []
+        self._corpus_digest = hashlib.sha256()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except Exception:
+            self.abort()
+            raise
+
+    def add(self, documents, vectors):
+        """
+        Function to append a batch of chunks and their embeddings to the bundle.
+
+        Args:
+        documents (list): The chunks as langchain Documents.
+        vectors (np.ndarray): The embeddings of the chunks, one row per document.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) != len(documents):
+            raise IndexBundleError(f"Got {len(vectors)} vectors for {len(documents)} documents.")
+        if not documents:
+            return
+
+        # Add the dense vectors to a flat L2 index, replaced by a compressed one on close if it pays off
+        if self._index is None:
+            self._index = faiss.IndexFlatL2(vectors.shape[1])
+        self._index.add(vectors)
+
+        # Append the chunks to the docstore and extend the postings
+        texts = [doc.page_content for doc in documents]
+        _write_docstore(self._tmp_path / DOCSTORE_FILE, documents, self._offsets, mode="ab")
+        postings = build_postings(texts, self._tokenizer, self._vocab)
+        self._vocab = {term: term_id for term_id, term in enumerate(postings["vocab"])}
+        self._postings.append(postings)
+        self._chunk_keys.extend(get_chunk_key(doc) for doc in documents)
+        for text in texts:
+            _update_corpus_hash(self._corpus_digest, text)
+        self.num_documents += len(documents)
+
+    def close(self):
+        """
+        Function to write the remaining files and swap the bundle in, once.
+
+        Returns:
+        dict: The manifest of the written bundle.
+        """
+        if self.manifest is not None:
+            return self.manifest
+        tmp_path = self._tmp_path
+        index, vector_index = select_vector_index(self._index if self._index is not None else faiss.IndexFlatL2(0),
+                                                  get_vector_index_params(self.build_params))
+        faiss.write_index(index, str(tmp_path / VECTORS_FILE))
+        (tmp_path / DOCSTORE_FILE).touch()
+        np.save(tmp_path / DOCSTORE_OFFSETS_FILE, np.asarray(self._offsets, dtype=np.int64))
+
+        # Stitch the postings of every batch together
+        indptr = [np.zeros(1, dtype=np.int64)]
+        for postings in self._postings:
+            indptr.append(indptr[-1][-1] + postings["indptr"][1:])
+        _write_postings(tmp_path, {
+            "vocab": list(self._vocab),
+            "indptr": np.concatenate(indptr),
+            "indices": np.concatenate([p["indices"] for p in self._postings] or [np.zeros(0, dtype=np.int32)]),
+            "tf": np.concatenate([p["tf"] for p in self._postings] or [np.zeros(0, dtype=np.float32)]),
+            "doc_len": np.concatenate([p["doc_len"] for p in self._postings] or [np.zeros(0, dtype=np.float32)]),
+        })
+
+        # Write the chunk keys and an empty tombstone mask
+        np.save(tmp_path / CHUNK_KEYS_FILE, np.asarray(self._chunk_keys, dtype="S16"))
+        np.save(tmp_path / TOMBSTONES_FILE, np.zeros(self.num_documents, dtype=bool))
+
+        self.manifest = _finalize_bundle(tmp_path, self.bundle_path, self._corpus_digest.hexdigest(),
+                                         self.num_documents, self.num_documents, index.d, self.build_params,
+                                         vector_index)
+        logger.info(f"Index bundle with {self.num_documents} documents written to {self.bundle_path}")
+        return self.manifest
+
+    def abort(self):
+        """
+        Function to discard the bundle being written, leaving the previous one in place.
+        """
+        shutil.rmtree(self._tmp_path, ignore_errors=True)
+
+
+def write_bundle(bundle_path, documents, vectors, build_params=None):
+    """
+    Function to write an index bundle for the given chunks and their embeddings.
+
+    Args:
+    bundle_path (str): The folder to write the bundle to.
+    documents (list): The chunks as langchain Documents.
+    vectors (np.ndarray): The embeddings of the chunks, one row per document.
+    build_params (dict): The parameters used to build the chunks and embeddings.
+
+    Returns:
+    dict: The manifest of the written bundle.
+    """
+    with BundleWriter(bundle_path, build_params) as writer:
+        writer.add(documents, vectors)
+    return writer.manifest
+
+
+def update_bundle(bundle_path, documents, embed_documents, build_params=None, compaction_threshold=DEFAULT_COMPACTION_THRESHOLD):
+    """
+    Function to bring an index bundle in line with a new chunk set without re-indexing it.
+
+    The new chunk set is diffed against the live chunks of the bundle by content key. Only the
+    added chunks are embedded and appended to the vectors, postings and docstore; removed chunks
+    are tombstoned. Once tombstoned rows exceed compaction_threshold of the bundle, it is
+    compacted by rewriting it from the new chunk set.
+
+    Args:
+    bundle_path (str): The folder of the bundle.
+    documents (list): The new chunk set.
+    embed_documents (callable): Function embedding a list of texts, used for the added chunks
+        and, on compaction, for the whole chunk set.
+    build_params (dict): The parameters used to build the chunks and embeddings.
+    compaction_threshold (float): The share of tombstoned rows that triggers a compaction.
+
+    Returns:
+    dict: The manifest of the updated bundle.
+    """
+    bundle_path = Path(bundle_path)
+    if not IndexBundle.exists(bundle_path):
+        return write_bundle(bundle_path, documents, embed_documents([doc.page_content for doc in documents]), build_params)
+    bundle = IndexBundle(bundle_path)
+    num_rows = len(bundle)
+
+    # Match the new chunks against the live rows, chunks may legitimately repeat. NumPy drops the
+    # trailing zero bytes of fixed-width byte strings, so the keys are padded back to full length
+    live_rows = {}
+    for row, key in enumerate(bundle.chunk_keys):
+        if not bundle.tombstones[row]:
+            live_rows.setdefault(bytes(key).ljust(CHUNK_KEY_SIZE, b"\0"), []).append(row)
+    added = []
+    for doc in documents:
+        rows = live_rows.get(get_chunk_key(doc))
+        if rows:
+            rows.pop()
+        else:
+            added.append(doc)
+    removed = [row for rows in live_rows.values() for row in rows]
+
+    # A different tokenizer invalidates all the postings
+    if bundle.tokenizer.name != get_tokenizer_name(build_params):
+        logger.info(f"BM25 tokenizer changed, rebuilding the index bundle at {bundle_path}")
+        return write_bundle(bundle_path, documents, embed_documents([doc.page_content for doc in documents]), build_params)
+
+    if not added and not removed:
+        logger.info(f"Index bundle at {bundle_path} is up to date")
+        return bundle.manifest
+
+    # Compact once too much of the bundle is dead weight
+    dead = int(np.count_nonzero(bundle.tombstones)) + len(removed)
+    if dead > compaction_threshold * (num_rows + len(added)):
+        logger.info(f"Compacting the index bundle at {bundle_path}")
+        return write_bundle(bundle_path, documents, embed_documents([doc.page_content for doc in documents]), build_params)
+
+    vectors = np.ascontiguousarray(embed_documents([doc.page_content for doc in added]), dtype=np.float32)
+    tmp_path = _create_tmp_path(bundle_path)
+
+    # Append the new vectors, the index type is only reconsidered on compaction
+    index = faiss.read_index(bundle._file(VECTORS_FILE))
+    if len(vectors):
+        index.add(vectors)
+    faiss.write_index(index, str(tmp_path / VECTORS_FILE))
+
+    # Append the new chunks to a copy of the docstore
+    shutil.copyfile(bundle._file(DOCSTORE_FILE), tmp_path / DOCSTORE_FILE)
+    offsets = np.load(bundle._file(DOCSTORE_OFFSETS_FILE)).tolist()
+    _write_docstore(tmp_path / DOCSTORE_FILE, added, offsets, mode="ab")
+    np.save(tmp_path / DOCSTORE_OFFSETS_FILE, np.asarray(offsets, dtype=np.int64))
+
+    # Append the new postings, extending the vocabulary
+    postings = bundle.postings
+    new_postings = build_postings([doc.page_content for doc in added], bundle.tokenizer, postings["vocab"])
+    _write_postings(tmp_path, {
+        "vocab": new_postings["vocab"],
+        "indptr": np.concatenate([postings["indptr"], postings["indptr"][-1] + new_postings["indptr"][1:]]),
+        "indices": np.concatenate([postings["indices"], new_postings["indices"]]),
+        "tf": np.concatenate([postings["tf"], new_postings["tf"]]),
+        "doc_len": np.concatenate([postings["doc_len"], new_postings["doc_len"]]),
+    })
+
+    # Record the keys of the new rows and tombstone the removed ones
+    chunk_keys = np.concatenate([bundle.chunk_keys, np.asarray([get_chunk_key(doc) for doc in added], dtype="S16")])
+    np.save(tmp_path / CHUNK_KEYS_FILE, chunk_keys)
+    tombstones = np.concatenate([bundle.tombstones, np.zeros(len(added), dtype=bool)])
+    tombstones[removed] = True
+    np.save(tmp_path / TOMBSTONES_FILE, tombstones)
+
+    manifest = _finalize_bundle(tmp_path, bundle_path, get_corpus_hash([doc.page_content for doc in documents]),
+                                len(documents), len(tombstones), index.d, build_params, bundle.manifest.get("vector_index"))
+    logger.info(f"Index bundle at {bundle_path} updated: {len(added)} chunks added, {len(removed)} removed")
+    return manifest
+
+
+class IndexBundle:
+    """
+    Read-only view of an index bundle on disk.
+
+    Only the manifest is read when the bundle is opened. The FAISS index, the docstore and the BM25
+    postings are memory-mapped on first use, and each file is checked against its manifest entry
+    before it is used.
+
+    Attributes:
+    path (Path): The folder of the bundle.
+    manifest (dict): The manifest of the bundle.
+    verify (bool): Whether to check the sha256 of each file before it is used.
+    """
+    def __init__(self, path, verify=True):
+        """
+        The constructor for the IndexBundle class.
+
+        Args:
+        path (str): The folder of the bundle.
+        verify (bool): Whether to check the sha256 of each file before it is used.
+        """
+        self.path = Path(path)
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._verified = set()
+        self._vector_index = None
+        self._docstore = None
+        self._offsets = None
+        self._postings = None
+        self._bm25_index = None
+        self._tokenizer = None
+        self._tombstones = None
+        self._chunk_keys = None
+
+        manifest_path = self.path / MANIFEST_FILE
+        if not manifest_path.exists():
+            raise IndexBundleError(f"No index bundle found at {self.path}")
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format_version") not in SUPPORTED_FORMAT_VERSIONS:
+            raise IndexBundleError(
+                f"Index bundle at {self.path} has format version {self.manifest.get('format_version')}, "
+                f"expected one of {SUPPORTED_FORMAT_VERSIONS}")
+
+        # Cheap structural check of every file, the checksums are verified lazily
+        for name, entry in self.manifest["files"].items():
+            expected = entry["size"]
+            if not (self.path / name).exists() or os.path.getsize(self.path / name) != expected:
+                raise IndexBundleError(f"File {name} of the index bundle at {self.path} is missing or truncated")
+
+    @staticmethod
+    def exists(path):
+        """
+        Function to check whether a bundle has been written to the given folder.
+
+        Args:
+        path (str): The folder of the bundle.
+
+        Returns:
+        bool: Whether the bundle manifest exists.
+        """
+        return (Path(path) / MANIFEST_FILE).exists()
+
+    def __len__(self):
+        return self.manifest["num_documents"]
+
+    @property
+    def nbytes(self):
+        """
+        The total size of the bundle files in bytes.
+        """
+        return sum(entry["size"] for entry in self.manifest["files"].values())
+
+    def _file(self, name):
+        """
+        Function to get the path of a bundle file, verifying its checksum on first use.
+
+        Args:
+        name (str): The name of the file.
+
+        Returns:
+        str: The path of the file.
+        """
+        path = self.path / name
+        if self.verify and name not in self._verified:
+            if get_file_hash(path) != self.manifest["files"][name]["sha256"]:
+                raise IndexBundleError(f"File {name} of the index bundle at {self.path} failed its integrity check")
+            self._verified.add(name)
+        return str(path)
+
+    @property
+    def build_id(self):
+        """
+        The identifier of the build that wrote the bundle, it changes on every rebuild or update.
+        """
+        return self.manifest.get("build_id", self.manifest["corpus_hash"])
+
+    @property
+    def tombstones(self):
+        """
+        The mask of the rows removed by incremental updates.
+        """
+        if self._tombstones is None:
+            if TOMBSTONES_FILE in self.manifest["files"]:
+                self._tombstones = np.load(self._file(TOMBSTONES_FILE), mmap_mode="r")
+            else:
+                self._tombstones = np.zeros(len(self), dtype=bool)
+        return self._tombstones
+
+    @property
+    def num_tombstones(self):
+        """
+        The number of rows removed by incremental updates.
+        """
+        return len(self) - self.manifest.get("num_live_documents", len(self))
+
+    @property
+    def chunk_keys(self):
+        """
+        The content key of every row.
+        """
+        if self._chunk_keys is None:
+            if CHUNK_KEYS_FILE in self.manifest["files"]:
+                self._chunk_keys = np.load(self._file(CHUNK_KEYS_FILE), mmap_mode="r")
+            else:
+                self._chunk_keys = np.asarray([get_chunk_key(doc) for doc in self.iter_documents()], dtype="S16")
+        return self._chunk_keys
+
+    @property
+    def vector_index(self):
+        """
+        The FAISS index of the chunk embeddings.
+        """
+        with self._lock:
+            if self._vector_index is None:
+                path = self._file(VECTORS_FILE)
+                try:
+                    self._vector_index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                except RuntimeError:
+                    # Not every index type supports memory mapping
+                    self._vector_index = faiss.read_index(path)
+                apply_search_params(self._vector_index, self.manifest.get("vector_index", {}).get("search_params"))
+            return self._vector_index
+
+    @property
+    def postings(self):
+        """
+        The BM25 vocabulary and postings arrays.
+        """
+        with self._lock:
+            if self._postings is None:
+                with open(self._file(BM25_VOCAB_FILE), "r", encoding="utf-8") as f:
+                    vocab = json.load(f)
+                self._postings = {
+                    "vocab": {term: term_id for term_id, term in enumerate(vocab)},
+                    "indptr": np.load(self._file(BM25_INDPTR_FILE), mmap_mode="r"),
+                    "indices": np.load(self._file(BM25_INDICES_FILE), mmap_mode="r"),
+                    "tf": np.load(self._file(BM25_TF_FILE), mmap_mode="r"),
+                    "doc_len": np.load(self._file(BM25_DOC_LEN_FILE), mmap_mode="r"),
+                }
+            return self._postings
+
+    def _open_docstore(self):
+        """
+        Function to memory-map the docstore and its offsets.
+
+        The offsets are published last, since get_document checks them without the lock.
+        """
+        with self._lock:
+            if self._offsets is None:
+                offsets = np.load(self._file(DOCSTORE_OFFSETS_FILE), mmap_mode="r")
+                if len(self) > 0:
+                    with open(self._file(DOCSTORE_FILE), "rb") as f:
+                        self._docstore = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._offsets = offsets
+
+    def get_document(self, i):
+        """
+        Function to read a single chunk from the docstore.
+
+        Args:
+        i (int): The position of the chunk in the index.
+
+        Returns:
+        Document: The chunk.
+        """
+        if self._offsets is None:
+            self._open_docstore()
+        record = json.loads(self._docstore[int(self._offsets[i]):int(self._offsets[i + 1])])
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def get_documents(self, ids):
+        """
+        Function to read several chunks from the docstore.
+
+        Args:
+        ids (list): The positions of the chunks in the index.
+
+        Returns:
+        list: The chunks, in the order of ids.
+        """
+        return [self.get_document(i) for i in ids]
+
+    def iter_documents(self):
+        """
+        Function to iterate over all the chunks in index order.
+
+        Yields:
+        Document: The next chunk.
+        """
+        for i in range(len(self)):
+            yield self.get_document(i)
+
+    @property
+    def tokenizer(self):
+        """
+        The tokenizer the BM25 postings were built with.
+        """
+        if self._tokenizer is None:
+            self._tokenizer = Tokenizer(self.manifest["build_params"]["bm25"].get("tokenizer", "whitespace"))
+        return self._tokenizer
+
+    @property
+    def bm25_index(self):
+        """
+        The sparse BM25 scorer over the postings.
+        """
+        postings = self.postings
+        with self._lock:
+            if self._bm25_index is None:
+                params = self.manifest["build_params"]["bm25"]
+                self._bm25_index = SparseBM25Index(postings, self.tombstones, params["k1"], params["b"], params["epsilon"])
+            return self._bm25_index
+
+
+class BundleVectorRetriever(BaseRetriever):
+    """
+    Dense retriever searching the FAISS index of an index bundle.
+
+    Attributes:
+    bundle: The index bundle.
+    embeddings: The embeddings used to embed the query.
+    k: The number of documents to return.
+    """
+    bundle: Any
+    embeddings: Any
+    k: int = 5
+
+    class Config:
+        """Configuration for this pydantic object."""
+
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        if len(self.bundle) == 0:
+            return []
+        vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+
+        # Over-fetch by the number of tombstoned rows so that k live rows remain after filtering
+        _, ids = self.bundle.vector_index.search(vector, self.k + self.bundle.num_tombstones)
+        tombstones = self.bundle.tombstones
+        return self.bundle.get_documents([i for i in ids[0] if i != -1 and not tombstones[i]][:self.k])
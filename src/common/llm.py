@@ -1,8 +1,196 @@
-from langchain_openai.chat_models import ChatOpenAI
+# Import the required libraries
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.prompts import PromptTemplate
-from langchain.chains import LLMChain
 import google.generativeai as gemini
 import streamlit as st
+from src.common.chatRuntime import get_chat_model
+from src.common.llmRouter import LLMRouter, get_router_options
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Thread pool running the batched generations, bounding the requests in flight for the whole process
+_executor = ThreadPoolExecutor(max_workers=st.secrets.get("LLM_MAX_CONCURRENCY", 8), thread_name_prefix="llm")
+
+# Sampling temperature of the OpenAI model, set LLM_TEMPERATURE to 0 to serve its responses from the cache
+DEFAULT_TEMPERATURE = 1
+
+# Defaults of the response cache, overridable through the secrets
+RESPONSE_CACHE_PATH = "data/llm_response_cache.sqlite"
+DEFAULT_RESPONSE_CACHE_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_RESPONSE_CACHE_TTL = 7 * 24 * 3600
+
+
+def get_response_key(backend, model, temperature, text, inputs):
+    """
+    Function to get the cache key of a request to the model.
+
+    Args:
+    backend (str): The type of the LLM.
+    model (str): The name of the model.
+    temperature (float): The sampling temperature, None when the backend default is used.
+    text (str): The filled prompt.
+    inputs (dict): The values of the variables of the prompt.
+
+    Returns:
+    str: The hex digest identifying the response.
+    """
+    payload = json.dumps([backend, model, temperature, text, inputs or {}], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache of the responses of the model kept in a SQLite file shared by all the sessions.
+
+    Responses older than ttl seconds are never served. Once the responses take more than
+    max_bytes, the least recently used ones are evicted.
+
+    Attributes:
+    path (str): The path of the SQLite file.
+    max_bytes (int): The maximum total size of the cached responses.
+    ttl (float): The number of seconds a response is served for.
+    hits (int): The number of requests served from the cache.
+    misses (int): The number of requests not in the cache.
+    """
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_bytes=DEFAULT_RESPONSE_CACHE_MAX_BYTES,
+                 ttl=DEFAULT_RESPONSE_CACHE_TTL):
+        """
+        The constructor for the ResponseCache class.
+
+        Args:
+        path (str): The path of the SQLite file.
+        max_bytes (int): The maximum total size of the cached responses.
+        ttl (float): The number of seconds a response is served for.
+        """
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @contextmanager
+    def _connect(self):
+        """
+        Function to open a connection to the cache, one per call so that threads never share one.
+
+        Yields:
+        sqlite3.Connection: The connection, committed and closed on exit.
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """
+        Function to look up a cached response.
+
+        Args:
+        key (str): The cache key of the request.
+
+        Returns:
+        str: The cached response, or None on a miss.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, response):
+        """
+        Function to cache a response, evicting the expired and least recently used ones beyond max_bytes.
+
+        Args:
+        key (str): The cache key of the request.
+        response (str): The response.
+        """
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses (key, response, size, created, accessed) "
+                         "VALUES (?, ?, ?, ?, ?)", (key, response, size, now, now))
+            conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            excess = (conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]) - self.max_bytes
+            if excess > 0:
+                evicted = []
+                for evicted_key, evicted_size in conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                    if excess <= 0:
+                        break
+                    evicted.append((evicted_key,))
+                    excess -= evicted_size
+                conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+                logger.debug(f"Evicted {len(evicted)} responses from the response cache")
+
+    def stats(self):
+        """
+        Function to get the statistics of the cache.
+
+        Returns:
+        dict: The entries, size, hits, misses and hit rate.
+        """
+        with self._connect() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        with self._lock:
+            total = self.hits + self.misses
+            return {"entries": entries, "bytes": size, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Function to get the process-wide response cache.
+
+    The cache is off unless LLM_RESPONSE_CACHE is set, and is configured with the
+    LLM_RESPONSE_CACHE_PATH, LLM_RESPONSE_CACHE_MAX_BYTES and LLM_RESPONSE_CACHE_TTL secrets.
+
+    Returns:
+    ResponseCache: The cache, or None when it is off.
+    """
+    global _response_cache
+    if not st.secrets.get("LLM_RESPONSE_CACHE", False):
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                st.secrets.get("LLM_RESPONSE_CACHE_PATH", RESPONSE_CACHE_PATH),
+                max_bytes=st.secrets.get("LLM_RESPONSE_CACHE_MAX_BYTES", DEFAULT_RESPONSE_CACHE_MAX_BYTES),
+                ttl=st.secrets.get("LLM_RESPONSE_CACHE_TTL", DEFAULT_RESPONSE_CACHE_TTL),
+            )
+        return _response_cache
 
 
 # Singleton class for LLM
@@ -20,45 +208,213 @@ class LLM:
 
     Attributes:
     config: Configuration for the LLM
-    llm: ChatOpenAI object for the LLM
+    llm: ChatOpenAI object for the LLM, or the LLMRouter between chatgpt and gemini when the type is auto
 
     Methods:
     get_response(prompt) - get the response from the LLM
+    get_responses(requests) - get the responses to many prompts concurrently
+    cache_stats() - get the statistics of the response cache
+    router_stats() - get the latencies and errors of the providers when the type is auto
     """
     def __init__(self, llm="chatgpt"):
         self.llm_type = llm
+        self.model_name = None
+        self.temperature = None
         if llm=="chatgpt":
-            self.llm = ChatOpenAI(model=st.secrets["OPENAI_MODEL"], 
-                              temperature=1, 
-                              api_key=st.secrets["OPENAI_KEY"])
+            self.model_name = st.secrets["OPENAI_MODEL"]
+            self.temperature = st.secrets.get("LLM_TEMPERATURE", DEFAULT_TEMPERATURE)
+            self.llm = get_chat_model(st.secrets["OPENAI_KEY"], self.model_name, self.temperature)
         elif llm=="gemini":
+            self.model_name = "gemini-pro"
             gemini.configure(api_key=st.secrets["GEMINI_API_KEY"])
-            self.llm = gemini.GenerativeModel(model_name = "gemini-pro")
+            self.llm = gemini.GenerativeModel(model_name = self.model_name)
+        elif llm=="auto":
+            self.model_name = "auto"
+            self.llm = self._create_router()
 
     def change_llm_type(self, llm_type):
         self.llm_type = llm_type
+        self.model_name = None
+        self.temperature = None
         if llm_type=="chatgpt":
-            self.llm = ChatOpenAI(model=st.secrets["OPENAI_MODEL"], 
-                              temperature=1, 
-                              api_key=st.secrets["OPENAI_KEY"])
+            self.model_name = st.secrets["OPENAI_MODEL"]
+            self.temperature = st.secrets.get("LLM_TEMPERATURE", DEFAULT_TEMPERATURE)
+            self.llm = get_chat_model(st.secrets["OPENAI_KEY"], self.model_name, self.temperature)
         elif llm_type=="gemini":
+            self.model_name = "gemini-pro"
             gemini.configure(api_key=st.secrets["GEMINI_API_KEY"])
-            self.llm = gemini.GenerativeModel(model_name = "gemini-pro")
-        
-    def get_response(self, prompt, inputs=None):
-        # Create the chain
+            self.llm = gemini.GenerativeModel(model_name = self.model_name)
+        elif llm_type=="auto":
+            self.model_name = "auto"
+            self.llm = self._create_router()
+
+    @staticmethod
+    def _create_router():
+        """
+        Function to create the router sending every request to the fastest healthy of chatgpt and gemini.
+
+        Returns:
+        LLMRouter: The router.
+        """
+        chat_model = get_chat_model(st.secrets["OPENAI_KEY"], st.secrets["OPENAI_MODEL"],
+                                    temperature=st.secrets.get("LLM_TEMPERATURE", DEFAULT_TEMPERATURE))
+        gemini.configure(api_key=st.secrets["GEMINI_API_KEY"])
+        gemini_model = gemini.GenerativeModel(model_name="gemini-pro")
+        return LLMRouter({
+            "chatgpt": lambda text: chat_model.invoke(text).content,
+            "gemini": lambda text: gemini_model.generate_content(text).text,
+        }, **get_router_options())
+
+    @staticmethod
+    def _render(prompt, inputs=None):
+        """
+        Function to fill a prompt with its inputs.
+
+        Args:
+        prompt (PromptTemplate): The prompt.
+        inputs (dict): The values of the variables of the prompt.
+
+        Returns:
+        str: The text sent to the model.
+        """
+        return prompt.invoke(inputs or {}).to_string()
+
+    def _generate(self, text):
+        """
+        Function to get the response of the model to a filled prompt.
+
+        Args:
+        text (str): The filled prompt.
+
+        Returns:
+        str: The response.
+        """
         if self.llm_type=="chatgpt":
-            chain = LLMChain(llm=self.llm, prompt=prompt)
-            print("Prompt", prompt)
-            print("Chain", chain)
-            response = chain.invoke(input=inputs)['text']
-            print("Invocation", chain.invoke(input=inputs))
-            print("Response", response)
-            return response
+            return self.llm.invoke(text).content
         elif self.llm_type=="gemini":
-            if inputs is None:
-                inputs = {}
-            response = self.llm.generate_content(
-                prompt.invoke(inputs).to_string(),
-            )
-            return response.text
+            return self.llm.generate_content(text).text
+        elif self.llm_type=="auto":
+            return self.llm.generate(text)
+        raise ValueError(f"Unknown LLM type {self.llm_type}")
+
+    def _get_cache(self, cache=None):
+        """
+        Function to get the response cache usable for a request.
+
+        Args:
+        cache (bool): Whether to use the cache. By default it is only used when the temperature is
+            zero, as sampled responses would otherwise all be the same. False never uses it.
+
+        Returns:
+        ResponseCache: The cache, or None when the request must reach the model.
+        """
+        if cache is False or (cache is None and self.temperature != 0):
+            return None
+        return get_response_cache()
+
+    def _generate_cached(self, text, inputs=None, cache=None):
+        """
+        Function to get the response of the model to a filled prompt, through the response cache when allowed.
+
+        Args:
+        text (str): The filled prompt.
+        inputs (dict): The values of the variables of the prompt.
+        cache (bool): Whether to use the response cache, see _get_cache.
+
+        Returns:
+        str: The response.
+        """
+        response_cache = self._get_cache(cache)
+        if response_cache is None:
+            return self._generate(text)
+        key = get_response_key(self.llm_type, self.model_name, self.temperature, text, inputs)
+        response = response_cache.get(key)
+        if response is None:
+            response = self._generate(text)
+            response_cache.put(key, response)
+        return response
+
+    def get_response(self, prompt, inputs=None, cache=None):
+        """
+        Function to get the response of the model to a prompt.
+
+        Args:
+        prompt (PromptTemplate): The prompt.
+        inputs (dict): The values of the variables of the prompt.
+        cache (bool): Whether to use the response cache. By default it is only used when the
+            temperature is zero, i.e. for the chatgpt type with LLM_TEMPERATURE set to 0, never for
+            the gemini and auto types whose temperature is unset. True opts in with any type and
+            temperature, False never uses it.
+
+        Returns:
+        str: The response.
+        """
+        text = self._render(prompt, inputs)
+        logger.debug(f"Prompt sent to {self.llm_type}: {text}")
+        response = self._generate_cached(text, inputs, cache)
+        logger.debug(f"Response of {self.llm_type}: {response}")
+        return response
+
+    def get_responses(self, requests, cache=None):
+        """
+        Function to get the responses of the model to many prompts concurrently.
+
+        Requests filling their prompt into the same text are sent only once and share the
+        response. The requests run on a pool of LLM_MAX_CONCURRENCY threads shared by the whole
+        process, and a failed request does not fail the others.
+
+        Args:
+        requests (list): The (prompt, inputs) pairs, inputs being a dict or None.
+        cache (bool): Whether to use the response cache, as in get_response.
+
+        Returns:
+        list: The response of every request in the order of the requests, or the exception
+            raised by the request when it failed.
+        """
+        texts = []
+        inputs_of = {}
+        for prompt, inputs in requests:
+            try:
+                texts.append(self._render(prompt, inputs))
+                inputs_of.setdefault(texts[-1], inputs)
+            except Exception as e:
+                texts.append(e)
+
+        futures = {}
+        for text in texts:
+            if isinstance(text, str) and text not in futures:
+                futures[text] = _executor.submit(contextvars.copy_context().run, self._generate_cached, text,
+                                                inputs_of[text], cache)
+        logger.info(f"Generating {len(futures)} responses for {len(texts)} requests with {self.llm_type}")
+
+        responses = []
+        for i, text in enumerate(texts):
+            if isinstance(text, Exception):
+                logger.warning(f"Could not fill the prompt of request {i}: {text}")
+                responses.append(text)
+                continue
+            try:
+                responses.append(futures[text].result())
+            except Exception as e:
+                logger.warning(f"Could not get the response of request {i}: {e}")
+                responses.append(e)
+        return responses
+
+    def cache_stats(self):
+        """
+        Function to get the statistics of the response cache.
+
+        Returns:
+        dict: The entries, size, hits, misses and hit rate, or None when the cache is off.
+        """
+        response_cache = get_response_cache()
+        return response_cache.stats() if response_cache is not None else None
+
+    def router_stats(self):
+        """
+        Function to get the statistics of the router.
+
+        Returns:
+        dict: The latencies, error rates and health of the providers, or None when the type is not auto.
+        """
+        return self.llm.stats() if self.llm_type=="auto" else None
@@ -0,0 +1,310 @@
+# Import the required libraries
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import streamlit as st
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Defaults of the router, overridable through the secrets
+DEFAULT_WINDOW = 100
+DEFAULT_MAX_ERROR_RATE = 0.5
+DEFAULT_COOLDOWN = 30.0
+DEFAULT_HEDGE_QUANTILE = 0.95
+DEFAULT_MIN_HEDGE_DELAY = 0.5
+
+# Delay before hedging a provider without any latency measured yet
+DEFAULT_HEDGE_DELAY = 5.0
+
+# Consecutive failures taking a provider out of the rotation, and the samples needed to trust its error rate
+MAX_CONSECUTIVE_FAILURES = 3
+MIN_SAMPLES = 5
+
+# Thread pool running the provider calls, separate from the batch pool of LLM so that a batch
+# waiting on its requests can never starve them
+_executor = ThreadPoolExecutor(max_workers=st.secrets.get("LLM_ROUTER_THREADS", 16), thread_name_prefix="llm-router")
+
+
+class ProviderStats:
+    """
+    Rolling latencies and outcomes of the calls to one provider.
+
+    A provider is taken out of the rotation for cooldown seconds after MAX_CONSECUTIVE_FAILURES
+    failures in a row, or when the error rate of its last calls exceeds max_error_rate.
+
+    Attributes:
+    name (str): The name of the provider.
+    max_error_rate (float): The error rate above which the provider is taken out of the rotation.
+    cooldown (float): The seconds a failing provider stays out of the rotation.
+    calls (int): The number of calls made to the provider.
+    down_until (float): The time until which the provider is out of the rotation.
+    """
+    def __init__(self, name, window=DEFAULT_WINDOW, max_error_rate=DEFAULT_MAX_ERROR_RATE, cooldown=DEFAULT_COOLDOWN):
+        """
+        The constructor for the ProviderStats class.
+
+        Args:
+        name (str): The name of the provider.
+        window (int): The number of calls kept.
+        max_error_rate (float): The error rate above which the provider is taken out of the rotation.
+        cooldown (float): The seconds a failing provider stays out of the rotation.
+        """
+        self.name = name
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.calls = 0
+        self.down_until = 0.0
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self._failures = 0
+
+    def observe(self, seconds, failed):
+        """
+        Function to record a finished call, called with the lock of the router held.
+
+        Args:
+        seconds (float): The duration of the call.
+        failed (bool): Whether the call raised.
+        """
+        self.calls += 1
+        self._outcomes.append(failed)
+        if not failed:
+            self._latencies.append(seconds)
+            self._failures = 0
+            return
+        self._failures += 1
+        if self._failures >= MAX_CONSECUTIVE_FAILURES or \
+                (len(self._outcomes) >= MIN_SAMPLES and self.error_rate() > self.max_error_rate):
+            self.down_until = time.monotonic() + self.cooldown
+            self._failures = 0
+            self._outcomes.clear()
+            logger.warning(f"Provider {self.name} is failing, taking it out of the rotation for {self.cooldown}s")
+
+    def healthy(self):
+        """
+        Function to check whether the provider is in the rotation.
+
+        Returns:
+        bool: Whether the provider is healthy.
+        """
+        return time.monotonic() >= self.down_until
+
+    def error_rate(self):
+        """
+        Function to get the share of the last calls that failed.
+
+        Returns:
+        float: The error rate.
+        """
+        return sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0
+
+    def quantile(self, q, default=0.0):
+        """
+        Function to get a quantile of the latency of the last successful calls.
+
+        Args:
+        q (float): The quantile.
+        default (float): The value returned before any successful call.
+
+        Returns:
+        float: The latency in seconds.
+        """
+        return float(np.quantile(self._latencies, q)) if self._latencies else default
+
+
+class LLMRouter:
+    """
+    Functionality to send each request to the fastest healthy provider.
+
+    Providers are ranked by the median latency of their last calls, unmeasured ones first so
+    that they get measured. When hedging is on and the chosen provider has not answered after
+    the hedge_quantile of its latency, the request is also sent to the next provider and the
+    first response wins. A failed call fails over to the next provider until one answers.
+
+    Attributes:
+    providers (dict): The functions returning the response to a filled prompt by provider name.
+    hedge (bool): Whether slow requests are duplicated to a second provider.
+    hedge_quantile (float): The quantile of the latency after which a request is hedged.
+    min_hedge_delay (float): The minimum seconds before hedging a request.
+    hedges (int): The number of hedged requests.
+    hedge_wins (int): The number of hedged requests answered by the duplicate.
+    failovers (int): The number of calls retried on another provider after an error.
+    """
+    def __init__(self, providers, hedge=True, hedge_quantile=DEFAULT_HEDGE_QUANTILE,
+                 min_hedge_delay=DEFAULT_MIN_HEDGE_DELAY, window=DEFAULT_WINDOW,
+                 max_error_rate=DEFAULT_MAX_ERROR_RATE, cooldown=DEFAULT_COOLDOWN):
+        """
+        The constructor for the LLMRouter class.
+
+        Args:
+        providers (dict): The functions returning the response to a filled prompt by provider name.
+        hedge (bool): Whether slow requests are duplicated to a second provider.
+        hedge_quantile (float): The quantile of the latency after which a request is hedged.
+        min_hedge_delay (float): The minimum seconds before hedging a request.
+        window (int): The number of calls kept per provider.
+        max_error_rate (float): The error rate above which a provider is taken out of the rotation.
+        cooldown (float): The seconds a failing provider stays out of the rotation.
+        """
+        if not providers:
+            raise ValueError("The router needs at least one provider")
+        self.providers = dict(providers)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self._stats = {name: ProviderStats(name, window, max_error_rate, cooldown) for name in self.providers}
+        self._lock = threading.Lock()
+
+    def rank(self):
+        """
+        Function to order the providers from the one to try first to the last resort.
+
+        Returns:
+        list: The names of the providers, healthy ones by median latency then the others.
+        """
+        with self._lock:
+            return sorted(self.providers,
+                          key=lambda name: (not self._stats[name].healthy(), self._stats[name].quantile(0.5)))
+
+    def _hedge_delay(self, name):
+        """
+        Function to get the seconds to wait for a provider before hedging.
+
+        Args:
+        name (str): The name of the provider.
+
+        Returns:
+        float: The delay.
+        """
+        with self._lock:
+            return max(self.min_hedge_delay, self._stats[name].quantile(self.hedge_quantile, DEFAULT_HEDGE_DELAY))
+
+    def _call(self, name, text):
+        """
+        Function to call a provider and record its latency and outcome, run on the router pool.
+
+        Args:
+        name (str): The name of the provider.
+        text (str): The filled prompt.
+
+        Returns:
+        str: The response.
+        """
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = self.providers[name](text)
+            failed = False
+            return response
+        finally:
+            with self._lock:
+                self._stats[name].observe(time.perf_counter() - start, failed)
+
+    def _submit(self, name, text):
+        return _executor.submit(contextvars.copy_context().run, self._call, name, text)
+
+    def generate(self, text):
+        """
+        Function to get the response of the fastest healthy provider to a filled prompt.
+
+        Args:
+        text (str): The filled prompt.
+
+        Returns:
+        str: The first successful response.
+
+        Raises:
+        Exception: The error of the last provider tried when they all failed.
+        """
+        pending = self.rank()
+        primary = pending[0]
+        running = {}
+        hedge_at = None
+        hedged = False
+        error = None
+
+        def start():
+            nonlocal hedge_at
+            name = pending.pop(0)
+            running[self._submit(name, text)] = name
+            hedge_at = time.monotonic() + self._hedge_delay(name) if self.hedge and pending else None
+            return name
+
+        start()
+        while running:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # The provider is slower than usual, race it against the next one
+                name = start()
+                hedge_at = None
+                hedged = True
+                with self._lock:
+                    self.hedges += 1
+                logger.debug(f"Hedging a slow request with provider {name}")
+                continue
+
+            for future in done:
+                name = running.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = e
+                    logger.warning(f"Provider {name} failed: {e}")
+                    continue
+                if hedged and name != primary:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return response
+
+            if not running and pending:
+                name = start()
+                with self._lock:
+                    self.failovers += 1
+                logger.info(f"Failing over to provider {name}")
+        raise error
+
+    def stats(self):
+        """
+        Function to get the statistics of the router.
+
+        Returns:
+        dict: The calls, p50 and p95 latencies in milliseconds, error rate and health by provider,
+            and the hedge and failover counts.
+        """
+        with self._lock:
+            return {
+                "providers": {name: {"calls": stats.calls,
+                                     "p50": round(stats.quantile(0.5) * 1000, 2),
+                                     "p95": round(stats.quantile(0.95) * 1000, 2),
+                                     "error_rate": round(stats.error_rate(), 4),
+                                     "healthy": stats.healthy()}
+                              for name, stats in self._stats.items()},
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "failovers": self.failovers,
+            }
+
+
+def get_router_options():
+    """
+    Function to get the options of the router from the secrets.
+
+    Returns:
+    dict: The keyword arguments of LLMRouter besides the providers.
+    """
+    return {
+        "hedge": st.secrets.get("LLM_ROUTER_HEDGE", True),
+        "hedge_quantile": st.secrets.get("LLM_ROUTER_HEDGE_QUANTILE", DEFAULT_HEDGE_QUANTILE),
+        "min_hedge_delay": st.secrets.get("LLM_ROUTER_MIN_HEDGE_DELAY", DEFAULT_MIN_HEDGE_DELAY),
+        "window": st.secrets.get("LLM_ROUTER_WINDOW", DEFAULT_WINDOW),
+        "max_error_rate": st.secrets.get("LLM_ROUTER_MAX_ERROR_RATE", DEFAULT_MAX_ERROR_RATE),
+        "cooldown": st.secrets.get("LLM_ROUTER_COOLDOWN", DEFAULT_COOLDOWN),
+    }
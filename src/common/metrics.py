@@ -0,0 +1,340 @@
+# Import the required libraries
+import json
+import time
+import logging
+import threading
+import contextvars
+from pathlib import Path
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+import numpy as np
+import streamlit as st
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Defaults of the metrics, overridable through the secrets
+DEFAULT_METRICS_PATH = "logs/metrics.jsonl"
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_WINDOW = 1000
+DEFAULT_SUMMARY_EVERY = 100
+
+# Quantiles of the latency summaries
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Trace of the question being answered, set on the threads working on it
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """
+    Timings and counters of the answer to one question.
+
+    Stages are timed with span, possibly from several threads at once, and counters such as
+    token counts or cache results are set with record. The trace is exported when finished.
+
+    Attributes:
+    course (str): The code of the course.
+    spans (list): The (stage, seconds) of every timed stage, in the order they ended.
+    values (dict): The recorded counters by name.
+    """
+    def __init__(self, course):
+        """
+        The constructor for the Trace class.
+
+        Args:
+        course (str): The code of the course.
+        """
+        self.course = course
+        self.spans = []
+        self.values = {}
+        self._started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Function to time a stage of the answer.
+
+        Args:
+        stage (str): The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.spans.append((stage, time.perf_counter() - start))
+
+    def record(self, name, value):
+        """
+        Function to record a counter of the answer.
+
+        Args:
+        name (str): The name of the counter.
+        value: The value, a number or a short string.
+        """
+        with self._lock:
+            self.values[name] = value
+
+    def elapsed(self):
+        """
+        Function to get the time since the trace started.
+
+        Returns:
+        float: The elapsed time in seconds.
+        """
+        return time.perf_counter() - self._start
+
+    def activate(self):
+        """
+        Function to make this trace the current one of the running context, e.g. of an asyncio task.
+        """
+        _current_trace.set(self)
+
+    def finish(self):
+        """
+        Function to end the trace and export it.
+        """
+        with self._lock:
+            self.spans.append(("total", self.elapsed()))
+        get_metrics().observe(self)
+
+    def to_dict(self):
+        """
+        Function to get the trace as a metrics record.
+
+        Returns:
+        dict: The record.
+        """
+        with self._lock:
+            return {
+                "type": "trace",
+                "time": round(self._started, 3),
+                "course": self.course,
+                "spans": [{"stage": stage, "ms": round(seconds * 1000, 2)} for stage, seconds in self.spans],
+                **self.values,
+            }
+
+
+@contextmanager
+def span(stage):
+    """
+    Function to time a stage of the current question, doing nothing outside of a trace.
+
+    Args:
+    stage (str): The name of the stage.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(stage):
+        yield
+
+
+def record(name, value):
+    """
+    Function to record a counter of the current question, doing nothing outside of a trace.
+
+    Args:
+    name (str): The name of the counter.
+    value: The value, a number or a short string.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(name, value)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRecorder:
+    """
+    Process-wide sink of the traces.
+
+    Every trace is appended as one JSON line to a rotating metrics file. The latencies of the
+    last window traces are kept per course and stage to compute their p50, p95 and p99, which
+    are written to the file every summary_every traces and served in the Prometheus text format.
+
+    Attributes:
+    window (int): The number of latencies kept per course and stage.
+    summary_every (int): The number of traces between two summaries in the file.
+    """
+    def __init__(self, path=DEFAULT_METRICS_PATH, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT,
+                 window=DEFAULT_WINDOW, summary_every=DEFAULT_SUMMARY_EVERY):
+        """
+        The constructor for the MetricsRecorder class.
+
+        Args:
+        path (str): The path of the metrics file.
+        max_bytes (int): The size at which the metrics file is rotated.
+        backup_count (int): The number of rotated metrics files kept.
+        window (int): The number of latencies kept per course and stage.
+        summary_every (int): The number of traces between two summaries in the file.
+        """
+        self.window = window
+        self.summary_every = summary_every
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._totals = defaultdict(lambda: [0, 0.0])
+        self._counters = defaultdict(int)
+        self._traces = 0
+        self._collectors = []
+        self._lock = threading.Lock()
+
+        # Dedicated logger, so that the metrics lines do not end up in the app log
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._file = logging.getLogger(f"AlgoAudit-Metrics-{path}")
+        self._file.setLevel(logging.INFO)
+        self._file.propagate = False
+        if not self._file.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._file.addHandler(handler)
+
+    def observe(self, trace):
+        """
+        Function to record a finished trace.
+
+        Args:
+        trace (Trace): The trace.
+        """
+        record = trace.to_dict()
+        with self._lock:
+            for item in record["spans"]:
+                key = (trace.course, item["stage"])
+                self._latencies[key].append(item["ms"] / 1000)
+                self._totals[key][0] += 1
+                self._totals[key][1] += item["ms"] / 1000
+            for name, value in record.items():
+                if name.endswith("_cache"):
+                    self._counters[(trace.course, name, value)] += 1
+            self._traces += 1
+            write_summary = self.summary_every and self._traces % self.summary_every == 0
+        self._file.info(json.dumps(record))
+        if write_summary:
+            self._file.info(json.dumps({"type": "summary", "time": round(time.time(), 3), "courses": self.summary()}))
+
+    def add_collector(self, collector):
+        """
+        Function to add metrics of another component to the Prometheus endpoint.
+
+        Args:
+        collector (callable): Function returning the lines of the metrics in the Prometheus text format.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def summary(self):
+        """
+        Function to get the latency percentiles of the last traces.
+
+        Returns:
+        dict: The count, p50, p95 and p99 in milliseconds by course and stage.
+        """
+        with self._lock:
+            latencies = {key: np.array(values) for key, values in self._latencies.items()}
+        summary = defaultdict(dict)
+        for (course, stage), values in sorted(latencies.items()):
+            percentiles = np.quantile(values, QUANTILES) * 1000
+            summary[course][stage] = {"count": len(values),
+                                      **{f"p{int(q * 100)}": round(float(p), 2) for q, p in zip(QUANTILES, percentiles)}}
+        return dict(summary)
+
+    def render_prometheus(self):
+        """
+        Function to render the metrics in the Prometheus text format.
+
+        Returns:
+        str: The metrics.
+        """
+        with self._lock:
+            latencies = {key: np.array(values) for key, values in self._latencies.items()}
+            totals = {key: list(value) for key, value in self._totals.items()}
+            counters = dict(self._counters)
+            collectors = list(self._collectors)
+
+        lines = ["# HELP qucopilot_stage_seconds Latency of the stages of the QuCopilot answers.",
+                 "# TYPE qucopilot_stage_seconds summary"]
+        for (course, stage), values in sorted(latencies.items()):
+            labels = f'course="{_escape_label(course)}",stage="{_escape_label(stage)}"'
+            for q, value in zip(QUANTILES, np.quantile(values, QUANTILES)):
+                lines.append(f'qucopilot_stage_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+            lines.append(f"qucopilot_stage_seconds_sum{{{labels}}} {totals[(course, stage)][1]:.6f}")
+            lines.append(f"qucopilot_stage_seconds_count{{{labels}}} {totals[(course, stage)][0]}")
+
+        lines += ["# HELP qucopilot_cache_total Cache lookups of the QuCopilot answers by result.",
+                  "# TYPE qucopilot_cache_total counter"]
+        for (course, cache, result), count in sorted(counters.items(), key=lambda item: tuple(map(str, item[0]))):
+            lines.append(f'qucopilot_cache_total{{course="{_escape_label(course)}",cache="{_escape_label(cache)}",'
+                         f'result="{_escape_label(result)}"}} {count}')
+        for collector in collectors:
+            try:
+                lines += collector()
+            except Exception as e:
+                logger.warning(f"Could not collect the metrics of {collector}: {e}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """
+        Function to serve the metrics in the Prometheus text format on a local port, from a daemon thread.
+
+        Args:
+        port (int): The port.
+        """
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = recorder.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Serving the metrics on http://127.0.0.1:{port}/metrics")
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Function to get the process-wide metrics recorder.
+
+    The file is configured with the METRICS_PATH, METRICS_MAX_BYTES and METRICS_BACKUP_COUNT
+    secrets, and the Prometheus endpoint is served when METRICS_PORT is set.
+
+    Returns:
+    MetricsRecorder: The recorder.
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRecorder(
+                st.secrets.get("METRICS_PATH", DEFAULT_METRICS_PATH),
+                max_bytes=st.secrets.get("METRICS_MAX_BYTES", DEFAULT_MAX_BYTES),
+                backup_count=st.secrets.get("METRICS_BACKUP_COUNT", DEFAULT_BACKUP_COUNT),
+                window=st.secrets.get("METRICS_WINDOW", DEFAULT_WINDOW),
+                summary_every=st.secrets.get("METRICS_SUMMARY_EVERY", DEFAULT_SUMMARY_EVERY),
+            )
+            port = st.secrets.get("METRICS_PORT", 0)
+            if port:
+                try:
+                    _metrics.serve(port)
+                except OSError as e:
+                    logger.warning(f"Could not serve the metrics on port {port}: {e}")
+        return _metrics
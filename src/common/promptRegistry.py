@@ -0,0 +1,181 @@
+# Import the required libraries
+import os
+import json
+import threading
+from langchain.prompts import PromptTemplate, ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain.output_parsers import StructuredOutputParser
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Default location of the prompts
+PROMPTS_PATH = "data/prompts.json"
+
+
+class PromptRegistry:
+    """
+    Process-wide cache of the prompts and of the templates compiled from them.
+
+    The prompts file is parsed once, and every template is built once per set of arguments.
+    The file's modification time is checked on every lookup, and everything is reloaded when
+    it changed, so prompts can be edited without restarting the app.
+
+    Attributes:
+    path (str): The path of the prompts file.
+    version (int): The modification time of the loaded file in nanoseconds, it changes on every reload.
+    """
+    def __init__(self, path=PROMPTS_PATH):
+        """
+        The constructor for the PromptRegistry class.
+
+        Args:
+        path (str): The path of the prompts file.
+        """
+        self.path = path
+        self.version = None
+        self._prompts = {}
+        self._templates = {}
+        self._output_parsers = {}
+        self._load_error = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """
+        Function to reload the prompts when the file changed on disk, called with the lock held.
+
+        A file that cannot be read or parsed leaves the loaded prompts and their version in place.
+        """
+        try:
+            version = os.stat(self.path).st_mtime_ns
+            if version == self.version:
+                return
+            with open(self.path, "r") as f:
+                prompts = json.load(f)
+        except (OSError, ValueError) as e:
+            # Keep serving the last good prompts, e.g. while the file is being saved, and retry on the next lookup
+            if self.version is None:
+                raise
+            if str(e) != self._load_error:
+                logger.error(f"Could not reload the prompts file {self.path}, keeping the loaded prompts: {e}")
+                self._load_error = str(e)
+            return
+        if self.version is not None:
+            logger.info(f"Prompts file {self.path} changed, reloading the prompts")
+        self._prompts = prompts
+        self._load_error = None
+        self._templates.clear()
+        self.version = version
+
+    def get_version(self):
+        """
+        Function to get the version of the prompts, reloading them when the file changed.
+
+        Returns:
+        int: The version of the prompts.
+        """
+        with self._lock:
+            self._refresh()
+            return self.version
+
+    def get_text(self, name):
+        """
+        Function to get the raw text of a prompt.
+
+        Args:
+        name (str): The name of the prompt.
+
+        Returns:
+        str: The text of the prompt.
+        """
+        with self._lock:
+            self._refresh()
+            return self._prompts[name]
+
+    def _get_template(self, key, build):
+        """
+        Function to get a compiled template, building it on the first request.
+
+        Args:
+        key (tuple): The cache key of the template, its first item is the name of the prompt.
+        build (callable): Function building the template from the text of the prompt.
+
+        Returns:
+        The compiled template.
+        """
+        with self._lock:
+            self._refresh()
+            template = self._templates.get(key)
+            if template is None:
+                template = self._templates[key] = build(self._prompts[key[0]])
+            return template
+
+    def get_prompt(self, name, input_variables):
+        """
+        Function to get the PromptTemplate of a prompt.
+
+        Args:
+        name (str): The name of the prompt.
+        input_variables (list): The input variables of the template.
+
+        Returns:
+        PromptTemplate: The compiled template.
+        """
+        return self._get_template((name, "prompt", tuple(input_variables)),
+                                  lambda text: PromptTemplate(template=text, input_variables=list(input_variables)))
+
+    def get_chat_prompt(self, name, input_variables, suffix="", partial_variables=None):
+        """
+        Function to get the single message ChatPromptTemplate of a prompt.
+
+        Args:
+        name (str): The name of the prompt.
+        input_variables (list): The input variables of the template.
+        suffix (str): Text appended to the prompt, e.g. the document link of the course.
+        partial_variables (dict): The variables filled in once, e.g. the format instructions.
+
+        Returns:
+        ChatPromptTemplate: The compiled template.
+        """
+        partial_variables = partial_variables or {}
+        key = (name, "chat", tuple(input_variables), suffix, tuple(sorted(partial_variables.items())))
+        return self._get_template(key, lambda text: ChatPromptTemplate(
+            messages=[HumanMessagePromptTemplate.from_template(text + suffix)],
+            input_variables=list(input_variables),
+            partial_variables=partial_variables
+        ))
+
+    def get_output_parser(self, response_schemas):
+        """
+        Function to get the structured output parser of a list of response schemas and its format instructions.
+
+        Args:
+        response_schemas (list): The ResponseSchemas of the output.
+
+        Returns:
+        tuple: The StructuredOutputParser and its format instructions.
+        """
+        key = tuple((schema.name, schema.description, schema.type) for schema in response_schemas)
+        with self._lock:
+            if key not in self._output_parsers:
+                output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
+                self._output_parsers[key] = (output_parser, output_parser.get_format_instructions())
+            return self._output_parsers[key]
+
+
+_prompt_registry = None
+_prompt_registry_lock = threading.Lock()
+
+
+def get_prompt_registry():
+    """
+    Function to get the process-wide prompt registry.
+
+    Returns:
+    PromptRegistry: The registry.
+    """
+    global _prompt_registry
+    with _prompt_registry_lock:
+        if _prompt_registry is None:
+            _prompt_registry = PromptRegistry()
+        return _prompt_registry
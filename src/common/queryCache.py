@@ -0,0 +1,259 @@
+# Import the required libraries
+import re
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from src.common.metrics import span
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Defaults for the cache, overridable through the secrets
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_TTL_SECONDS = 6 * 60 * 60
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+
+# Number of query embeddings kept by MemoizedQueryEmbeddings
+QUERY_EMBEDDING_MEMO_SIZE = 256
+
+_WHITESPACE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = re.compile(r"^[\W_]+|[\W_]+$")
+
+
+def normalize_query(query):
+    """
+    Function to normalize a query for exact cache lookups.
+
+    Args:
+    query (str): The query.
+
+    Returns:
+    str: The lower-cased query with collapsed whitespace and no leading or trailing punctuation.
+    """
+    return _EDGE_PUNCTUATION.sub("", _WHITESPACE.sub(" ", query.lower()).strip())
+
+
+class MemoizedQueryEmbeddings(Embeddings):
+    """
+    Embeddings wrapper remembering the most recent query embeddings, so that a query is embedded
+    once for both the cache lookup and the dense search. Concurrent requests for the same query
+    share the call in flight.
+
+    Attributes:
+    embeddings: The wrapped embeddings.
+    """
+    def __init__(self, embeddings, size=QUERY_EMBEDDING_MEMO_SIZE):
+        """
+        The constructor for the MemoizedQueryEmbeddings class.
+
+        Args:
+        embeddings: The wrapped embeddings.
+        size (int): The number of query embeddings to remember.
+        """
+        self.embeddings = embeddings
+        self.size = size
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._lock:
+            future = self._memo.get(text)
+            owner = future is None
+            if owner:
+                future = self._memo[text] = Future()
+                while len(self._memo) > self.size:
+                    self._memo.popitem(last=False)
+            else:
+                self._memo.move_to_end(text)
+
+        if owner:
+            try:
+                with span("query_embedding"):
+                    future.set_result(self.embeddings.embed_query(text))
+            except Exception as e:
+                # Do not remember failures, the next caller retries
+                with self._lock:
+                    if self._memo.get(text) is future:
+                        del self._memo[text]
+                future.set_exception(e)
+        return future.result()
+
+    def clear(self):
+        """
+        Function to forget the remembered query embeddings.
+        """
+        with self._lock:
+            self._memo.clear()
+
+
+class QueryCache:
+    """
+    Cache of reranked retrieval results for one course.
+
+    A query hits the cache when its normalized text was seen before (get), or when the cosine
+    similarity of its embedding with a cached query's is above the similarity threshold (get_similar).
+    Entries expire after ttl seconds and the least recently used ones are evicted beyond
+    max_entries. The whole cache is tied to the build id of the course index and is cleared
+    when it changes.
+
+    Attributes:
+    max_entries (int): The maximum number of cached queries.
+    ttl (float): The lifetime of an entry in seconds.
+    similarity_threshold (float): The cosine similarity above which two queries are the same.
+    hits (int): The number of exact hits.
+    near_hits (int): The number of near-duplicate hits.
+    misses (int): The number of misses.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL_SECONDS,
+                 similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD):
+        """
+        The constructor for the QueryCache class.
+
+        Args:
+        max_entries (int): The maximum number of cached queries.
+        ttl (float): The lifetime of an entry in seconds.
+        similarity_threshold (float): The cosine similarity above which two queries are the same.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        """
+        Function to clear the cache when the index it was filled from changed.
+
+        Args:
+        version (str): The build id of the course index.
+        """
+        if version != self._version:
+            if self._entries:
+                logger.info("Course index changed, clearing the query cache")
+            self._entries.clear()
+            self._version = version
+
+    def _expire(self):
+        """
+        Function to drop the expired entries.
+        """
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry["expires"] <= now]:
+            del self._entries[key]
+
+    def get(self, query, version):
+        """
+        Function to look up the cached result of a query by its normalized text.
+
+        Args:
+        query (str): The query.
+        version (str): The build id of the course index.
+
+        Returns:
+        list: The cached documents, or None on a miss.
+        """
+        key = normalize_query(query)
+        with self._lock:
+            self._check_version(version)
+            self._expire()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]["result"]
+            return None
+
+    def get_similar(self, query, version, vector):
+        """
+        Function to look up the cached result of a near-duplicate query, after get missed.
+
+        Args:
+        query (str): The query.
+        version (str): The build id of the course index.
+        vector (list): The embedding of the query.
+
+        Returns:
+        list: The cached documents of the most similar query above the threshold, or None on a miss.
+        """
+        vector = self._normalize(vector)
+        with self._lock:
+            self._check_version(version)
+            if self._entries:
+                keys = list(self._entries)
+                similarities = np.stack([self._entries[key]["vector"] for key in keys]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.near_hits += 1
+                    return self._entries[keys[best]]["result"]
+            self.misses += 1
+            return None
+
+    def put(self, query, version, result, vector):
+        """
+        Function to cache the result of a query.
+
+        Args:
+        query (str): The query.
+        version (str): The build id of the course index the result comes from.
+        result (list): The reranked documents.
+        vector (list): The embedding of the query, used for the near-duplicate lookup.
+        """
+        key = normalize_query(query)
+        vector = self._normalize(vector)
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = {"result": result, "vector": vector, "expires": time.monotonic() + self.ttl}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Function to empty the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    @staticmethod
+    def _normalize(vector):
+        """
+        Function to scale a vector to unit length.
+
+        Args:
+        vector (list): The vector.
+
+        Returns:
+        np.ndarray: The unit vector.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self):
+        """
+        Function to get the hit counts of the cache.
+
+        Returns:
+        dict: The entries, hits, near-duplicate hits, misses and hit rate.
+        """
+        total = self.hits + self.near_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.near_hits) / total if total else 0.0,
+        }
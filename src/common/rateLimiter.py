@@ -0,0 +1,511 @@
+# Import the required libraries
+import json
+import time
+import asyncio
+import itertools
+import threading
+import contextvars
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Optional, Sequence
+import httpx
+import numpy as np
+import streamlit as st
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import Document
+from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
+from src.common.metrics import get_metrics, span
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Priorities of the requests, interactive chat gets four times the share of the background work
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+PRIORITY_WEIGHTS = {INTERACTIVE: 4.0, BACKGROUND: 1.0}
+
+# Default limits per minute of the house keys, overridable through the secrets, 0 for no limit
+DEFAULT_OPENAI_RPM = 3500
+DEFAULT_OPENAI_TPM = 90000
+DEFAULT_OPENAI_EMBEDDING_RPM = 3000
+DEFAULT_OPENAI_EMBEDDING_TPM = 1000000
+DEFAULT_COHERE_RPM = 1000
+
+# Completion tokens counted against the limits when a request does not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 512
+
+# Characters per token of the estimates
+CHARS_PER_TOKEN = 4
+
+# Number of waits kept per priority for the percentiles
+WAIT_WINDOW = 1000
+
+# Quantiles of the wait summaries
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Session and priority of the requests made by the running context, e.g. of an asyncio task
+_request_class = contextvars.ContextVar("request_class", default=(None, BACKGROUND))
+
+
+def set_request_class(session, priority):
+    """
+    Function to set the session and priority of the requests made by the running context.
+
+    Args:
+    session (str): The identifier of the session the requests are made for.
+    priority (str): INTERACTIVE or BACKGROUND.
+    """
+    _request_class.set((session, priority))
+
+
+@contextmanager
+def request_class(session, priority):
+    """
+    Function to set the session and priority of the requests made within a block.
+
+    Args:
+    session (str): The identifier of the session the requests are made for.
+    priority (str): INTERACTIVE or BACKGROUND.
+    """
+    token = _request_class.set((session, priority))
+    try:
+        yield
+    finally:
+        _request_class.reset(token)
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at a rate per minute, holding at most one minute of it.
+
+    Attributes:
+    per_minute (float): The refill rate per minute, 0 for no limit.
+    tokens (float): The tokens available.
+    """
+    def __init__(self, per_minute):
+        """
+        The constructor for the TokenBucket class.
+
+        Args:
+        per_minute (float): The refill rate per minute, 0 for no limit.
+        """
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    def wait_time(self, cost, now):
+        """
+        Function to get the time until the bucket holds enough tokens for a cost.
+
+        Args:
+        cost (float): The tokens needed, capped to the capacity of the bucket.
+        now (float): The current monotonic time.
+
+        Returns:
+        float: The seconds to wait, 0 when the cost can be taken now.
+        """
+        if not self.per_minute:
+            return 0.0
+        self.tokens = min(self.per_minute, self.tokens + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+        missing = min(cost, self.per_minute) - self.tokens
+        return max(0.0, missing * 60 / self.per_minute)
+
+    def take(self, cost):
+        """
+        Function to take a cost out of the bucket, after wait_time returned 0.
+
+        Args:
+        cost (float): The tokens taken, capped to the capacity of the bucket.
+        """
+        if self.per_minute:
+            self.tokens -= min(cost, self.per_minute)
+
+
+class _Waiter:
+    """
+    Request waiting in the queue of a RequestScheduler.
+    """
+    __slots__ = ("kind", "tokens", "priority", "start", "tag", "seq", "enqueued", "grant", "cancelled")
+
+    def __init__(self, kind, tokens, priority, start, tag, seq, grant):
+        self.kind = kind
+        self.tokens = tokens
+        self.priority = priority
+        self.start = start
+        self.tag = tag
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.grant = grant
+        self.cancelled = False
+
+
+class RequestScheduler:
+    """
+    Process-wide scheduler of the requests made with one API key.
+
+    Every kind of request, e.g. chat or embeddings, has a bucket of requests per minute and one
+    of tokens per minute. Waiting requests are served by start-time fair queuing over the
+    (priority, session) flows: each flow gets a share of the tokens proportional to the weight of
+    its priority, so a session sending many requests cannot starve the others and interactive
+    chat overtakes background index builds without ever blocking them completely. A request
+    waiting on an empty bucket never holds back the requests of the other kinds.
+
+    Attributes:
+    name (str): The name of the scheduler, e.g. the provider.
+    limits (dict): The (requests per minute, tokens per minute) by kind of request, kinds not
+        listed are not limited.
+    """
+    def __init__(self, name, limits):
+        """
+        The constructor for the RequestScheduler class.
+
+        Args:
+        name (str): The name of the scheduler, e.g. the provider.
+        limits (dict): The (requests per minute, tokens per minute) by kind of request.
+        """
+        self.name = name
+        self.limits = dict(limits)
+        self._buckets = {kind: (TokenBucket(rpm), TokenBucket(tpm)) for kind, (rpm, tpm) in self.limits.items()}
+        self._queue = []
+        self._finish = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._granted = defaultdict(int)
+        self._waits = defaultdict(lambda: deque(maxlen=WAIT_WINDOW))
+        self._wait_totals = defaultdict(lambda: [0, 0.0])
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name=f"scheduler-{name}", daemon=True).start()
+
+    def _enqueue(self, kind, tokens, grant):
+        """
+        Function to queue a request of the running context.
+
+        Args:
+        kind (str): The kind of the request.
+        tokens (int): The estimated tokens of the request.
+        grant (callable): Called, with the lock held, once the request may be sent.
+
+        Returns:
+        _Waiter: The queued request.
+        """
+        session, priority = _request_class.get()
+        flow = (priority, session)
+        with self._cond:
+            start = max(self._virtual_time, self._finish.get(flow, 0.0))
+            tag = start + max(tokens, 1) / PRIORITY_WEIGHTS.get(priority, 1.0)
+            self._finish[flow] = tag
+            waiter = _Waiter(kind, tokens, priority, start, tag, next(self._seq), grant)
+            self._queue.append(waiter)
+            self._cond.notify()
+        return waiter
+
+    def acquire(self, kind, tokens):
+        """
+        Function to wait until a request may be sent.
+
+        Args:
+        kind (str): The kind of the request.
+        tokens (int): The estimated tokens of the request.
+        """
+        if kind not in self._buckets:
+            return
+        event = threading.Event()
+        self._enqueue(kind, tokens, event.set)
+        event.wait()
+
+    async def aacquire(self, kind, tokens):
+        """
+        Function to wait until a request may be sent, without blocking the event loop.
+
+        Args:
+        kind (str): The kind of the request.
+        tokens (int): The estimated tokens of the request.
+        """
+        if kind not in self._buckets:
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(kind, tokens, grant)
+        try:
+            await future
+        except asyncio.CancelledError:
+            waiter.cancelled = True
+            raise
+
+    def _dispatch(self):
+        """
+        Function to grant the queued requests their buckets allow, called with the lock held.
+
+        Returns:
+        float: The seconds until a blocked request may be granted, None when the queue is empty.
+        """
+        now = time.monotonic()
+        blocked = {}
+        for waiter in sorted(self._queue, key=lambda waiter: (waiter.tag, waiter.seq)):
+            if waiter.cancelled:
+                self._queue.remove(waiter)
+                continue
+            if waiter.kind in blocked:
+                continue
+            requests, tokens = self._buckets[waiter.kind]
+            delay = max(requests.wait_time(1, now), tokens.wait_time(waiter.tokens, now))
+            if delay > 0:
+                blocked[waiter.kind] = delay
+                continue
+            requests.take(1)
+            tokens.take(waiter.tokens)
+            self._queue.remove(waiter)
+            self._virtual_time = max(self._virtual_time, waiter.start)
+            waited = now - waiter.enqueued
+            self._granted[waiter.priority] += 1
+            self._waits[waiter.priority].append(waited)
+            self._wait_totals[waiter.priority][0] += 1
+            self._wait_totals[waiter.priority][1] += waited
+            waiter.grant()
+
+        # Forget the flows that are idle, their next request starts at the virtual time anyway
+        if not self._queue and len(self._finish) > 1000:
+            self._finish = {flow: tag for flow, tag in self._finish.items() if tag > self._virtual_time}
+        return min(blocked.values()) if blocked else None
+
+    def _run(self):
+        """
+        Function to grant the queued requests as the buckets refill, run on the thread of the scheduler.
+        """
+        with self._cond:
+            while True:
+                delay = self._dispatch() if self._queue else None
+                self._cond.wait(delay)
+
+    def stats(self):
+        """
+        Function to get the statistics of the scheduler.
+
+        Returns:
+        dict: The queue depth, granted requests and wait percentiles in milliseconds by priority,
+            and the tokens left by kind of request.
+        """
+        with self._cond:
+            depth = defaultdict(int)
+            for waiter in self._queue:
+                depth[waiter.priority] += 1
+            waits = {priority: np.array(values) for priority, values in self._waits.items() if values}
+            stats = {
+                "queue_depth": dict(depth),
+                "granted": dict(self._granted),
+                "tokens_left": {kind: {"requests": round(requests.tokens, 2), "tokens": round(tokens.tokens, 2)}
+                                for kind, (requests, tokens) in self._buckets.items()},
+            }
+        stats["wait_ms"] = {priority: {f"p{int(q * 100)}": round(float(value) * 1000, 2)
+                                       for q, value in zip(QUANTILES, np.quantile(values, QUANTILES))}
+                            for priority, values in waits.items()}
+        return stats
+
+    def render_prometheus(self):
+        """
+        Function to render the queue depth and wait times in the Prometheus text format.
+
+        Returns:
+        tuple: The lines of the queue depth gauges and the lines of the wait summaries.
+        """
+        with self._cond:
+            depth = defaultdict(int)
+            for waiter in self._queue:
+                depth[waiter.priority] += 1
+            waits = {priority: np.array(values) for priority, values in self._waits.items() if values}
+            totals = {priority: list(value) for priority, value in self._wait_totals.items()}
+
+        depth_lines, wait_lines = [], []
+        for priority in sorted(set(PRIORITY_WEIGHTS) | set(depth)):
+            depth_lines.append(f'qucopilot_scheduler_queue_depth{{scheduler="{self.name}",priority="{priority}"}} '
+                         f'{depth.get(priority, 0)}')
+        for priority, values in sorted(waits.items()):
+            labels = f'scheduler="{self.name}",priority="{priority}"'
+            for q, value in zip(QUANTILES, np.quantile(values, QUANTILES)):
+                wait_lines.append(f'qucopilot_scheduler_wait_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+            wait_lines.append(f"qucopilot_scheduler_wait_seconds_sum{{{labels}}} {totals[priority][1]:.6f}")
+            wait_lines.append(f"qucopilot_scheduler_wait_seconds_count{{{labels}}} {totals[priority][0]}")
+        return depth_lines, wait_lines
+
+
+def _render_schedulers():
+    """
+    Function to render the metrics of every scheduler in the Prometheus text format.
+
+    Returns:
+    list: The lines of the metrics.
+    """
+    with _schedulers_lock:
+        samples = [scheduler.render_prometheus() for scheduler in _schedulers.values()]
+    return ["# HELP qucopilot_scheduler_queue_depth Requests waiting for the rate limits of the house keys.",
+            "# TYPE qucopilot_scheduler_queue_depth gauge",
+            *[line for depth_lines, _ in samples for line in depth_lines],
+            "# HELP qucopilot_scheduler_wait_seconds Time the requests waited for the rate limits of the house keys.",
+            "# TYPE qucopilot_scheduler_wait_seconds summary",
+            *[line for _, wait_lines in samples for line in wait_lines]]
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def _get_limits(name):
+    """
+    Function to get the limits of a scheduler from the secrets.
+
+    Args:
+    name (str): The name of the scheduler, "openai" or "cohere".
+
+    Returns:
+    dict: The (requests per minute, tokens per minute) by kind of request.
+    """
+    if name == "openai":
+        return {
+            "chat": (st.secrets.get("OPENAI_RPM", DEFAULT_OPENAI_RPM), st.secrets.get("OPENAI_TPM", DEFAULT_OPENAI_TPM)),
+            "embeddings": (st.secrets.get("OPENAI_EMBEDDING_RPM", DEFAULT_OPENAI_EMBEDDING_RPM),
+                           st.secrets.get("OPENAI_EMBEDDING_TPM", DEFAULT_OPENAI_EMBEDDING_TPM)),
+        }
+    if name == "cohere":
+        return {"rerank": (st.secrets.get("COHERE_RPM", DEFAULT_COHERE_RPM), 0)}
+    raise ValueError(f"Unknown scheduler {name}")
+
+
+def get_scheduler(name):
+    """
+    Function to get the process-wide scheduler of the house key of a provider.
+
+    The limits are set with the OPENAI_RPM, OPENAI_TPM, OPENAI_EMBEDDING_RPM, OPENAI_EMBEDDING_TPM
+    and COHERE_RPM secrets. The queue depth and wait times are served with the other metrics.
+
+    Args:
+    name (str): The name of the provider, "openai" or "cohere".
+
+    Returns:
+    RequestScheduler: The scheduler.
+    """
+    with _schedulers_lock:
+        if name not in _schedulers:
+            _schedulers[name] = RequestScheduler(name, _get_limits(name))
+            if len(_schedulers) == 1:
+                get_metrics().add_collector(_render_schedulers)
+        return _schedulers[name]
+
+
+def estimate_request(request):
+    """
+    Function to get the kind and the estimated tokens of a request to the OpenAI API.
+
+    The tokens are estimated from the size of the body, plus the completion tokens the request
+    may generate, which OpenAI counts against the limit too.
+
+    Args:
+    request (httpx.Request): The request.
+
+    Returns:
+    tuple: The kind of the request, None when it is not limited, and its estimated tokens.
+    """
+    path = request.url.path
+    if path.endswith("/embeddings"):
+        return "embeddings", len(request.content) // CHARS_PER_TOKEN
+    if path.endswith("/chat/completions"):
+        try:
+            completion_tokens = json.loads(request.content).get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+        except ValueError:
+            completion_tokens = DEFAULT_COMPLETION_TOKENS
+        return "chat", len(request.content) // CHARS_PER_TOKEN + completion_tokens
+    return None, 0
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """
+    Transport making the requests sent with the house key wait for the scheduler of the key.
+
+    Requests sent with another key, e.g. the own key of a user, go straight through.
+
+    Attributes:
+    transport (httpx.BaseTransport): The wrapped transport.
+    scheduler (RequestScheduler): The scheduler of the house key.
+    """
+    def __init__(self, transport, scheduler, api_key):
+        """
+        The constructor for the RateLimitedTransport class.
+
+        Args:
+        transport (httpx.BaseTransport): The wrapped transport.
+        scheduler (RequestScheduler): The scheduler of the house key.
+        api_key (str): The house key.
+        """
+        self.transport = transport
+        self.scheduler = scheduler
+        self._authorization = f"Bearer {api_key}"
+
+    def handle_request(self, request):
+        if request.headers.get("Authorization") == self._authorization:
+            kind, tokens = estimate_request(request)
+            if kind is not None:
+                with span("rate_limit_wait"):
+                    self.scheduler.acquire(kind, tokens)
+        return self.transport.handle_request(request)
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    Asynchronous counterpart of RateLimitedTransport, waiting without blocking the event loop.
+
+    Attributes:
+    transport (httpx.AsyncBaseTransport): The wrapped transport.
+    scheduler (RequestScheduler): The scheduler of the house key.
+    """
+    def __init__(self, transport, scheduler, api_key):
+        """
+        The constructor for the AsyncRateLimitedTransport class.
+
+        Args:
+        transport (httpx.AsyncBaseTransport): The wrapped transport.
+        scheduler (RequestScheduler): The scheduler of the house key.
+        api_key (str): The house key.
+        """
+        self.transport = transport
+        self.scheduler = scheduler
+        self._authorization = f"Bearer {api_key}"
+
+    async def handle_async_request(self, request):
+        if request.headers.get("Authorization") == self._authorization:
+            kind, tokens = estimate_request(request)
+            if kind is not None:
+                with span("rate_limit_wait"):
+                    await self.scheduler.aacquire(kind, tokens)
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ScheduledCompressor(BaseDocumentCompressor):
+    """
+    Document compressor making every call of the wrapped one wait for the Cohere scheduler.
+
+    Attributes:
+    compressor: The wrapped compressor, e.g. CohereRerank.
+    """
+    compressor: BaseDocumentCompressor
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        tokens = (len(query) + sum(len(doc.page_content) for doc in documents)) // CHARS_PER_TOKEN
+        with span("rate_limit_wait"):
+            get_scheduler("cohere").acquire("rerank", tokens)
+        return self.compressor.compress_documents(documents, query, callbacks)
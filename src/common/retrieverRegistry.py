@@ -0,0 +1,293 @@
+# Import the required libraries
+import os
+import time
+import weakref
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import streamlit as st
+from src.common.customHybridRetriever import Retriever
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Default memory budget for the loaded indexes, in megabytes
+DEFAULT_MEMORY_BUDGET_MB = 2048
+
+# Default number of seconds between two checks of a course index on disk
+DEFAULT_STALE_CHECK_SECONDS = 10
+
+
+class RetrieverRegistry:
+    """
+    Process-wide registry of read-only retrievers shared by all the Streamlit sessions.
+
+    Retrievers are keyed by the course's RETRIEVER_DB_PATH and HYBRID_DB_PATH. Every session
+    holding a retriever counts as a reference. Retrievers that are no longer referenced stay
+    loaded until the total size of the loaded indexes exceeds the memory budget, at which point
+    the least recently used ones are evicted.
+
+    Attributes:
+    memory_budget (int): The memory budget for the loaded indexes in bytes.
+    stale_check_interval (float): The number of seconds between two checks of a course index on disk.
+    """
+    def __init__(self, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, stale_check_interval=DEFAULT_STALE_CHECK_SECONDS):
+        """
+        The constructor for the RetrieverRegistry class.
+
+        Args:
+        memory_budget_mb (int): The memory budget for the loaded indexes in megabytes.
+        stale_check_interval (float): The number of seconds between two checks of a course index on disk.
+        """
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.stale_check_interval = stale_check_interval
+        self._entries = OrderedDict()
+        self._owners = {}
+        self._loading = {}
+        self._load_listeners = []
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def get_key(config_param):
+        """
+        Function to get the registry key of a course.
+
+        Args:
+        config_param (dict): The configuration of the course.
+
+        Returns:
+        tuple: The key of the course.
+        """
+        return (os.path.abspath(config_param["RETRIEVER_DB_PATH"]),
+                os.path.abspath(config_param["HYBRID_DB_PATH"]))
+
+    def acquire(self, config_param, owner=None):
+        """
+        Function to get the shared retriever of a course, loading it if needed.
+
+        Args:
+        config_param (dict): The configuration of the course.
+        owner (object): The object holding the retriever. The reference is released when it is
+            garbage collected or passed to release.
+
+        Returns:
+        Retriever: The shared retriever.
+        """
+        key = self.get_key(config_param)
+        with self._lock:
+            entry = self._entries.get(key)
+
+        # Reload the course once its index was rebuilt or updated on disk, checked without the lock
+        if entry is not None and self._is_stale(entry):
+            logger.info(f"Index of {key[0]} changed on disk, reloading the shared retriever")
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            # Only one session loads a course, the others wait for it without holding the lock
+            loading = None
+            if entry is None:
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = Future()
+                    loading.set_running_or_notify_cancel()
+                else:
+                    entry, loading = loading, None
+
+        if isinstance(entry, Future):
+            entry = entry.result()
+        elif loading is not None:
+            entry = self._load(key, config_param, loading)
+
+        with self._lock:
+            # The entry may have been evicted while it was loading, it is referenced again now
+            entry = self._entries.setdefault(key, entry)
+            self._entries.move_to_end(key)
+            entry["refs"] += 1
+
+            # Release the previous retriever of the owner, then tie this one to its lifetime
+            if owner is not None:
+                self.release(owner)
+                self._owners[id(owner)] = weakref.finalize(owner, self._release_owner, id(owner), key,
+                                                           entry["retriever"])
+
+            self._evict()
+            return entry["retriever"]
+
+    def _is_stale(self, entry):
+        """
+        Function to check whether the index of a loaded course changed on disk, at most once per interval.
+
+        Reading the manifest and hashing the legacy store hit the disk, so this is called without the lock.
+
+        Args:
+        entry (dict): The registry entry of the course.
+
+        Returns:
+        bool: True when the retriever must be reloaded.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - entry["checked"] < self.stale_check_interval:
+                return False
+            entry["checked"] = now
+        return entry["retriever"].is_stale()
+
+    def _load(self, key, config_param, loading):
+        """
+        Function to load the retriever of a course without holding the registry lock.
+
+        Args:
+        key (tuple): The key of the course.
+        config_param (dict): The configuration of the course.
+        loading (Future): The future the other sessions acquiring the course wait on.
+
+        Returns:
+        dict: The registry entry of the loaded retriever.
+        """
+        logger.info(f"Loading the shared retriever for {key[0]}")
+        try:
+            retriever = Retriever(config_param["RETRIEVER_DB_PATH"], config_param["HYBRID_DB_PATH"])
+            retriever._load_params()
+        except Exception as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set_exception(e)
+            raise
+        entry = {"retriever": retriever, "refs": 0, "nbytes": retriever.index_bundle.nbytes,
+                 "checked": time.monotonic()}
+        with self._lock:
+            self._entries[key] = entry
+            self._loading.pop(key, None)
+            listeners = list(self._load_listeners)
+        loading.set_result(entry)
+
+        for listener in listeners:
+            try:
+                listener(config_param, retriever)
+            except Exception as e:
+                logger.warning(f"Load listener failed for {key[0]}: {e}")
+        return entry
+
+    def add_load_listener(self, listener):
+        """
+        Function to be notified every time a course index is loaded, e.g. after it was rebuilt.
+
+        Args:
+        listener (callable): Function taking the configuration of the course and its retriever,
+            called by the session that loaded the course, after the registry lock is released.
+        """
+        with self._lock:
+            if listener not in self._load_listeners:
+                self._load_listeners.append(listener)
+
+    def release(self, owner):
+        """
+        Function to release the retriever held by an owner.
+
+        Args:
+        owner (object): The object passed to acquire.
+        """
+        with self._lock:
+            finalizer = self._owners.pop(id(owner), None)
+        if finalizer is not None:
+            finalizer()
+
+    def _release_owner(self, owner_id, key, retriever):
+        """
+        Function to drop the reference of an owner, called by its finalizer.
+
+        Args:
+        owner_id (int): The id of the owner.
+        key (tuple): The key of the course.
+        retriever (Retriever): The retriever the reference was taken on.
+        """
+        with self._lock:
+            # A finalizer is dead once called, a live one belongs to a new owner reusing the id
+            finalizer = self._owners.get(owner_id)
+            if finalizer is not None and not finalizer.alive:
+                del self._owners[owner_id]
+        self._release_key(key, retriever)
+
+    def _release_key(self, key, retriever):
+        """
+        Function to drop one reference to a retriever.
+
+        Args:
+        key (tuple): The key of the course.
+        retriever (Retriever): The retriever the reference was taken on.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            # The entry may have been invalidated and reloaded since the reference was taken
+            if entry is not None and entry["retriever"] is retriever:
+                entry["refs"] = max(entry["refs"] - 1, 0)
+            self._evict()
+
+    def invalidate(self, config_param):
+        """
+        Function to drop the shared retriever of a course, e.g. after its index was rebuilt.
+
+        Sessions still holding the old retriever keep using it, new sessions load the new index.
+
+        Args:
+        config_param (dict): The configuration of the course.
+        """
+        with self._lock:
+            self._entries.pop(self.get_key(config_param), None)
+
+    def _evict(self):
+        """
+        Function to evict the least recently used unreferenced retrievers while over budget.
+        """
+        total = sum(entry["nbytes"] for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.memory_budget:
+                break
+            entry = self._entries[key]
+            if entry["refs"] == 0:
+                logger.info(f"Evicting the shared retriever for {key[0]}")
+                del self._entries[key]
+                total -= entry["nbytes"]
+
+    def stats(self):
+        """
+        Function to get the state of the registry.
+
+        Returns:
+        dict: The loaded retrievers with their reference counts and sizes.
+        """
+        with self._lock:
+            return {
+                "memory_budget": self.memory_budget,
+                "loaded_bytes": sum(entry["nbytes"] for entry in self._entries.values()),
+                "retrievers": {key[0]: {"refs": entry["refs"], "nbytes": entry["nbytes"]}
+                               for key, entry in self._entries.items()},
+            }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    Function to get the process-wide retriever registry.
+
+    The memory budget is read from the RETRIEVER_CACHE_BUDGET_MB secret, and the interval between
+    two checks of a course index on disk from RETRIEVER_STALE_CHECK_SECONDS.
+
+    Returns:
+    RetrieverRegistry: The registry.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = RetrieverRegistry(
+                st.secrets.get("RETRIEVER_CACHE_BUDGET_MB", DEFAULT_MEMORY_BUDGET_MB),
+                st.secrets.get("RETRIEVER_STALE_CHECK_SECONDS", DEFAULT_STALE_CHECK_SECONDS))
+        return _registry
@@ -0,0 +1,177 @@
+# Import the required libraries
+import re
+from typing import Any, List
+import numpy as np
+from scipy import sparse
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+
+# English stopwords dropped by the "english" tokenizer
+ENGLISH_STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers
+herself him himself his how i if in into is it its itself just me more most my myself no nor not now of off on
+once only or other our ours ourselves out over own same she should so some such than that the their theirs them
+themselves then there these they this those through to too under until up very was we were what when where which
+while who whom why will with would you your yours yourself yourselves
+""".split())
+
+
+class Tokenizer:
+    """
+    Precompiled regex tokenizer for BM25.
+
+    The "whitespace" tokenizer splits on whitespace like the BM25Retriever default, so scores are
+    identical to rank_bm25. The "english" tokenizer lower-cases, keeps word characters only and
+    drops English stopwords.
+
+    Attributes:
+    name (str): The name of the tokenizer, recorded in the index manifest.
+    """
+    CONFIGS = {
+        "whitespace": {"pattern": r"\S+", "lowercase": False, "stopwords": frozenset()},
+        "english": {"pattern": r"\w+", "lowercase": True, "stopwords": ENGLISH_STOPWORDS},
+    }
+
+    def __init__(self, name="whitespace"):
+        """
+        The constructor for the Tokenizer class.
+
+        Args:
+        name (str): The name of the tokenizer, one of Tokenizer.CONFIGS.
+        """
+        if name not in self.CONFIGS:
+            raise ValueError(f"Unknown BM25 tokenizer {name}, expected one of {list(self.CONFIGS)}")
+        config = self.CONFIGS[name]
+        self.name = name
+        self._findall = re.compile(config["pattern"]).findall
+        self._lowercase = config["lowercase"]
+        self._stopwords = config["stopwords"]
+
+    def __call__(self, text):
+        """
+        Function to tokenize a text.
+
+        Args:
+        text (str): The text to tokenize.
+
+        Returns:
+        list: The list of tokens.
+        """
+        if self._lowercase:
+            text = text.lower()
+        tokens = self._findall(text)
+        if self._stopwords:
+            tokens = [token for token in tokens if token not in self._stopwords]
+        return tokens
+
+
+class SparseBM25Index:
+    """
+    BM25 Okapi scorer over a sparse term-document matrix.
+
+    The BM25 weight of every (term, document) pair does not depend on the query, so it is computed
+    once into a CSR matrix with one row per term. Scoring a query is then a sparse row gather and
+    a matrix-vector product, and stays flat as the corpus grows. Scores are identical to
+    rank_bm25.BM25Okapi on the live documents.
+
+    Attributes:
+    vocab (dict): The term ids by term.
+    weights (sparse.csr_matrix): The BM25 weights, terms x documents.
+    live (np.ndarray): The mask of the documents that can be returned.
+    """
+    def __init__(self, postings, tombstones, k1=1.5, b=0.75, epsilon=0.25):
+        """
+        The constructor for the SparseBM25Index class.
+
+        Args:
+        postings (dict): The vocabulary and the document-major CSR postings of an index bundle.
+        tombstones (np.ndarray): The mask of the removed documents.
+        k1 (float): The BM25 term frequency saturation.
+        b (float): The BM25 length normalization.
+        epsilon (float): The floor of negative idf values, as a share of the average idf.
+        """
+        self.vocab = postings["vocab"]
+        self.live = ~np.asarray(tombstones, dtype=bool)
+        num_docs = len(self.live)
+        num_terms = len(self.vocab)
+
+        # Document-major term frequencies copied out of the memory-mapped postings, tombstoned
+        # documents are dropped from the statistics
+        tf = sparse.csr_matrix(
+            (np.array(postings["tf"], dtype=np.float64), np.array(postings["indices"]), np.array(postings["indptr"])),
+            shape=(num_docs, num_terms))
+        tf.data *= self.live[np.repeat(np.arange(num_docs), np.diff(tf.indptr))]
+        tf.eliminate_zeros()
+
+        # Document frequencies and idf as computed by BM25Okapi, with negative idf floored
+        num_live = max(int(np.count_nonzero(self.live)), 1)
+        df = np.bincount(tf.indices, minlength=num_terms).astype(np.float64)
+        idf = np.log(num_live - df + 0.5) - np.log(df + 0.5)
+        if (df > 0).any():
+            idf[idf < 0] = epsilon * idf[df > 0].mean()
+
+        # BM25 weight of every non-zero entry
+        doc_len = np.asarray(postings["doc_len"], dtype=np.float64)
+        avgdl = doc_len[self.live].mean() if self.live.any() else 1.0
+        norm = k1 * (1 - b + b * doc_len / avgdl)
+        rows = np.repeat(np.arange(num_docs), np.diff(tf.indptr))
+        tf.data = idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + norm[rows])
+        self.weights = tf.T.tocsr()
+
+    def scores(self, tokens):
+        """
+        Function to compute the BM25 score of every document for a tokenized query.
+
+        Args:
+        tokens (list): The query tokens, repeated tokens count every time.
+
+        Returns:
+        np.ndarray: The score of every document, -inf for removed documents.
+        """
+        term_ids = [self.vocab[token] for token in tokens if token in self.vocab]
+        scores = np.zeros(len(self.live), dtype=np.float64)
+        if term_ids:
+            ids, counts = np.unique(term_ids, return_counts=True)
+            scores = self.weights[ids].T @ counts.astype(np.float64)
+        scores[~self.live] = -np.inf
+        return scores
+
+    def top_k(self, tokens, k):
+        """
+        Function to get the best scoring documents for a tokenized query.
+
+        Args:
+        tokens (list): The query tokens.
+        k (int): The number of documents to return.
+
+        Returns:
+        list: The positions of the documents, best first.
+        """
+        scores = self.scores(tokens)
+        k = min(k, int(np.count_nonzero(self.live)))
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        return candidates[np.argsort(-scores[candidates], kind="stable")].tolist()
+
+
+class SparseBM25Retriever(BaseRetriever):
+    """
+    BM25 retriever over the sparse index of an index bundle, a drop-in replacement for BM25Retriever.
+
+    Attributes:
+    bundle: The index bundle.
+    k: The number of documents to return.
+    """
+    bundle: Any
+    k: int = 5
+
+    class Config:
+        """Configuration for this pydantic object."""
+
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.bundle.get_documents(self.bundle.bm25_index.top_k(self.bundle.tokenizer(query), self.k))
@@ -0,0 +1,280 @@
+# Import the required libraries
+import time
+import numpy as np
+import faiss
+from src.common.logger import Logger
+
+# Create the logger object
+logger = Logger.get_logger()
+
+# Index types the builder can choose from, "auto" picks one from the corpus size and the targets
+VECTOR_INDEX_TYPES = ("auto", "flat", "hnsw", "ivfpq", "ivfsq")
+
+# Default selection parameters, overridable through the build parameters
+DEFAULT_VECTOR_INDEX_PARAMS = {
+    "type": "auto",
+    "memory_budget_mb": 512,
+    "target_recall": 0.95,
+    "flat_max_vectors": 20000,
+    "recall_k": 10,
+    "recall_queries": 200,
+}
+
+# Construction parameters of the approximate indexes
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+PQ_NBITS = 8
+PQ_DIMS_PER_CODE = (16, 8, 4)
+MAX_TRAINING_VECTORS = 100000
+
+# Search parameters tried in order until the recall target is met
+EF_SEARCH_VALUES = (16, 32, 64, 128, 256, 512)
+NPROBE_VALUES = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def get_vector_index_params(build_params):
+    """
+    Function to get the index selection parameters of a build.
+
+    Args:
+    build_params (dict): The parameters used to build the chunks and embeddings.
+
+    Returns:
+    dict: The selection parameters, defaults filled in.
+    """
+    params = dict(DEFAULT_VECTOR_INDEX_PARAMS, **((build_params or {}).get("vector_index") or {}))
+    if params["type"] not in VECTOR_INDEX_TYPES:
+        raise ValueError(f"Unknown vector index type {params['type']}, expected one of {list(VECTOR_INDEX_TYPES)}")
+    return params
+
+
+def get_candidates(num_vectors, dimension, params):
+    """
+    Function to list the index specs worth trying for a corpus, most compact first.
+
+    Quantized IVF specs come first from the strongest to the lightest compression (product
+    quantization, then 8-bit scalar quantization), then HNSW, which is larger than flat but
+    searches in sub-linear time, then flat, which is exact. Specs whose estimated size exceeds
+    the memory budget are dropped, unless nothing fits.
+
+    Args:
+    num_vectors (int): The number of vectors.
+    dimension (int): The dimension of the vectors.
+    params (dict): The selection parameters.
+
+    Returns:
+    list: The candidate specs, each with its estimated size in bytes.
+    """
+    flat = {"type": "flat", "factory": "Flat", "nbytes": num_vectors * dimension * 4}
+    if params["type"] == "flat" or (params["type"] == "auto" and num_vectors <= params["flat_max_vectors"]):
+        return [flat]
+
+    candidates = []
+    nlist = max(1, min(int(4 * np.sqrt(num_vectors)), num_vectors // 39))
+    if params["type"] in ("auto", "ivfpq"):
+        nbits = PQ_NBITS if num_vectors >= 39 * 2 ** PQ_NBITS else max(1, int(np.log2(max(num_vectors // 39, 2))))
+        for dims_per_code in PQ_DIMS_PER_CODE:
+            m = max(1, dimension // dims_per_code)
+            while dimension % m:
+                m -= 1
+            candidates.append({
+                "type": "ivfpq", "factory": f"IVF{nlist},PQ{m}x{nbits}", "nlist": nlist,
+                "nbytes": num_vectors * (m * nbits // 8 + 8) + (nlist + 2 ** nbits) * dimension * 4,
+            })
+    if params["type"] in ("auto", "ivfsq"):
+        candidates.append({"type": "ivfsq", "factory": f"IVF{nlist},SQ8", "nlist": nlist,
+                           "nbytes": num_vectors * (dimension + 8) + nlist * dimension * 4})
+    if params["type"] in ("auto", "hnsw"):
+        candidates.append({"type": "hnsw", "factory": f"HNSW{HNSW_M}",
+                           "nbytes": num_vectors * (dimension * 4 + HNSW_M * 2 * 4 * 1.1)})
+    if params["type"] == "auto":
+        candidates.append(flat)
+
+    budget = params["memory_budget_mb"] * 1024 * 1024
+    fitting = [spec for spec in candidates if spec["nbytes"] <= budget]
+    if not fitting:
+        logger.warning(f"No vector index fits the budget of {params['memory_budget_mb']}MB, using the smallest one")
+        fitting = [min(candidates, key=lambda spec: spec["nbytes"])]
+    return fitting
+
+
+def build_index(spec, vectors):
+    """
+    Function to build an index from its spec.
+
+    Args:
+    spec (dict): The index spec.
+    vectors (np.ndarray): The vectors.
+
+    Returns:
+    faiss.Index: The trained index holding the vectors.
+    """
+    index = faiss.index_factory(vectors.shape[1], spec["factory"], faiss.METRIC_L2)
+    if spec["type"] == "hnsw":
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        sample = vectors if len(vectors) <= MAX_TRAINING_VECTORS else \
+            vectors[np.sort(rng.choice(len(vectors), MAX_TRAINING_VECTORS, replace=False))]
+        index.train(sample)
+    index.add(vectors)
+    return index
+
+
+def get_recall(index, queries, ground_truth):
+    """
+    Function to measure the recall of an index against exact search.
+
+    Args:
+    index (faiss.Index): The index.
+    queries (np.ndarray): The query vectors.
+    ground_truth (np.ndarray): The exact nearest neighbours of every query.
+
+    Returns:
+    float: The share of the exact neighbours found.
+    """
+    _, ids = index.search(queries, ground_truth.shape[1])
+    found = sum(len(np.intersect1d(row, truth)) for row, truth in zip(ids, ground_truth))
+    return found / ground_truth.size
+
+
+def apply_search_params(index, search_params):
+    """
+    Function to set the search parameters of an index, e.g. after it was read from disk.
+
+    Args:
+    index (faiss.Index): The index.
+    search_params (dict): The parameter values by name, e.g. nprobe or efSearch.
+    """
+    space = faiss.ParameterSpace()
+    for name, value in (search_params or {}).items():
+        space.set_index_parameter(index, name, value)
+
+
+def tune_search(index, spec, queries, ground_truth, target_recall):
+    """
+    Function to find the cheapest search parameters of an index reaching the recall target.
+
+    Args:
+    index (faiss.Index): The index.
+    spec (dict): The index spec.
+    queries (np.ndarray): The query vectors.
+    ground_truth (np.ndarray): The exact nearest neighbours of every query.
+    target_recall (float): The recall to reach.
+
+    Returns:
+    tuple: The search parameters and the recall they give, the best ones if the target is out of reach.
+    """
+    if spec["type"] == "flat":
+        return {}, 1.0
+    if spec["type"] == "hnsw":
+        name, values = "efSearch", EF_SEARCH_VALUES
+    else:
+        name, values = "nprobe", [value for value in NPROBE_VALUES if value < spec["nlist"]] + [spec["nlist"]]
+
+    best = ({}, 0.0)
+    for value in values:
+        apply_search_params(index, {name: value})
+        recall = get_recall(index, queries, ground_truth)
+        if recall > best[1]:
+            best = ({name: value}, recall)
+        if recall >= target_recall:
+            break
+    apply_search_params(index, best[0])
+    return best
+
+
+def _evaluate(spec, flat_index, vectors, queries, ground_truth, params):
+    """
+    Function to build a candidate index and measure its recall.
+
+    Args:
+    spec (dict): The index spec.
+    flat_index (faiss.IndexFlatL2): The exact index holding all the vectors.
+    vectors (np.ndarray): The vectors.
+    queries (np.ndarray): The query vectors.
+    ground_truth (np.ndarray): The exact nearest neighbours of every query.
+    params (dict): The selection parameters.
+
+    Returns:
+    tuple: The index and its description for the manifest.
+    """
+    started = time.perf_counter()
+    index = flat_index if spec["type"] == "flat" else build_index(spec, vectors)
+    search_params, recall = tune_search(index, spec, queries, ground_truth, params["target_recall"])
+    info = {
+        "type": spec["type"],
+        "factory": spec["factory"],
+        "search_params": search_params,
+        "recall_at_k": round(recall, 4),
+        "recall_k": ground_truth.shape[1],
+        "recall_queries": len(queries),
+        "target_recall": params["target_recall"],
+        "nbytes": int(faiss.serialize_index(index).nbytes),
+        "flat_nbytes": flat_index.ntotal * flat_index.d * 4,
+    }
+    logger.info(f"Vector index candidate {spec['factory']}: recall {recall:.3f} with {search_params}, "
+                f"{info['nbytes']} bytes, built in {time.perf_counter() - started:.1f}s")
+    return index, info
+
+
+def select_vector_index(flat_index, params):
+    """
+    Function to choose and build the vector index of a bundle.
+
+    The recall of every candidate is measured against exact search on perturbed copies of a
+    sample of the vectors.
+    Quantized indexes lose recall as the compression grows, so they are tried from the lightest
+    compression on and the most compact one reaching the recall target is kept. Otherwise HNSW
+    and then flat are tried, and when nothing reaches the target the best recall is kept.
+
+    Args:
+    flat_index (faiss.IndexFlatL2): The exact index holding all the vectors.
+    params (dict): The selection parameters.
+
+    Returns:
+    tuple: The chosen index and its description for the manifest.
+    """
+    num_vectors, dimension = flat_index.ntotal, flat_index.d
+    candidates = get_candidates(num_vectors, dimension, params)
+    if [spec["type"] for spec in candidates] == ["flat"]:
+        return flat_index, {"type": "flat", "factory": "Flat", "search_params": {}, "recall_at_k": 1.0,
+                            "nbytes": num_vectors * dimension * 4, "flat_nbytes": num_vectors * dimension * 4}
+
+    # Exact neighbours of queries near a sample of the vectors, the yardstick of every candidate.
+    # The sampled vectors are moved halfway to their nearest neighbour in a random direction, as
+    # each of them would otherwise be an exact match of itself and inflate the recall
+    vectors = flat_index.reconstruct_n(0, num_vectors)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(num_vectors, min(params["recall_queries"], num_vectors), replace=False)]
+    distances, _ = flat_index.search(queries, 2)
+    directions = rng.standard_normal(queries.shape).astype(np.float32)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    queries = queries + directions * (0.5 * np.sqrt(np.maximum(distances[:, 1:], 0)))
+    _, ground_truth = flat_index.search(queries, min(params["recall_k"], num_vectors))
+
+    best = None
+    chosen = None
+    quantized = [spec for spec in candidates if spec["type"] in ("ivfpq", "ivfsq")]
+    for spec in reversed(quantized):
+        index, info = _evaluate(spec, flat_index, vectors, queries, ground_truth, params)
+        if best is None or info["recall_at_k"] > best[1]["recall_at_k"]:
+            best = (index, info)
+        if info["recall_at_k"] < params["target_recall"]:
+            break
+        chosen = (index, info)
+    if chosen is not None:
+        return chosen
+
+    for spec in candidates:
+        if spec in quantized:
+            continue
+        index, info = _evaluate(spec, flat_index, vectors, queries, ground_truth, params)
+        if best is None or info["recall_at_k"] > best[1]["recall_at_k"]:
+            best = (index, info)
+        if info["recall_at_k"] >= params["target_recall"]:
+            return index, info
+
+    logger.warning(f"No vector index reached the recall target of {params['target_recall']}, "
+                   f"using {best[1]['factory']} with recall {best[1]['recall_at_k']}")
+    return best
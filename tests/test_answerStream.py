@@ -0,0 +1,41 @@
+# Import the required libraries
+from src.common.answerStream import JsonFieldStream, REPLACEMENT_CHARACTER
+
+
+def feed_all(chunks):
+    """
+    Function to stream chunks of a model output through a JsonFieldStream on the answer field.
+
+    Args:
+    chunks (list): The chunks.
+
+    Returns:
+    str: The decoded answer.
+    """
+    answer = JsonFieldStream("answer")
+    return "".join([answer.feed(chunk) for chunk in chunks])
+
+
+def test_surrogate_pair_is_decoded():
+    assert feed_all(['{"answer": "a\\ud83d\\ude00b"}']) == "a\U0001F600b"
+
+
+def test_surrogate_pair_split_across_chunks():
+    output = '{"answer": "a\\ud83d\\ude00b"}'
+    for cut in range(len(output) + 1):
+        assert feed_all([output[:cut], output[cut:]]) == "a\U0001F600b"
+
+
+def test_high_surrogate_at_the_end_of_the_field():
+    answer = JsonFieldStream("answer")
+    assert answer.feed('{"answer": "ab\\ud83d", "followups": ["x"]}') == "ab" + REPLACEMENT_CHARACTER
+    assert answer.done
+
+
+def test_high_surrogate_followed_by_another_escape():
+    assert feed_all(['{"answer": "\\ud83d\\n\\ud83d\\u0041"}']) == \
+        REPLACEMENT_CHARACTER + "\n" + REPLACEMENT_CHARACTER + "A"
+
+
+def test_lone_low_surrogate():
+    assert feed_all(['{"answer": "a\\ude00b"}']) == "a" + REPLACEMENT_CHARACTER + "b"